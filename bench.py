@@ -0,0 +1,479 @@
+"""
+Нагрузочный тест бота без настоящих Telegram и Gemini.
+
+Запускает настоящее приложение бота (обработчики, хранилище, пулы, очередь к Gemini) против
+локальных поддельных серверов: Bot API и generateContent. Синтетические обновления (текст, фото,
+альбомы, документы) подаются прямо в очередь обновлений приложения, а с --workers N > 1 — через
+getUpdates поддельного Bot API главному процессу, который раздаёт их N рабочим процессам.
+Запрос считается выполненным, когда бот отправил пользователю файл с ответом (или сообщение об ошибке).
+
+Пример:
+    python bench.py --requests 200 --concurrency 20 --mix text=50,photo=30,album=10,document=10 \\
+        --gemini-latency 2 --gemini-429-rate 0.05 --keys 4
+
+Результат: пропускная способность, p50/p95/p99 задержки по видам запросов, задержка цикла событий
+и потребление памяти (RSS). С --json отчёт печатается в JSON для сравнения между версиями.
+"""
+
+import os
+import re
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import resource
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from PIL import Image
+
+BOT_TOKEN = "123456:bench"
+PROGRESS_PREFIXES = ("⏳", "⌛", "🕒", "📄", "⚠️") # Сообщения бота о ходе обработки, а не ответы
+
+
+# --- Простейший HTTP/1.1 сервер для поддельных API ---
+
+async def serve_http(reader, writer, handler) -> None:
+    """Обслуживает keep-alive соединение: handler(method, target, headers, body) -> (status, headers, body)."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, _ = request_line.decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode().split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", "0")))
+
+            status, response_headers, response_body = await handler(method, target, headers, body)
+            head = f"HTTP/1.1 {status}\r\n" + "".join(f"{name}: {value}\r\n" for name, value in response_headers.items())
+            if isinstance(response_body, bytes):
+                writer.write(f"{head}Content-Length: {len(response_body)}\r\n\r\n".encode() + response_body)
+            else:
+                # Поток частей (для SSE): отправляем их по мере готовности
+                writer.write(f"{head}Transfer-Encoding: chunked\r\n\r\n".encode())
+                async for chunk in response_body:
+                    writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                    await writer.drain()
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+class FakeTelegram:
+    """
+    Поддельный Bot API: отвечает на вызовы бота правдоподобными объектами, отдаёт «загруженные» файлы
+    и сообщает о завершении запроса, когда бот отправляет пользователю документ, фото или ошибку.
+    """
+
+    def __init__(self, latency: float, on_reply):
+        self.latency = latency
+        self.on_reply = on_reply  # on_reply(chat_id, ok), вызывается из потока сервера
+        self.files = {}  # file_id -> содержимое
+        self.calls = {}
+        self.loop = None  # Цикл событий потока сервера
+        self._message_id = 0
+        self._updates = []  # Обновления для getUpdates
+        self._new_updates = asyncio.Event()
+
+    def push(self, data: dict) -> None:
+        """Добавляет обновление для getUpdates (вызывается в потоке сервера)."""
+        self._updates.append(data)
+        self._new_updates.set()
+
+    def _params(self, headers: dict, body: bytes) -> dict:
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("multipart/form-data"):
+            return {
+                name.decode(): value.decode(errors="replace")
+                for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n', body)
+            }
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+    def _message(self, chat_id: int, text: str = None) -> dict:
+        self._message_id += 1
+        message = {"message_id": self._message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        if text is not None:
+            message["text"] = text
+        return message
+
+    async def handle(self, method, target, headers, body):
+        await asyncio.sleep(self.latency)
+        path = unquote(urlsplit(target).path) # PTB кодирует «:» из токена в адресе файла
+        if path.startswith(f"/file/bot{BOT_TOKEN}/"):
+            file_id = path.rsplit("/", 1)[-1]
+            return "200 OK", {"Content-Type": "application/octet-stream"}, self.files.get(file_id, b"")
+
+        api_method = path.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = self._params(headers, body)
+        chat_id = int(params.get("chat_id", 0) or 0)
+
+        if api_method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif api_method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            self._updates = [data for data in self._updates if data["update_id"] >= offset]
+            if not self._updates:
+                # Долгий опрос, но не дольше секунды, чтобы бот быстро останавливался
+                self._new_updates.clear()
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), min(1.0, float(params.get("timeout") or 0)))
+                except asyncio.TimeoutError:
+                    pass
+            result = self._updates[:100]
+        elif api_method == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files.get(file_id, b"")),
+                      "file_path": f"files/{file_id}"}
+        elif api_method in ("sendDocument", "sendPhoto"):
+            self.on_reply(chat_id, True)
+            result = self._message(chat_id)
+        elif api_method in ("sendMessage", "editMessageText"):
+            text = params.get("text", "")
+            # Ответ в формате HTML приходит документом; любое другое сообщение, кроме сообщений о ходе
+            # обработки, завершает запрос неудачей (ошибка, нехватка кредитов и т. п.)
+            if text.startswith("Извините") or (api_method == "sendMessage" and not text.startswith(PROGRESS_PREFIXES)):
+                self.on_reply(chat_id, False)
+            result = self._message(chat_id, text)
+        else:
+            result = True
+        return "200 OK", {"Content-Type": "application/json"}, json.dumps({"ok": True, "result": result}).encode()
+
+
+class FakeGemini:
+    """Поддельный generateContent / streamGenerateContent с настраиваемой задержкой, долей 429 и размером ответа."""
+
+    def __init__(self, latency: float, rate_limit_share: float, response_bytes: int):
+        self.latency = latency
+        self.rate_limit_share = rate_limit_share
+        self.response_bytes = response_bytes
+        self.requests = 0
+        self.rate_limited = 0
+
+    def _answer(self, request: dict) -> str:
+        paragraph = "<p>Решение: подставим значения и получим ответ x = 42.</p>\n"
+        count = max(1, self.response_bytes // len(paragraph.encode()))
+        return "<!DOCTYPE html><html><head><title>Решение</title></head><body>" + paragraph * count + "</body></html>"
+
+    async def handle(self, method, target, headers, body):
+        self.requests += 1
+        # Задержка с разбросом ±50%
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.rate_limit_share:
+            self.rate_limited += 1
+            return "429 Too Many Requests", {"Content-Type": "application/json", "Retry-After": "1"}, \
+                b'{"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}}'
+
+        request = json.loads(body or b"{}")
+        text = self._answer(request)
+        usage = {"promptTokenCount": len(body) // 4}
+        if ":streamGenerateContent" in target:
+            async def events():
+                step = max(1, len(text) // 8)
+                for start in range(0, len(text), step):
+                    chunk = {"candidates": [{"content": {"parts": [{"text": text[start:start + step]}]}}], "usageMetadata": usage}
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode()
+                    await asyncio.sleep(0.01)
+            return "200 OK", {"Content-Type": "text/event-stream"}, events()
+        result = {"candidates": [{"content": {"parts": [{"text": text}]}}], "usageMetadata": usage}
+        return "200 OK", {"Content-Type": "application/json"}, json.dumps(result, ensure_ascii=False).encode()
+
+
+def start_fake_servers(telegram: FakeTelegram, gemini: FakeGemini) -> tuple:
+    """Запускает поддельные серверы в отдельном потоке со своим циклом событий. Возвращает их порты."""
+    ready = threading.Event()
+    ports = {}
+
+    def run() -> None:
+        loop = telegram.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        async def start() -> None:
+            for name, fake in (("telegram", telegram), ("gemini", gemini)):
+                server = await asyncio.start_server(
+                    lambda r, w, fake=fake: serve_http(r, w, fake.handle), "127.0.0.1", 0
+                )
+                ports[name] = server.sockets[0].getsockname()[1]
+            ready.set()
+
+        loop.run_until_complete(start())
+        loop.run_forever()
+
+    threading.Thread(target=run, name="fake-servers", daemon=True).start()
+    ready.wait()
+    return ports["telegram"], ports["gemini"]
+
+
+# --- Синтетические обновления ---
+
+def make_jpeg(width: int, height: int) -> bytes:
+    """Шумное изображение: сжимается плохо, как настоящая фотография тетради."""
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class Workload:
+    """Генерирует обновления разных видов для виртуальных пользователей."""
+
+    def __init__(self, telegram: FakeTelegram, photo: bytes, album_size: int, document_bytes: int):
+        self.telegram = telegram
+        self.photo = photo
+        self.album_size = album_size
+        self.document = ("Задание: реши уравнение.\n" * (document_bytes // 40 + 1)).encode()
+        self._update_id = 0
+        self._message_id = 0
+        self._file_id = 0
+
+    def _message(self, user_id: int, **fields) -> dict:
+        self._update_id += 1
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            **fields,
+        }
+        return {"update_id": self._update_id, "message": message}
+
+    def _file(self, content: bytes) -> str:
+        self._file_id += 1
+        file_id = f"bench{self._file_id}"
+        self.telegram.files[file_id] = content
+        return file_id
+
+    def _photo_sizes(self) -> list:
+        file_id = self._file(self.photo)
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960, "file_size": len(self.photo)}]
+
+    def updates(self, kind: str, user_id: int, number: int) -> list:
+        """Обновления одного запроса вида kind (у альбома их несколько)."""
+        prompt = f"Задача {number}: найди x, если 2x + {number} = {number + 84}."
+        if kind == "text":
+            return [self._message(user_id, text=prompt)]
+        if kind == "photo":
+            return [self._message(user_id, photo=self._photo_sizes(), caption=prompt)]
+        if kind == "album":
+            group_id = f"album{number}"
+            return [
+                self._message(user_id, photo=self._photo_sizes(), media_group_id=group_id, **({"caption": prompt} if i == 0 else {}))
+                for i in range(self.album_size)
+            ]
+        if kind == "document":
+            file_id = self._file(self.document)
+            document = {"file_id": file_id, "file_unique_id": file_id, "file_name": "task.txt",
+                        "mime_type": "text/plain", "file_size": len(self.document)}
+            return [self._message(user_id, document=document, caption=prompt)]
+        raise ValueError(f"неизвестный вид запроса: {kind}")
+
+
+# --- Измерения ---
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+def summarize(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 0.50), 3),
+        "p95": round(percentile(values, 0.95), 3),
+        "p99": round(percentile(values, 0.99), 3),
+        "max": round(max(values), 3) if values else 0.0,
+    }
+
+async def measure_loop_lag(samples: list, interval: float = 0.05) -> None:
+    """Насколько позже запланированного просыпается задача — задержка цикла событий бота."""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.monotonic() - started - interval))
+
+
+async def run_benchmark(args, bot, telegram: FakeTelegram, gemini: FakeGemini, workload: Workload) -> dict:
+    loop = asyncio.get_running_loop()
+    waiting = {}  # user_id -> Future завершения текущего запроса
+
+    def on_reply(chat_id: int, ok: bool) -> None:
+        future = waiting.get(chat_id)
+        if future is not None and not future.done():
+            future.set_result(ok)
+
+    telegram.on_reply = lambda chat_id, ok: loop.call_soon_threadsafe(on_reply, chat_id, ok)
+
+    kinds, weights = zip(*args.mix.items())
+    latencies = {kind: [] for kind in kinds}
+    failures = {kind: 0 for kind in kinds}
+    counter = iter(range(args.requests))
+
+    async def virtual_user(user_id: int, submit) -> None:
+        for number in counter:
+            kind = random.choices(kinds, weights)[0]
+            future = waiting[user_id] = loop.create_future()
+            started = time.monotonic()
+            for data in workload.updates(kind, user_id, number):
+                await submit(data)
+            try:
+                ok = await asyncio.wait_for(future, args.timeout)
+            except asyncio.TimeoutError:
+                ok = False
+            if ok:
+                latencies[kind].append(time.monotonic() - started)
+            else:
+                failures[kind] += 1
+
+    async def run_users(submit) -> float:
+        started = time.monotonic()
+        await asyncio.gather(*(virtual_user(100000 + user, submit) for user in range(args.concurrency)))
+        return time.monotonic() - started
+
+    # Запросы разбираются пользователями из общего счётчика, поэтому быстрый пользователь
+    # может выполнить их больше своей доли — кредитов хватает на все
+    await bot.STORAGE.open()
+    for user in range(args.concurrency):
+        await bot.STORAGE.add_credits(100000 + user, args.requests)
+    await bot.STORAGE.close()
+
+    lag = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag))
+    if args.workers > 1:
+        # Как run_dispatcher: главный процесс получает обновления через getUpdates и раздаёт их процессам
+        async def submit(data: dict) -> None:
+            telegram.loop.call_soon_threadsafe(telegram.push, data)
+
+        queues, workers = bot.start_workers()
+        dispatcher = asyncio.create_task(bot.dispatch_updates(queues))
+        try:
+            elapsed = await run_users(submit)
+        finally:
+            dispatcher.cancel()
+            await asyncio.gather(dispatcher, return_exceptions=True)
+            await loop.run_in_executor(None, bot.stop_workers, queues, workers)
+    else:
+        application = bot.build_application(with_updater=False)
+        async with application:
+            await bot.post_init(application)
+            await application.start()
+
+            async def submit(data: dict) -> None:
+                await application.update_queue.put(bot.Update.de_json(data, application.bot))
+
+            elapsed = await run_users(submit)
+            await application.stop()
+            await bot.post_shutdown(application)
+    lag_task.cancel()
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "requests": args.requests,
+        "completed": completed,
+        "failed": sum(failures.values()),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(completed / elapsed, 2) if elapsed else 0.0,
+        "latency_s": {"all": summarize([value for values in latencies.values() for value in values]),
+                      **{kind: summarize(values) for kind, values in latencies.items()}},
+        "failures": failures,
+        "loop_lag_s": summarize(lag),
+        # ru_maxrss в Linux — в килобайтах
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "max_rss_children_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "gemini_requests": gemini.requests,
+        "gemini_rate_limited": gemini.rate_limited,
+        "telegram_calls": telegram.calls,
+    }
+
+def print_report(report: dict) -> None:
+    print(f"Запросов: {report['completed']}/{report['requests']} выполнено, {report['failed']} с ошибкой "
+          f"за {report['elapsed_s']} с — {report['throughput_rps']} запросов/с")
+    print("Задержка, с:")
+    for kind, stats in report["latency_s"].items():
+        if stats["count"]:
+            print(f"  {kind:9} n={stats['count']:<5} p50={stats['p50']:<7} p95={stats['p95']:<7} "
+                  f"p99={stats['p99']:<7} max={stats['max']}")
+    lag = report["loop_lag_s"]
+    print(f"Задержка цикла событий, с: p50={lag['p50']} p99={lag['p99']} max={lag['max']}")
+    print(f"RSS: бот {report['max_rss_mb']} МБ, дочерние процессы {report['max_rss_children_mb']} МБ")
+    print(f"Gemini: {report['gemini_requests']} запросов, из них 429: {report['gemini_rate_limited']}")
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с поддельными Telegram и Gemini.")
+    parser.add_argument("--requests", type=int, default=100, help="Сколько запросов выполнить")
+    parser.add_argument("--concurrency", type=int, default=10, help="Сколько пользователей отправляют запросы одновременно")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=50,photo=30,album=10,document=10"),
+                        help="Доли видов запросов: text, photo, album, document")
+    parser.add_argument("--album-size", type=int, default=4)
+    parser.add_argument("--document-bytes", type=int, default=4000)
+    parser.add_argument("--photo-size", default="1280x960", help="Размер синтетического фото, ШxВ")
+    parser.add_argument("--workers", type=int, default=1, help="Рабочих процессов бота (BOT_WORKERS)")
+    parser.add_argument("--keys", type=int, default=4, help="Сколько поддельных API-ключей Gemini")
+    parser.add_argument("--key-rpm", type=int, default=1000, help="Лимит запросов в минуту на ключ")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="Средняя задержка ответа Gemini, с")
+    parser.add_argument("--gemini-429-rate", type=float, default=0.0, help="Доля ответов HTTP 429")
+    parser.add_argument("--response-bytes", type=int, default=8000, help="Размер HTML-ответа Gemini")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Задержка ответа Bot API, с")
+    parser.add_argument("--timeout", type=float, default=120, help="Максимальное время одного запроса, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Напечатать отчёт в JSON")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    telegram = FakeTelegram(args.telegram_latency, on_reply=lambda chat_id, ok: None)
+    gemini = FakeGemini(args.gemini_latency, args.gemini_429_rate, args.response_bytes)
+    telegram_port, gemini_port = start_fake_servers(telegram, gemini)
+
+    # Настройки бота задаются до импорта: bot.py читает их при загрузке модуля
+    data_dir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "GEMINI_API_KEYS": ",".join(f"bench-key-{i}" for i in range(args.keys)),
+        "GEMINI_API_BASE": f"http://127.0.0.1:{gemini_port}",
+        "GEMINI_KEY_RPM": str(args.key_rpm),
+        "GEMINI_KEY_TPM": str(10 ** 9),
+        "GEMINI_CONTEXT_CACHE": "false",
+        "TELEGRAM_API_BASE": f"http://127.0.0.1:{telegram_port}/bot",
+        "TELEGRAM_FILE_API_BASE": f"http://127.0.0.1:{telegram_port}/file/bot",
+        "STORAGE_PATH": os.path.join(data_dir, "bench.sqlite3"),
+        "RESPONSE_CACHE_PATH": "",
+        "HTML_RENDER_ENABLED": "false",
+        "METRICS_PORT": "0",
+        "BOT_WORKERS": str(args.workers),
+    })
+    import bot
+
+    width, height = (int(side) for side in args.photo_size.split("x"))
+    workload = Workload(telegram, make_jpeg(width, height), args.album_size, args.document_bytes)
+    report = asyncio.run(run_benchmark(args, bot, telegram, gemini, workload))
+    if args.json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
@@ -2,32 +2,52 @@
 
 import os
 import logging
+import logging.handlers
+import atexit
 import base64
 import asyncio
 import httpx
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, PreCheckoutQueryHandler
+from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, PreCheckoutQueryHandler, BaseUpdateProcessor
 from dotenv import load_dotenv
-from telegram.error import RetryAfter, NetworkError, BadRequest
-from PIL import Image
+from telegram.error import RetryAfter, NetworkError, BadRequest, TelegramError
+from telegram.constants import ParseMode
+from PIL import Image, ImageOps
 import io
-import aiohttp
-from collections import defaultdict
 import json
+import codecs
 import tempfile
 import pathlib
+import time
+import re
+import html
+from html.parser import HTMLParser
+import hashlib
+import hmac
+from urllib.parse import urlsplit
+import contextlib
+import functools
+from dataclasses import dataclass, field
+from collections import OrderedDict, deque
+import multiprocessing
+import queue
+import signal
+import sys
+import threading
+import traceback
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # ВАЖНО: Для работы с презентациями необходимо установить библиотеку python-pptx:
 # pip install python-pptx
 from pptx import Presentation
 from pptx.util import Inches, Pt
-from pptx.enum.text import PP_ALIGN
 from pptx.dml.color import RGBColor
-from pptx.enum.shapes import MSO_SHAPE
-from pptx.util import Inches, Pt # Добавлено для работы с размерами
 from pptx.enum.dml import MSO_THEME_COLOR # Добавлено для работы с цветами темы
-from pptx.enum.shapes import MSO_SHAPE # Добавлено для работы с фигурами
 from pptx.enum.text import MSO_ANCHOR, MSO_AUTO_SIZE # Добавлено для настройки текста
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls, qn # Для стилей шаблонов презентаций
 
 # --- Настройка и конфигурация ---
 
@@ -35,16 +55,130 @@ from pptx.enum.text import MSO_ANCHOR, MSO_AUTO_SIZE # Добавлено для
 load_dotenv('secrets.env')
 
 # Настройка логирования
-# Уровень логирования можно изменить здесь:
-# logging.INFO (стандартный), logging.DEBUG (очень подробный)
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-logging.getLogger("aiohttp.internal_client").setLevel(logging.WARNING)
+# Уровень задаётся в secrets.env: INFO (стандартный), DEBUG (очень подробный), WARNING (только проблемы)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower() # "text" или "json" (одна JSON-запись на строку)
+LOG_SAMPLE_EVERY = max(1, int(os.getenv("LOG_SAMPLE_EVERY", "10"))) # Из частых записей выводится каждая N-я
+LOG_MAX_MESSAGE = int(os.getenv("LOG_MAX_MESSAGE", "4000")) # Длиннее — обрезается
+SAMPLED = {"sampled": True} # extra для частых записей, которые выводятся выборочно
+
+# Ключи API (в том числе в адресах запросов ?key=...) и длинные base64-данные в логи не попадают
+API_KEY_RE = re.compile(r"(?<=key=)[^&\s'\"]+|AIza[0-9A-Za-z_\-]{35}")
+BASE64_BLOB_RE = re.compile(r"[A-Za-z0-9+/]{256,}={0,2}")
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "sampled"}
+
+
+def redact_log_text(text: str) -> str:
+    """Скрывает ключи API и длинные base64-блоки, обрезает слишком длинный текст."""
+    text = API_KEY_RE.sub("***", text)
+    text = BASE64_BLOB_RE.sub(lambda match: f"<base64: {len(match.group())} символов>", text)
+    if len(text) > LOG_MAX_MESSAGE:
+        text = f"{text[:LOG_MAX_MESSAGE]}… (ещё {len(text) - LOG_MAX_MESSAGE} символов)"
+    return text
+
+
+class LazyJSON:
+    """
+    JSON-представление объекта для отладочных записей: строится только при выводе записи,
+    а данные изображений (inlineData) заменяются их размером.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    @staticmethod
+    def _strip_blobs(value):
+        if isinstance(value, dict):
+            if "data" in value and "mimeType" in value:
+                return {"mimeType": value["mimeType"], "data": f"<{len(value['data'])} символов base64>"}
+            return {key: LazyJSON._strip_blobs(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [LazyJSON._strip_blobs(item) for item in value]
+        return value
+
+    def __str__(self) -> str:
+        return json.dumps(self._strip_blobs(self.value), ensure_ascii=False, indent=2)
+
+
+class RedactingFilter(logging.Filter):
+    """Подставляет аргументы записи (только для записей, которые будут выведены) и скрывает секреты."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = redact_log_text(record.getMessage())
+        record.msg, record.args = message, None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = redact_log_text(logging.Formatter().formatException(record.exc_info))
+            record.exc_info = None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Из записей с extra=SAMPLED пропускает каждую LOG_SAMPLE_EVERY-ю (отдельно для каждого шаблона сообщения)."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self._counts = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or self.every == 1:
+            return True
+        count = self._counts.get(record.msg, 0)
+        self._counts[record.msg] = count + 1
+        return count % self.every == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — один JSON-объект; поля из extra выводятся как отдельные ключи."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update({key: value for key, value in vars(record).items() if key not in LOG_RECORD_FIELDS})
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    Записи форматируются и выводятся в отдельном потоке (QueueHandler → QueueListener),
+    поэтому вывод в консоль не блокирует цикл событий.
+    """
+    output = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+    queue_handler.addFilter(RedactingFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+LOG_LISTENER = setup_logging()
 LOGGER = logging.getLogger(__name__)
 
 # Получение токена бота и ключей API
 BOT_TOKEN = os.getenv("BOT_TOKEN") # Используем переменную окружения
+# Адрес Bot API (например, свой telegram-bot-api сервер или тестовый из bench.py); пусто — api.telegram.org
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "") # Например http://127.0.0.1:8081/bot
+TELEGRAM_FILE_API_BASE = os.getenv("TELEGRAM_FILE_API_BASE", "") # Например http://127.0.0.1:8081/file/bot
 GEMINI_API_KEYS = os.getenv("GEMINI_API_KEYS", "").split(',')
 
 # Проверка, что API-ключи существуют
@@ -52,8 +186,59 @@ if not all(GEMINI_API_KEYS):
     LOGGER.error("Ошибка: API-ключи не найдены в файле secrets.env. Пожалуйста, убедитесь, что они там есть.")
     exit(1)
 
-# Переменная для отслеживания текущего индекса ключа
-key_index = 0
+# Приём обновлений. Если задан WEBHOOK_URL, бот работает через webhook, иначе — long polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "") # Публичный адрес webhook, например https://bot.example.com/telegram
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", urlsplit(WEBHOOK_URL).path or "/") # Путь, на котором слушает встроенный сервер
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")) # Одновременных соединений от Telegram
+WEBHOOK_MAX_BODY = 1024 * 1024 # Максимальный размер одного обновления
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000")) # Сколько принятых обновлений может ждать и выполняться
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64")) # Сколько обновлений обрабатывается одновременно
+# Число рабочих процессов. При BOT_WORKERS > 1 главный процесс только принимает обновления и раздаёт их
+# процессам по пользователю; настройки, кредиты, история и состояние ключей общие — в STORAGE_PATH.
+BOT_WORKERS = max(1, int(os.getenv("BOT_WORKERS", "1")))
+KEY_HEALTH_SYNC_INTERVAL = float(os.getenv("KEY_HEALTH_SYNC_INTERVAL", "2")) # Как часто процессы обмениваются паузами ключей
+WORKER_INDEX = 0 # Номер текущего рабочего процесса (задаётся в run_worker)
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 — не запускать).
+# У рабочих процессов порт METRICS_PORT + номер процесса.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+# Сторож цикла событий: замечает, когда цикл заблокирован синхронным кодом, и записывает стек
+LOOP_WATCHDOG_ENABLED = os.getenv("LOOP_WATCHDOG_ENABLED", "true").lower() == "true"
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1")) # Как часто проверять цикл, сек.
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25")) # Блокировка дольше этого попадает в лог со стеком
+# Режим отладки asyncio: сообщать о каждом шаге задачи дольше LOOP_LAG_THRESHOLD (заметно замедляет бота)
+LOOP_SLOW_CALLBACK_DEBUG = os.getenv("LOOP_SLOW_CALLBACK_DEBUG", "false").lower() == "true"
+
+# Бюджеты одного API-ключа (лимиты бесплатного уровня Gemini можно переопределить в secrets.env)
+GEMINI_KEY_RPM = int(os.getenv("GEMINI_KEY_RPM", "10")) # Запросов в минуту на ключ
+GEMINI_KEY_TPM = int(os.getenv("GEMINI_KEY_TPM", "250000")) # Входных токенов в минуту на ключ
+GEMINI_KEY_COOLDOWN = float(os.getenv("GEMINI_KEY_COOLDOWN", "60")) # Пауза после 429, если Retry-After не указан
+GEMINI_KEY_WAIT_TIMEOUT = float(os.getenv("GEMINI_KEY_WAIT_TIMEOUT", "60")) # Сколько ждать свободный ключ
+
+# Модель и адрес Gemini API
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash-preview-05-20")
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+
+# Настройки общего пула HTTP-соединений к Gemini API.
+# Соединения держатся открытыми (keep-alive) и переиспользуются всеми пользователями,
+# поэтому TCP/TLS-рукопожатие и DNS-запрос выполняются только при открытии нового соединения.
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "20")) # Лимит соединений к хосту Gemini
+GEMINI_MAX_KEEPALIVE = int(os.getenv("GEMINI_MAX_KEEPALIVE", "10")) # Сколько простаивающих соединений держать
+GEMINI_KEEPALIVE_EXPIRY = float(os.getenv("GEMINI_KEEPALIVE_EXPIRY", "120")) # Секунды простоя до закрытия
+GEMINI_HTTP2 = os.getenv("GEMINI_HTTP2", "true").lower() == "true" # HTTP/2, если установлен пакет h2
+GEMINI_CONNECT_TIMEOUT = 10.0
+
+# Кэширование системных промптов на стороне Gemini (cachedContents API)
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() == "true"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600")) # Время жизни кэша, сек.
+GEMINI_CONTEXT_CACHE_REFRESH = 300 # За сколько секунд до истечения продлевать кэш
+GEMINI_CONTEXT_CACHE_RETRY = 600 # Пауза после неудачной попытки создать кэш
+GEMINI_REQUEST_TIMEOUT = 300.0
 
 # Максимальное количество попыток для запроса к API
 MAX_RETRIES = 5
@@ -61,16 +246,104 @@ RETRY_DELAY = 1
 
 # Максимальное количество сообщений в истории диалога для каждого пользователя
 MAX_HISTORY_MESSAGES = 10
+# Бюджет истории в токенах: старые сообщения отбрасываются, пока история в него не уложится
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "8000"))
+# Сколько пользователей держать в кэше истории и через сколько секунд простоя выгружать их
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "5000"))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "3600"))
+# Сжимать ответы в истории (убирать CSS и лишние пробелы)
+HISTORY_COMPACT = os.getenv("HISTORY_COMPACT", "true").lower() == "true"
+
+# Предобработка изображений выполняется в отдельных процессах, чтобы не блокировать цикл событий
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1)))) # Процессов в пуле
+IMAGE_QUEUE_LIMIT = int(os.getenv("IMAGE_QUEUE_LIMIT", "16")) # Сколько изображений может ждать обработки одновременно
+IMAGE_MAX_INPUT_BYTES = int(os.getenv("IMAGE_MAX_INPUT_BYTES", str(20 * 1024 * 1024))) # Максимальный размер исходного файла
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "50000000")) # Защита от «бомб» распаковки
+IMAGE_PROCESS_TIMEOUT = float(os.getenv("IMAGE_PROCESS_TIMEOUT", "20")) # Секунды на одно изображение
+
+# Параметры сжатия изображений перед отправкой в Gemini
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1536")) # Максимальная длинная сторона в пикселях
+IMAGE_TARGET_BYTES = int(os.getenv("IMAGE_TARGET_BYTES", str(400 * 1024))) # Желаемый размер после сжатия
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "auto").lower() # "jpeg", "webp" или "auto"
+IMAGE_MIN_QUALITY = 40
+IMAGE_MAX_QUALITY = 90
+
+# Сборка презентаций в отдельных процессах
+PPTX_WORKERS = int(os.getenv("PPTX_WORKERS", "2"))
+PPTX_BUILD_TIMEOUT = float(os.getenv("PPTX_BUILD_TIMEOUT", "60")) # Секунды на одну презентацию
+PPTX_THEMES_DIR = os.getenv("PPTX_THEMES_DIR", "themes") # Папка с дополнительными шаблонами *.pptx
+
+# Отрисовка HTML-ответов в картинку (формат «image»); нужен пакет playwright и Chromium:
+# pip install playwright && playwright install chromium
+HTML_RENDER_ENABLED = os.getenv("HTML_RENDER_ENABLED", "true").lower() == "true"
+HTML_RENDER_PAGES = int(os.getenv("HTML_RENDER_PAGES", "2")) # Сколько страниц браузера держать открытыми
+HTML_RENDER_TIMEOUT = float(os.getenv("HTML_RENDER_TIMEOUT", "15")) # Секунды на отрисовку одного ответа
+HTML_RENDER_QUEUE_TIMEOUT = float(os.getenv("HTML_RENDER_QUEUE_TIMEOUT", "20")) # Сколько ждать свободную страницу
+HTML_RENDER_WIDTH = int(os.getenv("HTML_RENDER_WIDTH", "800")) # Ширина страницы в CSS-пикселях
+HTML_RENDER_SCALE = float(os.getenv("HTML_RENDER_SCALE", "1.5")) # Масштаб (чёткость) картинки
+HTML_RENDER_QUALITY = int(os.getenv("HTML_RENDER_QUALITY", "85")) # Качество JPEG
+HTML_RENDER_CACHE_MAX_BYTES = int(os.getenv("HTML_RENDER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+HTML_FORMATS = ("html", "image") # Форматы ответа, для которых Gemini пишет HTML (списывается кредит)
 
-# Словари для хранения данных по пользователям
-user_history = {}
-# Единый словарь для всех настроек пользователя, включая кредиты.
-# Это гарантирует, что все функции будут обращаться к одному и тому же состоянию.
-user_settings = defaultdict(lambda: {"response_format": "html", "html_credits": 0})
-media_groups = {} # Словарь для временного хранения медиагрупп
+# Какой вариант фото (PhotoSize) скачивать из Telegram.
+# Берётся наименьший вариант, длинная сторона которого не меньше PHOTO_TARGET_EDGE.
+PHOTO_TARGET_EDGE = int(os.getenv("PHOTO_TARGET_EDGE", "1280"))
+# Разрешить самый большой вариант: если подходящего нет (даже больше IMAGE_MAX_INPUT_BYTES)
+# и если выбранный вариант не удалось скачать. Если выключено — берётся самый большой из укладывающихся в лимит.
+PHOTO_FALLBACK_TO_LARGEST = os.getenv("PHOTO_FALLBACK_TO_LARGEST", "true").lower() == "true"
+
+# Документы (текстовые файлы и PDF). Файл скачивается потоком во временный файл, который держится
+# в памяти до DOCUMENT_SPOOL_MEMORY байт, а дальше пишется на диск; текст извлекается по блокам и страницам.
+# Для PDF нужен пакет pypdf: pip install pypdf
+DOCUMENT_MAX_BYTES = int(os.getenv("DOCUMENT_MAX_BYTES", str(20 * 1024 * 1024))) # Больше облачный Bot API не отдаёт
+DOCUMENT_SPOOL_MEMORY = int(os.getenv("DOCUMENT_SPOOL_MEMORY", str(1024 * 1024)))
+DOCUMENT_DOWNLOAD_TIMEOUT = float(os.getenv("DOCUMENT_DOWNLOAD_TIMEOUT", "120")) # Секунды на скачивание файла
+DOCUMENT_READ_BLOCK = 64 * 1024
+DOCUMENT_TEXT_EXTENSIONS = ('.py', '.txt', '.html', '.md')
+# Документ до DOCUMENT_INLINE_TOKENS передаётся в Gemini целиком. Больший делится на части по DOCUMENT_CHUNK_TOKENS,
+# каждая часть конспектируется отдельным запросом (map), и ответ строится по склеенному конспекту (reduce).
+DOCUMENT_INLINE_TOKENS = int(os.getenv("DOCUMENT_INLINE_TOKENS", "30000"))
+DOCUMENT_CHUNK_TOKENS = int(os.getenv("DOCUMENT_CHUNK_TOKENS", "12000"))
+DOCUMENT_MAX_TOKENS = int(os.getenv("DOCUMENT_MAX_TOKENS", "400000")) # Текст дальше этого предела не читается
+DOCUMENT_MAP_CONCURRENCY = int(os.getenv("DOCUMENT_MAP_CONCURRENCY", "3")) # Одновременных map-запросов одного документа
+DOCUMENT_REDUCE_ROUNDS = 3 # Сколько раз можно сжимать конспект, пока он не уложится в DOCUMENT_INLINE_TOKENS
+
+# Кэш готовых ответов на одинаковые запросы (текст + изображения + формат + модель)
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(6 * 3600))) # Время жизни ответа в кэше, сек.
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))) # Объём кэша в памяти
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "") # Файл SQLite для дискового кэша; пусто — только память
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+# Сравнивать изображения по перцептивному хэшу (одно и то же фото, пересжатое заново),
+# а не только по точному содержимому файла
+RESPONSE_CACHE_PERCEPTUAL = os.getenv("RESPONSE_CACHE_PERCEPTUAL", "false").lower() == "true"
+
+# Настройки, кредиты и история пользователей хранятся в SQLite (см. класс Storage)
+STORAGE_PATH = os.getenv("STORAGE_PATH", "bot_data.sqlite3")
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "2")) # Как часто записывать историю на диск, сек.
+media_groups = {} # Собираемые альбомы: media_group_id -> MediaGroup
+processed_media_groups = {} # Обработанные альбомы: media_group_id -> время окончания обработки (см. MEDIA_GROUP_RETAIN)
+# Сбор альбома: после очередного фото ждём MEDIA_GROUP_GAP_FACTOR × наибольший интервал между фото
+# (но не меньше MEDIA_GROUP_MIN_WAIT), а всего — не дольше MEDIA_GROUP_MAX_WAIT с первого фото
+MEDIA_GROUP_FIRST_WAIT = float(os.getenv("MEDIA_GROUP_FIRST_WAIT", "0.8")) # Ожидание после первого фото
+MEDIA_GROUP_MIN_WAIT = float(os.getenv("MEDIA_GROUP_MIN_WAIT", "0.3"))
+MEDIA_GROUP_GAP_FACTOR = float(os.getenv("MEDIA_GROUP_GAP_FACTOR", "3"))
+MEDIA_GROUP_MAX_WAIT = float(os.getenv("MEDIA_GROUP_MAX_WAIT", "3"))
+MEDIA_GROUP_MAX_ITEMS = 10 # Больше фото в одном альбоме Telegram не отправляет
+MEDIA_GROUP_RETAIN = 60 # Сколько секунд помнить обработанный альбом, чтобы не принять его опоздавшие фото за новый
+ALBUM_DOWNLOAD_CONCURRENCY = int(os.getenv("ALBUM_DOWNLOAD_CONCURRENCY", "4")) # Одновременных скачиваний фото одного альбома
 # ВАЖНО: Переключатель для тестового режима. Установи в False для реальных платежей.
 IS_TEST_MODE = True
 
+# Очередь запросов к Gemini: общий лимит одновременных запросов зависит от числа рабочих ключей
+ADMISSION_PER_KEY = int(os.getenv("ADMISSION_PER_KEY", "2")) # Одновременных запросов на один ключ
+ADMISSION_PER_USER = int(os.getenv("ADMISSION_PER_USER", "1")) # Одновременных запросов одного пользователя
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "180")) # Сколько запрос может ждать в очереди, сек.
+ADMISSION_PRIORITY_PAID = os.getenv("ADMISSION_PRIORITY_PAID", "true").lower() == "true" # Отдельная очередь для платящих
+
+# Потоковая выдача ответов в текстовом режиме
+TELEGRAM_MESSAGE_LIMIT = 4096 # Максимальная длина сообщения Telegram
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5")) # Не чаще одного редактирования за столько секунд
+
 # CSS-стили для тетрадей
 NOTEBOOK_STYLES = """
 <style>
@@ -173,214 +446,2653 @@ DEVELOPER_PROMPT = f"""
 </html>
 """
 
-# Промпт для режима презентации
-PRESENTATION_PROMPT = """
-You are an advanced AI designed to create structured JSON output for generating PowerPoint presentations.
-Your task is to analyze the user's request and generate a JSON object that will be used to create the slides.
+# Промпт для режима презентации
+PRESENTATION_PROMPT = """
+You are an advanced AI designed to create structured JSON output for generating PowerPoint presentations.
+Your task is to analyze the user's request and generate a JSON object that will be used to create the slides.
+
+**IMPORTANT:** You must generate **ONLY** JSON. No other characters or text.
+
+**Instructions:**
+- The JSON should be an array of objects.
+- Each object in the array represents a single slide.
+- Each object must have two keys:
+    - `"title"`: A string for the slide's title.
+    - `"points"`: An array of strings with the main points or bullet points for that slide.
+
+**Example of the expected JSON structure:**
+[
+  {
+    "title": "Slide 1 Title",
+    "points": [
+      "Point 1",
+      "Point 2",
+      "Point 3"
+    ]
+  },
+  {
+    "title": "Slide 2 Title",
+    "points": [
+      "Another point",
+      "Yet another point"
+    ]
+  }
+]
+"""
+# --- Метрики ---
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Счётчик, который только растёт (например, число повторов запросов)."""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name + _format_labels(self.labels, key), value
+
+
+class Gauge(Counter):
+    """Текущее значение (например, число запросов в работе). callback вычисляет значение при выдаче метрик."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), callback=None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    @contextlib.asynccontextmanager
+    async def track(self, **labels):
+        """Увеличивает значение на время блока; можно использовать и как декоратор корутины."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        if self.callback is not None:
+            yield self.name, self.callback()
+        else:
+            yield from super().samples()
+
+
+class Histogram:
+    """Распределение длительностей по корзинам (в секундах)."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (),
+                 buckets: tuple = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # метки -> [счётчики по корзинам, сумма, количество]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Измеряет длительность блока with (в том числе с await внутри)."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield self.name + "_bucket" + _format_labels(self.labels, key, f'le="{bound}"'), bucket_count
+            yield self.name + "_bucket" + _format_labels(self.labels, key, 'le="+Inf"'), count
+            yield self.name + "_sum" + _format_labels(self.labels, key), total
+            yield self.name + "_count" + _format_labels(self.labels, key), count
+
+
+class MetricsRegistry:
+    """Набор метрик процесса и их выдача в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name} {value}" for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+STAGE_SECONDS = METRICS.register(Histogram(
+    "bot_stage_seconds", "Длительность этапов обработки запроса.", ("stage",)))
+GEMINI_SECONDS = METRICS.register(Histogram(
+    "bot_gemini_request_seconds", "Длительность одной попытки запроса к Gemini.", ("key", "status")))
+GEMINI_RETRIES = METRICS.register(Counter("bot_gemini_retries_total", "Повторные попытки запросов к Gemini."))
+GEMINI_RATE_LIMITED = METRICS.register(Counter(
+    "bot_gemini_rate_limited_total", "Ответы HTTP 429 от Gemini.", ("key",)))
+GEMINI_IN_FLIGHT = METRICS.register(Gauge("bot_gemini_in_flight", "Запросы к Gemini в работе."))
+REQUESTS_IN_FLIGHT = METRICS.register(Gauge("bot_requests_in_flight", "Сообщения и альбомы в обработке."))
+REQUESTS_TOTAL = METRICS.register(Counter("bot_requests_total", "Обработанные запросы по формату ответа.", ("format",)))
+CREDITS_SPENT = METRICS.register(Counter("bot_credits_spent_total", "Списанные кредиты."))
+CREDITS_REFUNDED = METRICS.register(Counter("bot_credits_refunded_total", "Возвращённые кредиты."))
+CACHE_LOOKUPS = METRICS.register(Counter(
+    "bot_response_cache_lookups_total", "Обращения к кэшу ответов: memory_hit, disk_hit или miss.", ("result",)))
+MEDIA_GROUPS = METRICS.register(Gauge(
+    "bot_media_groups", "Альбомы в media_groups.", callback=lambda: len(media_groups)))
+LOOP_LAG_SECONDS = METRICS.register(Histogram(
+    "bot_event_loop_lag_seconds", "Задержка цикла событий.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)))
+LOOP_STALLS = METRICS.register(Counter(
+    "bot_event_loop_stalls_total", "Блокировки цикла событий дольше LOOP_LAG_THRESHOLD по обработчику.", ("handler",)))
+LOOP_SLOW_CALLBACKS = METRICS.register(Counter(
+    "bot_event_loop_slow_callbacks_total", "Медленные шаги задач по сообщениям asyncio (LOOP_SLOW_CALLBACK_DEBUG).",
+    ("handler",)))
+
+async def _handle_metrics_request(reader, writer) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1] == b"/metrics":
+            status, body = "200 OK", METRICS.render().encode()
+        else:
+            status, body = "404 Not Found", b""
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+# Обработчики, которые указываются в отчётах о блокировке цикла событий
+WATCHED_HANDLERS = ("handle_message", "process_media_group", "create_and_send_pptx_file", "collect_media_group",
+                    "button_handler", "send_streamed_text", "generate_cached")
+
+def _watched_handler(names) -> str:
+    """Ближайший к месту блокировки обработчик из WATCHED_HANDLERS среди имён функций стека."""
+    for name in reversed(list(names)):
+        if name in WATCHED_HANDLERS:
+            return name
+    return "other"
+
+
+class SlowCallbackFilter(logging.Filter):
+    """Считает сообщения asyncio о медленных шагах задач (режим LOOP_SLOW_CALLBACK_DEBUG) по обработчикам."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        if " took " in message and message.startswith("Executing"):
+            LOOP_SLOW_CALLBACKS.inc(handler=_watched_handler(re.findall(r"\w+", message)))
+        return True
+
+
+class LoopWatchdog:
+    """
+    Сторож цикла событий. Задача-«пульс» просыпается каждые LOOP_LAG_INTERVAL секунд и записывает,
+    на сколько она опоздала (это и есть задержка цикла). Отдельный поток следит за пульсом:
+    если цикл не отвечает дольше LOOP_LAG_THRESHOLD, поток снимает стек потока цикла — то есть
+    того кода, который его блокирует, — и пишет его в лог вместе с обработчиком из WATCHED_HANDLERS.
+    """
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self._beat = time.monotonic()
+        self._reported = None # Пульс, блокировку после которого поток уже записал
+        self._loop = None
+        self._thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        loop = self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._pulse())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        if LOOP_SLOW_CALLBACK_DEBUG:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold
+            logging.getLogger("asyncio").addFilter(SlowCallbackFilter())
+        LOGGER.info("Сторож цикла событий запущен (порог %s с).", self.threshold)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _pulse(self) -> None:
+        while True:
+            started = time.monotonic()
+            previous = self._beat
+            await asyncio.sleep(self.interval)
+            self._beat = time.monotonic()
+            lag = max(0.0, self._beat - started - self.interval)
+            LOOP_LAG_SECONDS.observe(lag)
+            # Блокировку, замеченную потоком сторожа, он уже записал вместе со стеком
+            if lag > self.threshold and self._reported != previous:
+                LOGGER.warning("Цикл событий был заблокирован %.3f с.", lag)
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            if time.monotonic() - beat <= self.threshold or beat == self._reported:
+                continue
+            # Цикл не отвечает: снимаем стек его потока прямо во время блокировки
+            self._reported = beat
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            handler = _watched_handler(summary.name for summary in stack)
+            # Метрики не потокобезопасны: счётчик увеличивается в потоке цикла, когда тот освободится
+            try:
+                self._loop.call_soon_threadsafe(functools.partial(LOOP_STALLS.inc, handler=handler))
+            except RuntimeError:
+                return # Цикл уже закрыт
+            LOGGER.warning("Цикл событий заблокирован дольше %s с (обработчик: %s). Стек:\n%s",
+                           self.threshold, handler, "".join(traceback.format_list(stack[-12:])))
+
+
+LOOP_WATCHDOG = LoopWatchdog(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD)
+
+# Локальный HTTP-сервер метрик
+metrics_server = None
+
+async def open_metrics_server() -> None:
+    """Запускает выдачу метрик на /metrics, если задан METRICS_PORT."""
+    global metrics_server
+    if not METRICS_PORT or metrics_server is not None:
+        return
+    port = METRICS_PORT + WORKER_INDEX
+    try:
+        metrics_server = await asyncio.start_server(_handle_metrics_request, METRICS_HOST, port)
+    except OSError as e:
+        LOGGER.error("Не удалось запустить сервер метрик на порту %s: %s", port, e)
+        return
+    LOGGER.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, port)
+
+async def close_metrics_server() -> None:
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+
+# --- Функции API и вспомогательные функции ---
+
+class TokenBucket:
+    """«Ведро токенов»: ёмкость capacity, полностью пополняется за period секунд."""
+
+    def __init__(self, capacity: float, period: float = 60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Через сколько секунд в ведре будет amount токенов (0 — уже есть)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float, now: float) -> None:
+        """Списывает токены. Баланс может уйти в минус при уточнении фактического расхода."""
+        self._refill(now)
+        self.tokens -= amount
+
+
+@dataclass
+class ApiKeyState:
+    """Состояние одного API-ключа в пуле."""
+    key: str
+    index: int
+    rpm: TokenBucket
+    tpm: TokenBucket
+    in_flight: int = 0
+    cooldown_until: float = 0.0
+    invalid: bool = False
+    consecutive_errors: int = 0
+
+    @property
+    def key_id(self) -> str:
+        """Идентификатор ключа для общего хранилища (сам ключ туда не записывается)."""
+        return hashlib.sha256(self.key.encode()).hexdigest()[:16]
+
+
+class NoHealthyKeysError(Exception):
+    """Нет ни одного ключа, которым можно воспользоваться."""
+
+
+class ApiKeyPool:
+    """
+    Планировщик API-ключей Gemini с учётом их состояния.
+    Ключ после 429 уходит на паузу (с учётом Retry-After), неверный ключ исключается навсегда,
+    а для каждого ключа ведутся бюджеты запросов и токенов в минуту.
+    Из доступных ключей всегда выбирается наименее загруженный.
+    """
+
+    def __init__(self, keys: list, rpm: int, tpm: int):
+        self._states = [
+            ApiKeyState(key=key, index=i, rpm=TokenBucket(rpm), tpm=TokenBucket(tpm))
+            for i, key in enumerate(keys)
+        ]
+        self._condition = asyncio.Condition()
+        self._changed = set()  # ключи, чьё состояние ещё не передано другим процессам
+
+    @property
+    def healthy_count(self) -> int:
+        return sum(1 for state in self._states if not state.invalid)
+
+    def _delay_for(self, state: ApiKeyState, tokens: int, now: float) -> float:
+        return max(
+            state.cooldown_until - now,
+            state.rpm.wait_time(1, now),
+            state.tpm.wait_time(tokens, now),
+            0.0,
+        )
+
+    async def acquire(self, tokens: int, timeout: float = GEMINI_KEY_WAIT_TIMEOUT) -> ApiKeyState:
+        """Выбирает ключ для запроса примерно на tokens входных токенов, при необходимости ждёт."""
+        deadline = time.monotonic() + timeout
+        async with self._condition:
+            while True:
+                now = time.monotonic()
+                healthy = [state for state in self._states if not state.invalid]
+                if not healthy:
+                    raise NoHealthyKeysError("Все API-ключи помечены как недействительные.")
+
+                delays = {state.index: self._delay_for(state, tokens, now) for state in healthy}
+                ready = [state for state in healthy if delays[state.index] == 0.0]
+                if ready:
+                    state = min(ready, key=lambda s: (s.in_flight, -s.rpm.tokens, s.index))
+                    state.rpm.consume(1, now)
+                    state.tpm.consume(tokens, now)
+                    state.in_flight += 1
+                    return state
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise NoHealthyKeysError("Все API-ключи на паузе или исчерпали лимиты.")
+                wait = min(min(delays.values()), remaining)
+                LOGGER.info("Нет свободных API-ключей, ожидание %.1f с.", wait)
+                try:
+                    await asyncio.wait_for(self._condition.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, state: ApiKeyState, outcome: str = "ok", retry_after: float = None,
+                      actual_tokens: int = None, estimated_tokens: int = 0) -> None:
+        """
+        Возвращает ключ в пул и обновляет его состояние.
+        outcome: "ok", "rate_limited" (HTTP 429), "invalid" (неверный ключ) или "error".
+        """
+        async with self._condition:
+            now = time.monotonic()
+            state.in_flight -= 1
+            if outcome == "ok":
+                state.consecutive_errors = 0
+                if actual_tokens is not None:
+                    state.tpm.consume(actual_tokens - estimated_tokens, now)
+            elif outcome == "rate_limited":
+                state.cooldown_until = now + (retry_after if retry_after is not None else GEMINI_KEY_COOLDOWN)
+                self._changed.add(state.index)
+                LOGGER.warning("API ключ %s на паузе %.0f с после HTTP 429.", state.index, state.cooldown_until - now)
+            elif outcome == "invalid":
+                state.invalid = True
+                self._changed.add(state.index)
+                LOGGER.error("API ключ %s недействителен и исключён из пула.", state.index)
+            else:
+                state.consecutive_errors += 1
+            self._condition.notify_all()
+
+    async def sync_health(self, storage) -> None:
+        """
+        Обменивается с другими процессами паузами после 429 и недействительными ключами через storage.
+        Время паузы хранится в «настенных» часах, так как у процессов разные monotonic().
+        """
+        offset = time.time() - time.monotonic()
+        changed, self._changed = self._changed, set()
+        for index in changed:
+            state = self._states[index]
+            await storage.save_key_health(state.key_id, state.cooldown_until + offset, state.invalid)
+
+        shared = await storage.load_key_health()
+        async with self._condition:
+            for state in self._states:
+                if state.key_id not in shared:
+                    continue
+                cooldown_until, invalid = shared[state.key_id]
+                state.cooldown_until = max(state.cooldown_until, cooldown_until - offset)
+                if invalid and not state.invalid:
+                    state.invalid = True
+                    LOGGER.error("API ключ %s признан недействительным другим процессом.", state.index)
+            self._condition.notify_all()
+
+
+# Лимиты ключей делятся между рабочими процессами поровну
+GEMINI_KEY_POOL = ApiKeyPool(GEMINI_API_KEYS, GEMINI_KEY_RPM / BOT_WORKERS, GEMINI_KEY_TPM / BOT_WORKERS)
+
+# Приблизительная стоимость одного изображения во входных токенах Gemini
+IMAGE_TOKEN_ESTIMATE = 258
+
+def estimate_parts_tokens(parts: list) -> int:
+    """Грубая оценка числа токенов в частях сообщения (около 4 символов на токен)."""
+    tokens = 0
+    for part in parts:
+        if "text" in part:
+            tokens += len(part["text"]) // 4 + 1
+        elif "inlineData" in part:
+            tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+def estimate_payload_tokens(payload: dict) -> int:
+    """Грубая оценка числа входных токенов запроса."""
+    parts = [part for content in payload.get("contents", []) for part in content.get("parts", [])]
+    parts += payload.get("systemInstruction", {}).get("parts", [])
+    return estimate_parts_tokens(parts)
+
+def parse_retry_after(response: httpx.Response):
+    """Достаёт задержку из заголовка Retry-After или из RetryInfo в теле ответа 429."""
+    header = response.headers.get("Retry-After")
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            pass
+    match = re.search(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"', response.text)
+    if match:
+        return float(match.group(1))
+    return None
+
+# Общий HTTP-клиент для Gemini API. Открывается в post_init и закрывается при остановке бота.
+gemini_http_client = None
+
+def _http2_available() -> bool:
+    """Проверяет, установлен ли пакет h2, необходимый httpx для HTTP/2."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+async def open_gemini_client() -> httpx.AsyncClient:
+    """Создаёт (один раз) долгоживущий HTTP-клиент с пулом соединений к Gemini API."""
+    global gemini_http_client
+    if gemini_http_client is None or gemini_http_client.is_closed:
+        use_http2 = GEMINI_HTTP2 and _http2_available()
+        gemini_http_client = httpx.AsyncClient(
+            base_url=GEMINI_API_BASE,
+            http2=use_http2,
+            limits=httpx.Limits(
+                max_connections=GEMINI_MAX_CONNECTIONS,
+                max_keepalive_connections=GEMINI_MAX_KEEPALIVE,
+                keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(GEMINI_REQUEST_TIMEOUT, connect=GEMINI_CONNECT_TIMEOUT),
+        )
+        LOGGER.info("HTTP-клиент Gemini API открыт (HTTP/2: %s, лимит соединений: %s).", use_http2, GEMINI_MAX_CONNECTIONS)
+    return gemini_http_client
+
+async def close_gemini_client() -> None:
+    """Закрывает общий HTTP-клиент и все соединения пула."""
+    global gemini_http_client
+    if gemini_http_client is not None:
+        await gemini_http_client.aclose()
+        gemini_http_client = None
+        LOGGER.info("HTTP-клиент Gemini API закрыт.")
+
+def system_instruction(prompt: str) -> dict:
+    """Оборачивает промпт в формат поля systemInstruction Gemini API."""
+    return {"parts": [{"text": prompt}]}
+
+
+@dataclass
+class CachedPrompt:
+    """Системный промпт, сохранённый в Gemini через cachedContents."""
+    name: str
+    expires_at: float
+
+
+class PromptCache:
+    """
+    Кэш системных промптов в Gemini (cachedContents API).
+    Кэш принадлежит проекту API-ключа, поэтому для каждого ключа создаётся свой.
+    Кэш продлевается незадолго до истечения; если Gemini сообщает, что кэш пропал,
+    запрос повторяется с обычным systemInstruction.
+    """
+
+    def __init__(self, enabled: bool, ttl: int):
+        self.enabled = enabled
+        self.ttl = ttl
+        self._entries = {}  # (индекс ключа, хэш промпта) -> CachedPrompt
+        self._failed_until = {}  # (индекс ключа, хэш промпта) -> время, до которого кэш не создаём
+        self._locks = {}
+
+    @staticmethod
+    def _digest(system: dict) -> str:
+        text = "".join(part.get("text", "") for part in system.get("parts", []))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    async def _create(self, client: httpx.AsyncClient, api_key: str, system: dict) -> CachedPrompt:
+        response = await client.post(
+            "cachedContents",
+            params={"key": api_key},
+            json={"model": f"models/{GEMINI_MODEL}", "systemInstruction": system, "ttl": f"{self.ttl}s"},
+        )
+        response.raise_for_status()
+        return CachedPrompt(response.json()["name"], time.time() + self.ttl)
+
+    async def _refresh(self, client: httpx.AsyncClient, api_key: str, entry: CachedPrompt) -> CachedPrompt:
+        response = await client.patch(
+            entry.name,
+            params={"key": api_key, "updateMask": "ttl"},
+            json={"ttl": f"{self.ttl}s"},
+        )
+        response.raise_for_status()
+        return CachedPrompt(entry.name, time.time() + self.ttl)
+
+    async def apply(self, client: httpx.AsyncClient, payload: dict, key_state: ApiKeyState) -> dict:
+        """Возвращает payload, в котором systemInstruction заменён ссылкой на кэш (если это возможно)."""
+        system = payload.get("systemInstruction")
+        if not self.enabled or not system:
+            return payload
+        cache_key = (key_state.index, self._digest(system))
+        if self._failed_until.get(cache_key, 0) > time.time():
+            return payload
+
+        lock = self._locks.setdefault(cache_key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(cache_key)
+            now = time.time()
+            try:
+                if entry is None or entry.expires_at <= now:
+                    entry = await self._create(client, key_state.key, system)
+                    LOGGER.info("Создан кэш промпта %s для API ключа %s.", entry.name, key_state.index)
+                elif entry.expires_at - now < GEMINI_CONTEXT_CACHE_REFRESH:
+                    entry = await self._refresh(client, key_state.key, entry)
+                self._entries[cache_key] = entry
+            except (httpx.HTTPError, KeyError, ValueError) as e:
+                LOGGER.warning("Не удалось создать или продлить кэш промпта для API ключа %s: %r", key_state.index, e)
+                self._entries.pop(cache_key, None)
+                self._failed_until[cache_key] = now + GEMINI_CONTEXT_CACHE_RETRY
+                return payload
+
+        cached_payload = {key: value for key, value in payload.items() if key != "systemInstruction"}
+        cached_payload["cachedContent"] = entry.name
+        return cached_payload
+
+    def invalidate(self, payload: dict, key_state: ApiKeyState) -> None:
+        """Забывает кэш промпта, который Gemini больше не находит."""
+        system = payload.get("systemInstruction")
+        if system:
+            cache_key = (key_state.index, self._digest(system))
+            self._entries.pop(cache_key, None)
+            self._failed_until[cache_key] = time.time() + GEMINI_CONTEXT_CACHE_RETRY
+
+
+PROMPT_CACHE = PromptCache(GEMINI_CONTEXT_CACHE, GEMINI_CONTEXT_CACHE_TTL)
+
+# Сообщения пользователю при ошибках Gemini API
+GEMINI_BAD_REQUEST_MESSAGE = "Извините, этот тип файла не поддерживается или запрос неверно сформирован."
+GEMINI_UNKNOWN_ERROR_MESSAGE = "Извините, произошла ошибка."
+GEMINI_FAILED_MESSAGE = "Извините, не удалось получить ответ от нейросети после нескольких попыток."
+
+
+class GeminiStreamError(Exception):
+    """Потоковый ответ Gemini оборвался после того, как часть текста уже была получена."""
+
+
+def classify_gemini_error(response: httpx.Response, payload: dict, request_payload: dict, key_state: ApiKeyState) -> tuple:
+    """
+    Разбирает неуспешный ответ Gemini API (тело ответа уже должно быть прочитано).
+    Возвращает (действие, состояние ключа для пула, Retry-After), где действие:
+    "retry" — сразу повторить с другим ключом, "backoff" — повторить после паузы, "fail" — не повторять.
+    """
+    status = response.status_code
+    error_text = response.text
+    if "cachedContent" in request_payload and status in (400, 403, 404) and "cachedcontent" in error_text.lower():
+        # Кэш промпта истёк или удалён — повторяем запрос с полным systemInstruction
+        LOGGER.warning("Кэш промпта недоступен (HTTP %s), повтор без кэша.", status)
+        PROMPT_CACHE.invalidate(payload, key_state)
+        return "retry", "ok", None
+    if status == 400:
+        if "API key not valid" in error_text:
+            return "retry", "invalid", None
+        LOGGER.error("HTTP 400 Bad Request. Details: %s", error_text)
+        return "fail", "ok", None
+    if status == 429:
+        GEMINI_RATE_LIMITED.inc(key=key_state.index)
+        LOGGER.warning("Rate limit exceeded for Gemini API. Switching to next key...")
+        return "retry", "rate_limited", parse_retry_after(response)
+    LOGGER.error("HTTP error during Gemini API request: %s - %s", status, response.reason_phrase)
+    return "backoff", "error", None
+
+async def call_gemini_api(payload: dict) -> str:
+    """Отправляет запрос к Gemini API и возвращает ответ."""
+    client = await open_gemini_client()
+    estimated_tokens = estimate_payload_tokens(payload)
+    retries = 0
+    while retries < MAX_RETRIES:
+        try:
+            key_state = await GEMINI_KEY_POOL.acquire(estimated_tokens)
+        except NoHealthyKeysError as e:
+            LOGGER.error("Не удалось получить API ключ: %s", e)
+            break
+
+        api_url = f"models/{GEMINI_MODEL}:generateContent"
+        LOGGER.info("Попытка %s/%s с API ключом %s.", retries + 1, MAX_RETRIES, key_state.index)
+        LOGGER.debug("Payload для Gemini API: %s", LazyJSON(payload))
+        outcome, retry_after, actual_tokens, backoff = "error", None, None, False
+        GEMINI_IN_FLIGHT.inc()
+        attempt_started = time.monotonic()
+        try:
+            request_payload = await PROMPT_CACHE.apply(client, payload, key_state)
+            response = await client.post(api_url, params={"key": key_state.key}, json=request_payload)
+            GEMINI_SECONDS.observe(time.monotonic() - attempt_started, key=key_state.index, status=response.status_code)
+            LOGGER.info("Ответ от Gemini API: HTTP %s", response.status_code, extra=SAMPLED if response.status_code == 200 else None)
+            if response.status_code == 200:
+                result = response.json()
+                outcome = "ok"
+                actual_tokens = result.get('usageMetadata', {}).get('promptTokenCount')
+                text_content = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', 'Не удалось получить ответ.')
+                LOGGER.info("Успешный ответ от Gemini API.", extra=SAMPLED)
+                return text_content
+
+            action, outcome, retry_after = classify_gemini_error(response, payload, request_payload, key_state)
+            if action == "fail":
+                return GEMINI_BAD_REQUEST_MESSAGE
+            retries += 1
+            GEMINI_RETRIES.inc()
+            backoff = action == "backoff"
+        except httpx.RequestError as e:
+            GEMINI_SECONDS.observe(time.monotonic() - attempt_started, key=key_state.index, status="network_error")
+            LOGGER.error("Network error during Gemini API request: %r", e)
+            retries += 1
+            GEMINI_RETRIES.inc()
+            backoff = True
+        except Exception as e:
+            LOGGER.error("Unknown error: %s", e)
+            return GEMINI_UNKNOWN_ERROR_MESSAGE
+        finally:
+            GEMINI_IN_FLIGHT.dec()
+            await GEMINI_KEY_POOL.release(key_state, outcome, retry_after, actual_tokens, estimated_tokens)
+        if backoff:
+            await asyncio.sleep(RETRY_DELAY * (2 ** retries))
+    LOGGER.error("Не удалось получить ответ от нейросети после нескольких попыток.")
+    return GEMINI_FAILED_MESSAGE
+
+async def stream_gemini_api(payload: dict):
+    """
+    Асинхронный генератор: отправляет запрос в streamGenerateContent и отдаёт текст ответа по частям.
+    Повторные попытки (с другим ключом) возможны только до получения первой части.
+    При неустранимой ошибке отдаёт текст сообщения об ошибке, как и call_gemini_api.
+    """
+    client = await open_gemini_client()
+    estimated_tokens = estimate_payload_tokens(payload)
+    retries = 0
+    while retries < MAX_RETRIES:
+        try:
+            key_state = await GEMINI_KEY_POOL.acquire(estimated_tokens)
+        except NoHealthyKeysError as e:
+            LOGGER.error("Не удалось получить API ключ: %s", e)
+            break
+
+        api_url = f"models/{GEMINI_MODEL}:streamGenerateContent"
+        LOGGER.info("Потоковый запрос, попытка %s/%s с API ключом %s.", retries + 1, MAX_RETRIES, key_state.index)
+        outcome, retry_after, actual_tokens, backoff, started = "error", None, None, False, False
+        GEMINI_IN_FLIGHT.inc()
+        attempt_started = time.monotonic()
+        try:
+            request_payload = await PROMPT_CACHE.apply(client, payload, key_state)
+            async with client.stream(
+                "POST", api_url, params={"key": key_state.key, "alt": "sse"}, json=request_payload
+            ) as response:
+                LOGGER.info("Ответ от Gemini API: HTTP %s", response.status_code, extra=SAMPLED if response.status_code == 200 else None)
+                if response.status_code == 200:
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        chunk = json.loads(line[5:])
+                        actual_tokens = chunk.get('usageMetadata', {}).get('promptTokenCount', actual_tokens)
+                        parts = chunk.get('candidates', [{}])[0].get('content', {}).get('parts', [])
+                        text = "".join(part.get('text', '') for part in parts)
+                        if text:
+                            started = True
+                            yield text
+                    outcome = "ok"
+                    GEMINI_SECONDS.observe(time.monotonic() - attempt_started, key=key_state.index, status=200)
+                    LOGGER.info("Потоковый ответ от Gemini API получен полностью.")
+                    return
+
+                await response.aread()
+                GEMINI_SECONDS.observe(time.monotonic() - attempt_started, key=key_state.index, status=response.status_code)
+                action, outcome, retry_after = classify_gemini_error(response, payload, request_payload, key_state)
+                if action == "fail":
+                    yield GEMINI_BAD_REQUEST_MESSAGE
+                    return
+                retries += 1
+                GEMINI_RETRIES.inc()
+                backoff = action == "backoff"
+        except httpx.RequestError as e:
+            GEMINI_SECONDS.observe(time.monotonic() - attempt_started, key=key_state.index, status="network_error")
+            if started:
+                raise GeminiStreamError(f"поток прерван: {e!r}") from e
+            LOGGER.error("Network error during Gemini API request: %r", e)
+            retries += 1
+            GEMINI_RETRIES.inc()
+            backoff = True
+        finally:
+            GEMINI_IN_FLIGHT.dec()
+            await GEMINI_KEY_POOL.release(key_state, outcome, retry_after, actual_tokens, estimated_tokens)
+        if backoff:
+            await asyncio.sleep(RETRY_DELAY * (2 ** retries))
+    LOGGER.error("Не удалось получить ответ от нейросети после нескольких попыток.")
+    yield GEMINI_FAILED_MESSAGE
+
+# --- Предобработка изображений ---
+
+class ImageProcessingError(Exception):
+    """Изображение не удалось подготовить для отправки в Gemini."""
+
+
+@dataclass
+class PreparedImage:
+    """Изображение, готовое к отправке в Gemini (данные в base64) и его хэши для кэша ответов."""
+    mime_type: str
+    data: str
+    digest: str = ""
+    phash: str = ""
+
+    def as_part(self) -> dict:
+        return {"inlineData": {"mimeType": self.mime_type, "data": self.data}}
+
+
+# Тег EXIF с ориентацией снимка
+EXIF_ORIENTATION_TAG = 0x0112
+
+def _encode_with_budget(img, image_format: str, target_bytes: int) -> bytes:
+    """
+    Подбирает двоичным поиском максимальное качество, при котором файл укладывается в target_bytes.
+    Если не укладывается даже при минимальном качестве, возвращает вариант с минимальным качеством.
+    """
+    def encode(quality: int) -> bytes:
+        buffer = io.BytesIO()
+        if image_format == "WEBP":
+            img.save(buffer, format="WEBP", quality=quality, method=4)
+        else:
+            img.save(buffer, format="JPEG", quality=quality, optimize=True)
+        return buffer.getvalue()
+
+    best = encode(IMAGE_MIN_QUALITY)
+    if len(best) > target_bytes:
+        return best
+    low, high = IMAGE_MIN_QUALITY + 1, IMAGE_MAX_QUALITY
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode(quality)
+        if len(data) <= target_bytes:
+            best, low = data, quality + 1
+        else:
+            high = quality - 1
+    return best
+
+
+def _difference_hash(img, size: int = 16) -> str:
+    """Перцептивный dHash: сравнение яркости соседних пикселей уменьшенного изображения."""
+    small = img.convert("L").resize((size + 1, size), Image.BILINEAR)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:0{size * size // 4}x}"
+
+
+def _prepare_image_sync(raw: bytes, max_pixels: int, max_edge: int, target_bytes: int, output_format: str,
+                        perceptual_hash: bool = False) -> tuple:
+    """
+    Выполняется в процессе пула: уменьшает изображение до max_edge по длинной стороне,
+    учитывает ориентацию из EXIF и сжимает в JPEG или WebP под target_bytes.
+    Если присланный JPEG уже подходит, он отправляется без перекодирования.
+    Возвращает (mime_type, data в base64, sha256 исходного файла, перцептивный хэш или "").
+    """
+    digest = hashlib.sha256(raw).hexdigest()
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    img = Image.open(io.BytesIO(raw))
+    if img.width * img.height > max_pixels:
+        raise ValueError(f"слишком большое разрешение: {img.width}x{img.height}")
+
+    orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    if (img.format == "JPEG" and img.mode in ("RGB", "L") and orientation == 1
+            and max(img.size) <= max_edge and len(raw) <= target_bytes):
+        phash = _difference_hash(img) if perceptual_hash else ""
+        return "image/jpeg", base64.b64encode(raw).decode('ascii'), digest, phash
+
+    # Для JPEG декодер сразу уменьшает изображение в 2-8 раз, это намного быстрее полного декодирования
+    if img.format == "JPEG":
+        img.draft("RGB", (max_edge, max_edge))
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        # Прозрачные области заливаем белым, а не чёрным
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+    else:
+        img = img.convert("RGB")
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    phash = _difference_hash(img) if perceptual_hash else ""
+
+    if output_format == "webp":
+        data, mime_type = _encode_with_budget(img, "WEBP", target_bytes), "image/webp"
+    else:
+        data, mime_type = _encode_with_budget(img, "JPEG", target_bytes), "image/jpeg"
+        if output_format == "auto" and len(data) > target_bytes:
+            webp_data = _encode_with_budget(img, "WEBP", target_bytes)
+            if len(webp_data) < len(data):
+                data, mime_type = webp_data, "image/webp"
+    return mime_type, base64.b64encode(data).decode('ascii'), digest, phash
+
+
+# Пул процессов для изображений и ограничение очереди (обратное давление)
+image_executor = None
+image_slots = asyncio.Semaphore(IMAGE_QUEUE_LIMIT)
+
+def open_image_executor() -> ProcessPoolExecutor:
+    """Создаёт пул процессов для обработки изображений (если он ещё не создан)."""
+    global image_executor
+    if image_executor is None:
+        # spawn: дочерние процессы не наследуют потоки и состояние цикла событий родителя
+        image_executor = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        LOGGER.info("Пул обработки изображений запущен (%s процессов).", IMAGE_WORKERS)
+    return image_executor
+
+def close_image_executor() -> None:
+    """Останавливает пул процессов для изображений."""
+    global image_executor
+    if image_executor is not None:
+        image_executor.shutdown(wait=False, cancel_futures=True)
+        image_executor = None
+        LOGGER.info("Пул обработки изображений остановлен.")
+
+async def prepare_image(raw) -> PreparedImage:
+    """
+    Готовит изображение для Gemini в пуле процессов.
+    Одновременно обрабатывается не более IMAGE_QUEUE_LIMIT изображений, остальные ждут своей очереди.
+    Место в очереди освобождается, когда процесс пула действительно закончил работу: после таймаута
+    он ещё занят, и новые изображения не должны копиться за ним сверх IMAGE_QUEUE_LIMIT.
+    """
+    if len(raw) > IMAGE_MAX_INPUT_BYTES:
+        raise ImageProcessingError(f"файл слишком большой: {len(raw)} байт")
+
+    loop = asyncio.get_running_loop()
+
+    def release_slot(_job) -> None:
+        # Вызывается в потоке пула, когда задача завершилась, упала или была отменена до запуска
+        try:
+            loop.call_soon_threadsafe(image_slots.release)
+        except RuntimeError:
+            pass  # Цикл событий уже закрыт
+
+    await image_slots.acquire()
+    job = None
+    try:
+        job = open_image_executor().submit(
+            _prepare_image_sync, bytes(raw),
+            IMAGE_MAX_PIXELS, IMAGE_MAX_EDGE, IMAGE_TARGET_BYTES, IMAGE_OUTPUT_FORMAT, RESPONSE_CACHE_PERCEPTUAL,
+        )
+        job.add_done_callback(release_slot)
+        with STAGE_SECONDS.time(stage="preprocess"):
+            mime_type, data, digest, phash = await asyncio.wait_for(asyncio.wrap_future(job), timeout=IMAGE_PROCESS_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise ImageProcessingError(f"обработка заняла больше {IMAGE_PROCESS_TIMEOUT} с")
+    except BrokenProcessPool as e:
+        # Процесс пула упал (например, из-за нехватки памяти) — пересоздаём пул для следующих запросов
+        close_image_executor()
+        raise ImageProcessingError("пул обработки изображений аварийно завершился") from e
+    except Exception as e:
+        raise ImageProcessingError(str(e)) from e
+    finally:
+        if job is None:
+            image_slots.release()
+    return PreparedImage(mime_type, data, digest, phash)
+
+def select_photo_size(photo_sizes):
+    """
+    Выбирает вариант фото для скачивания по метаданным PhotoSize: наименьший из тех,
+    что не меньше PHOTO_TARGET_EDGE по длинной стороне и укладываются в IMAGE_MAX_INPUT_BYTES.
+    Если таких нет, возвращает самый большой вариант (при PHOTO_FALLBACK_TO_LARGEST) или самый большой
+    из укладывающихся в IMAGE_MAX_INPUT_BYTES; если в лимит не укладывается ни один — самый маленький.
+    """
+    def area(size):
+        return size.width * size.height
+
+    fits = [size for size in photo_sizes if not size.file_size or size.file_size <= IMAGE_MAX_INPUT_BYTES]
+    adequate = [size for size in fits if max(size.width, size.height) >= PHOTO_TARGET_EDGE]
+    if adequate:
+        return min(adequate, key=area)
+    if PHOTO_FALLBACK_TO_LARGEST:
+        return max(photo_sizes, key=area)
+    if fits:
+        return max(fits, key=area)
+    return min(photo_sizes, key=area)
+
+async def download_photo(photo_sizes) -> bytearray:
+    """Скачивает подходящий вариант фото из Telegram."""
+    photo = select_photo_size(photo_sizes)
+    largest = max(photo_sizes, key=lambda size: size.width * size.height)
+    LOGGER.info("Выбран вариант фото %sx%s (%s байт) из %s.", photo.width, photo.height, photo.file_size or '?', len(photo_sizes),
+                extra=SAMPLED)
+    with STAGE_SECONDS.time(stage="download"):
+        try:
+            photo_file = await photo.get_file()
+            return await photo_file.download_as_bytearray()
+        except TelegramError as e:
+            if not PHOTO_FALLBACK_TO_LARGEST or photo.file_unique_id == largest.file_unique_id:
+                raise
+            LOGGER.warning("Не удалось скачать вариант фото %sx%s: %s. Скачиваю самый большой.", photo.width, photo.height, e)
+            photo_file = await largest.get_file()
+            return await photo_file.download_as_bytearray()
+
+# --- Документы ---
+
+class DocumentError(Exception):
+    """Документ не удалось прочитать; текст исключения показывается пользователю."""
+
+
+@dataclass
+class DocumentText:
+    """Текст документа, разбитый на части не больше DOCUMENT_CHUNK_TOKENS."""
+    file_name: str
+    chunks: list
+    tokens: int
+    truncated: bool = False # Документ длиннее DOCUMENT_MAX_TOKENS и прочитан не до конца
+
+
+DOCUMENT_MAP_PROMPT = """
+Тебе передают одну часть большого документа, который целиком не помещается в один запрос.
+Составь подробный конспект этой части на русском языке: сохрани факты, определения, числа, формулы, фрагменты кода и названия разделов, которые понадобятся для выполнения задания пользователя.
+Не выполняй само задание и не добавляй ничего от себя. Если в этой части нет ничего полезного для задания, ответь одним символом «—».
+"""
+
+# Потоки для записи и чтения временных файлов и извлечения текста из PDF (цикл событий при этом не блокируется)
+document_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="document")
+
+# Общий HTTP-клиент для скачивания файлов из Telegram: соединения переиспользуются между документами
+document_http_client = None
+
+async def open_document_client() -> httpx.AsyncClient:
+    """Создаёт (один раз) долгоживущий HTTP-клиент для скачивания документов."""
+    global document_http_client
+    if document_http_client is None or document_http_client.is_closed:
+        document_http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(DOCUMENT_DOWNLOAD_TIMEOUT, connect=GEMINI_CONNECT_TIMEOUT),
+        )
+    return document_http_client
+
+async def close_document_client() -> None:
+    """Закрывает HTTP-клиент для скачивания документов."""
+    global document_http_client
+    if document_http_client is not None:
+        await document_http_client.aclose()
+        document_http_client = None
+
+async def download_document(document, spool) -> str:
+    """
+    Скачивает документ из Telegram потоком в spool, не собирая файл целиком в памяти.
+    Возвращает sha256 содержимого.
+    """
+    if document.file_size and document.file_size > DOCUMENT_MAX_BYTES:
+        raise DocumentError(f"Извините, файл слишком большой. Максимальный размер — {DOCUMENT_MAX_BYTES // (1024 * 1024)} МБ.")
+
+    loop = asyncio.get_running_loop()
+    digest = hashlib.sha256()
+    size = 0
+
+    async def write(block: bytes) -> None:
+        nonlocal size
+        size += len(block)
+        if size > DOCUMENT_MAX_BYTES:
+            raise DocumentError(f"Извините, файл слишком большой. Максимальный размер — {DOCUMENT_MAX_BYTES // (1024 * 1024)} МБ.")
+        digest.update(block)
+        await loop.run_in_executor(document_executor, spool.write, block)
+
+    try:
+        file = await document.get_file()
+        if urlsplit(file.file_path).scheme in ("http", "https"):
+            client = await open_document_client()
+            async with client.stream("GET", file.file_path) as response:
+                response.raise_for_status()
+                async for block in response.aiter_bytes(DOCUMENT_READ_BLOCK):
+                    await write(block)
+        else:
+            # Локальный сервер Bot API (--local) отдаёт путь к файлу на диске
+            with open(file.file_path, "rb") as source:
+                while True:
+                    block = await loop.run_in_executor(document_executor, source.read, DOCUMENT_READ_BLOCK)
+                    if not block:
+                        break
+                    await write(block)
+    except (httpx.HTTPError, TelegramError, OSError) as e:
+        # В адресе файла есть токен бота, поэтому в лог пишется только тип ошибки
+        LOGGER.error("Не удалось скачать документ %s: %s", document.file_name, type(e).__name__)
+        raise DocumentError("Извините, не удалось скачать файл. Пожалуйста, попробуйте снова.") from e
+
+    await loop.run_in_executor(document_executor, spool.seek, 0)
+    LOGGER.info("Документ %s скачан: %s байт.", document.file_name, size)
+    return digest.hexdigest()
+
+def _open_pdf(spool):
+    """Открывает PDF (страницы читаются лениво) и возвращает (reader, число страниц)."""
+    from pypdf import PdfReader
+    reader = PdfReader(spool)
+    if reader.is_encrypted and not reader.decrypt(""):
+        raise DocumentError("Извините, этот PDF защищён паролем.")
+    return reader, len(reader.pages)
+
+def _extract_pdf_page(reader, index: int) -> str:
+    return reader.pages[index].extract_text() or ""
+
+async def iter_document_text(spool, is_pdf: bool):
+    """
+    Асинхронный генератор: отдаёт текст документа по мере чтения —
+    блоками по DOCUMENT_READ_BLOCK для текстовых файлов и по страницам для PDF.
+    """
+    loop = asyncio.get_running_loop()
+    if is_pdf:
+        try:
+            reader, page_count = await loop.run_in_executor(document_executor, _open_pdf, spool)
+        except ImportError:
+            LOGGER.warning("Пакет pypdf не установлен, чтение PDF недоступно.")
+            raise DocumentError("Извините, чтение PDF сейчас недоступно.")
+        except DocumentError:
+            raise
+        except Exception as e:
+            LOGGER.error("Не удалось открыть PDF: %s", e)
+            raise DocumentError("Извините, не удалось прочитать этот PDF.") from e
+
+        for index in range(page_count):
+            try:
+                text = await loop.run_in_executor(document_executor, _extract_pdf_page, reader, index)
+            except Exception as e:
+                LOGGER.warning("Не удалось извлечь текст страницы %s PDF: %s", index + 1, e)
+                continue
+            yield text + "\n\n"
+        return
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        block = await loop.run_in_executor(document_executor, spool.read, DOCUMENT_READ_BLOCK)
+        try:
+            text = decoder.decode(block, final=not block)
+        except UnicodeDecodeError:
+            LOGGER.error("Не удалось декодировать файл. Возможно, это бинарный файл.")
+            raise DocumentError("Извините, не удалось прочитать этот файл как текст.")
+        if text:
+            yield text
+        if not block:
+            return
+
+
+class DocumentChunker:
+    """
+    Делит поток текста на части не больше max_tokens (около 4 символов на токен, как в estimate_parts_tokens).
+    Части по возможности режутся по абзацам, затем по строкам и пробелам.
+    """
+
+    def __init__(self, max_tokens: int):
+        self.max_chars = max_tokens * 4
+        self._buffer = ""
+
+    def feed(self, text: str) -> list:
+        """Добавляет текст и возвращает части, которые уже заполнены."""
+        self._buffer += text
+        chunks = []
+        while len(self._buffer) > self.max_chars:
+            window = self._buffer[:self.max_chars]
+            cut = self.max_chars
+            for separator in ("\n\n", "\n", " "):
+                position = window.rfind(separator)
+                if position > self.max_chars // 2:
+                    cut = position + len(separator)
+                    break
+            chunk, self._buffer = self._buffer[:cut], self._buffer[cut:]
+            if chunk.strip():
+                chunks.append(chunk)
+        return chunks
+
+    def finish(self) -> list:
+        """Возвращает последнюю, неполную часть."""
+        chunk, self._buffer = self._buffer, ""
+        return [chunk] if chunk.strip() else []
+
+
+async def read_document(document, is_pdf: bool) -> DocumentText:
+    """
+    Скачивает документ во временный файл и читает из него текст, сразу деля его на части.
+    Текст дальше DOCUMENT_MAX_TOKENS отбрасывается, поэтому память ограничена и для огромных файлов.
+    """
+    chunker = DocumentChunker(DOCUMENT_CHUNK_TOKENS)
+    chunks, full, truncated = [], False, False
+    with tempfile.SpooledTemporaryFile(max_size=DOCUMENT_SPOOL_MEMORY) as spool:
+        with STAGE_SECONDS.time(stage="download"):
+            await download_document(document, spool)
+        with STAGE_SECONDS.time(stage="extract"):
+            pieces = iter_document_text(spool, is_pdf)
+            try:
+                async for text in pieces:
+                    if full:
+                        # Лимит набран; файл обрезан, только если дальше действительно есть текст
+                        if text.strip():
+                            truncated = True
+                            break
+                        continue
+                    chunks += chunker.feed(text)
+                    full = len(chunks) * DOCUMENT_CHUNK_TOKENS >= DOCUMENT_MAX_TOKENS
+            finally:
+                await pieces.aclose()
+            rest = chunker.finish()
+            if not full:
+                chunks += rest
+            elif rest:
+                truncated = True
+
+    if not chunks:
+        raise DocumentError("Извините, в файле не найден текст. Если это скан, отправьте страницы как фотографии.")
+    tokens = estimate_parts_tokens([{"text": chunk} for chunk in chunks])
+    LOGGER.info("Из документа %s извлечено ~%s токенов (%s частей%s).",
+                document.file_name, tokens, len(chunks), ", файл обрезан" if truncated else "")
+    return DocumentText(document.file_name or "document", chunks, tokens, truncated)
+
+async def summarize_document(document_text: DocumentText, task: str, new_slot=None) -> str:
+    """
+    Map-этап для большого документа: каждая часть конспектируется отдельным запросом
+    (не больше DOCUMENT_MAP_CONCURRENCY одновременно), конспекты склеиваются по порядку.
+    new_slot() возвращает новое место в очереди ADMISSION: его занимает каждый запрос части.
+    Если склеенный конспект всё ещё больше DOCUMENT_INLINE_TOKENS, он снова делится на части и сжимается.
+    Ответ пользователю (reduce) строится по конспекту обычным запросом в выбранном формате.
+    """
+    limiter = asyncio.Semaphore(DOCUMENT_MAP_CONCURRENCY)
+
+    async def summarize_chunk(index: int, total: int, chunk: str) -> str:
+        content = {
+            "role": "user",
+            "parts": [{"text": f"Задание пользователя: {task or 'не указано'}\n\n"
+                               f"Файл «{document_text.file_name}», часть {index} из {total}:\n\n{chunk}"}]
+        }
+        payload = {
+            "systemInstruction": system_instruction(DOCUMENT_MAP_PROMPT),
+            "contents": [content],
+            "generationConfig": {"temperature": 0.2}
+        }
+        # Конспекты частей кэшируются: повторный вопрос по тому же файлу не повторяет map-этап
+        cache_key = response_cache_key("document_map", content, [], [])
+        async with limiter:
+            notes = await generate_cached(cache_key, payload, new_slot() if new_slot else None)
+        if notes in GEMINI_ERROR_MESSAGES:
+            raise DocumentError("Извините, не удалось обработать часть файла. Пожалуйста, попробуйте позже.")
+        return f"Часть {index} из {total}:\n{notes.strip()}"
+
+    chunks = document_text.chunks
+    for round_index in range(1, DOCUMENT_REDUCE_ROUNDS + 1):
+        LOGGER.info("Конспектирую документ %s: %s частей, проход %s.", document_text.file_name, len(chunks), round_index)
+        tasks = [asyncio.create_task(summarize_chunk(index, len(chunks), chunk)) for index, chunk in enumerate(chunks, 1)]
+        try:
+            with STAGE_SECONDS.time(stage="document_map"):
+                notes = await asyncio.gather(*tasks)
+        finally:
+            # Если одна часть не удалась, остальные запросы не нужны
+            for pending in tasks:
+                pending.cancel()
+        summary = "\n\n".join(notes)
+        # Дальше не сжимаем, если конспект уже помещается или перестал сокращаться
+        if (len(notes) == 1 or estimate_parts_tokens([{"text": summary}]) <= DOCUMENT_INLINE_TOKENS
+                or len(summary) >= sum(len(chunk) for chunk in chunks)):
+            break
+        chunker = DocumentChunker(DOCUMENT_CHUNK_TOKENS)
+        chunks = chunker.feed(summary) + chunker.finish()
+    return summary
+
+async def send_html_file(update: Update, html_code: str):
+    """Creates and sends an HTML file from the generated code."""
+    LOGGER.info("Начало отправки HTML-файла.")
+    try:
+        file_size_bytes = len(html_code.encode('utf-8'))
+        LOGGER.info("Размер генерируемого HTML-файла: %s байт.", file_size_bytes)
+        if file_size_bytes > 50 * 1024 * 1024:
+            await update.message.reply_text("Извините, сгенерированный файл слишком большой для отправки в Telegram.")
+            LOGGER.warning("Файл слишком большой для отправки: %s байт.", file_size_bytes)
+            return
+
+        with STAGE_SECONDS.time(stage="send_document"):
+            await update.message.reply_document(
+                document=html_code.encode('utf-8'),
+                filename="solution.html"
+            )
+        LOGGER.info("HTML-файл успешно отправлен пользователю %s", update.effective_user.id)
+    except BadRequest as e:
+        if "too long" in str(e).lower():
+            await update.message.reply_text("Извините, сгенерированный файл слишком большой для отправки в Telegram. Пожалуйста, попробуйте сформулировать запрос более кратко.")
+        else:
+            LOGGER.error("Ошибка при отправке HTML-файла: %s", e)
+            await update.message.reply_text("Извините, произошла ошибка при отправке файла.")
+    except Exception as e:
+        LOGGER.error("Ошибка при отправке HTML-файла: %s", e)
+        await update.message.reply_text("Извините, произошла ошибка при отправке файла.")
+
+# --- Отрисовка HTML в картинку ---
+
+class HtmlRenderError(Exception):
+    """HTML-ответ не удалось отрисовать в картинку."""
+
+
+class HtmlRenderer:
+    """
+    Пул заранее открытых страниц headless Chromium для отрисовки HTML-ответов в JPEG.
+    Страницы создаются при запуске и переиспользуются, поэтому к времени ответа Gemini добавляется
+    только сама отрисовка. Свободные страницы лежат в очереди: запросы ждут страницу не дольше
+    HTML_RENDER_QUEUE_TIMEOUT. Готовые картинки кэшируются по хэшу HTML.
+    Скрипты и сетевые запросы на страницах отключены: отрисовывается только сам документ.
+    """
+
+    def __init__(self, pages: int, cache_max_bytes: int):
+        self.pages = pages
+        self._playwright = None
+        self._browser = None
+        self._free = None
+        self._size = 0
+        self._cache = OrderedDict()  # sha256 HTML -> JPEG
+        self._cache_bytes = 0
+        self._cache_max_bytes = cache_max_bytes
+
+    @property
+    def available(self) -> bool:
+        return self._size > 0
+
+    async def open(self) -> None:
+        """Запускает браузер и открывает страницы пула; без playwright формат «image» недоступен."""
+        try:
+            from playwright.async_api import async_playwright
+        except ImportError:
+            LOGGER.warning("Пакет playwright не установлен, ответы картинкой отключены.")
+            return
+        try:
+            self._playwright = await async_playwright().start()
+            self._browser = await self._playwright.chromium.launch(args=["--disable-gpu"])
+            self._free = asyncio.Queue()
+            for _ in range(self.pages):
+                self._free.put_nowait(await self._new_page())
+                self._size += 1
+        except Exception as e:
+            LOGGER.error("Не удалось запустить браузер для отрисовки HTML: %s", e)
+            await self.close()
+            return
+        LOGGER.info("Пул отрисовки HTML запущен (%s страниц).", self._size)
+
+    async def close(self) -> None:
+        self._size = 0
+        if self._browser is not None:
+            with contextlib.suppress(Exception):
+                await self._browser.close()
+            self._browser = None
+        if self._playwright is not None:
+            with contextlib.suppress(Exception):
+                await self._playwright.stop()
+            self._playwright = None
+            LOGGER.info("Пул отрисовки HTML остановлен.")
+
+    async def _new_page(self):
+        """Открывает страницу и «прогревает» её пустым документом, чтобы первая отрисовка не ждала запуска."""
+        page = await self._browser.new_page(
+            viewport={"width": HTML_RENDER_WIDTH, "height": 600},
+            device_scale_factor=HTML_RENDER_SCALE,
+            java_script_enabled=False,
+        )
+        await page.route("**/*", lambda route: route.abort())
+        await page.set_content("<html><body><p>.</p></body></html>")
+        return page
+
+    async def _recycle(self, page) -> None:
+        """Заменяет страницу, на которой отрисовка не удалась (она могла зависнуть или упасть)."""
+        with contextlib.suppress(Exception):
+            await page.close()
+        try:
+            self._free.put_nowait(await self._new_page())
+        except Exception as e:
+            self._size -= 1
+            LOGGER.error("Не удалось открыть новую страницу для отрисовки HTML (осталось %s): %s", self._size, e)
+
+    async def _render_page(self, page, html_code: str) -> bytes:
+        await page.set_content(html_code, wait_until="load")
+        return await page.screenshot(full_page=True, type="jpeg", quality=HTML_RENDER_QUALITY)
+
+    async def render(self, html_code: str) -> bytes:
+        """Возвращает JPEG с отрисованным HTML. Бросает HtmlRenderError при ошибке или превышении времени."""
+        key = hashlib.sha256(html_code.encode("utf-8")).hexdigest()
+        image = self._cache.get(key)
+        if image is not None:
+            self._cache.move_to_end(key)
+            return image
+        if not self.available:
+            raise HtmlRenderError("пул отрисовки не запущен")
+
+        try:
+            page = await asyncio.wait_for(self._free.get(), HTML_RENDER_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HtmlRenderError("нет свободной страницы для отрисовки") from None
+        try:
+            image = await asyncio.wait_for(self._render_page(page, html_code), HTML_RENDER_TIMEOUT)
+        except BaseException as e:
+            await self._recycle(page)
+            if isinstance(e, asyncio.TimeoutError):
+                raise HtmlRenderError("отрисовка заняла слишком много времени") from None
+            if isinstance(e, Exception):
+                raise HtmlRenderError(str(e)) from e
+            raise
+        self._free.put_nowait(page)
+
+        self._cache[key] = image
+        self._cache_bytes += len(image)
+        while self._cache_bytes > self._cache_max_bytes and self._cache:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted)
+        return image
+
+
+HTML_RENDERER = HtmlRenderer(HTML_RENDER_PAGES, HTML_RENDER_CACHE_MAX_BYTES)
+
+async def send_html_image(update: Update, html_code: str):
+    """
+    Отправляет HTML-ответ картинкой. Слишком длинные для фото картинки уходят файлом,
+    а если отрисовать не удалось — отправляется обычный HTML-файл.
+    """
+    try:
+        with STAGE_SECONDS.time(stage="render"):
+            image = await HTML_RENDERER.render(html_code)
+    except HtmlRenderError as e:
+        LOGGER.error("Не удалось отрисовать HTML в картинку: %s", e)
+        await send_html_file(update, html_code)
+        return
+
+    try:
+        with STAGE_SECONDS.time(stage="send_photo"):
+            await update.message.reply_photo(photo=image)
+    except BadRequest as e:
+        # Telegram не принимает фото с очень вытянутыми сторонами или больше 10 МБ
+        LOGGER.info("Картинка не подходит для фото (%s), отправляю файлом.", e)
+        try:
+            with STAGE_SECONDS.time(stage="send_document"):
+                await update.message.reply_document(document=image, filename="solution.jpg")
+        except TelegramError as e:
+            LOGGER.error("Не удалось отправить картинку файлом: %s. Отправляю HTML-файл.", e)
+            await send_html_file(update, html_code)
+            return
+    LOGGER.info("Ответ картинкой отправлен пользователю %s", update.effective_user.id)
+
+# --- Презентации ---
+
+@dataclass(frozen=True)
+class PptxTheme:
+    """Встроенное оформление презентации, из которого при запуске собирается шаблон .pptx."""
+    name: str
+    title: str
+    background: RGBColor
+    primary: RGBColor
+    secondary: RGBColor
+    accent: RGBColor
+    font_name: str = 'Arial'
+    title_size: Pt = Pt(36)
+    body_size: Pt = Pt(20)
+    body_space_after: Pt = Pt(10)
+    accent_height: Inches = Inches(0.2)
+    title_top: Inches = Inches(0.5)
+    title_height: Inches = Inches(1.5)
+    title_margin: Inches = Inches(1)
+
+
+PPTX_THEMES = {
+    "classic": PptxTheme(
+        name="classic",
+        title="Классическая",
+        background=RGBColor(245, 245, 245),
+        primary=RGBColor(41, 128, 185), # Синий
+        secondary=RGBColor(52, 73, 94), # Темно-серый
+        accent=RGBColor(52, 152, 219), # Голубой
+    ),
+    "dark": PptxTheme(
+        name="dark",
+        title="Тёмная",
+        background=RGBColor(33, 37, 43),
+        primary=RGBColor(241, 196, 15), # Жёлтый
+        secondary=RGBColor(236, 240, 241), # Светло-серый
+        accent=RGBColor(230, 126, 34), # Оранжевый
+    ),
+    "mint": PptxTheme(
+        name="mint",
+        title="Мятная",
+        background=RGBColor(240, 250, 245),
+        primary=RGBColor(22, 160, 133), # Бирюзовый
+        secondary=RGBColor(44, 62, 80), # Тёмно-синий
+        accent=RGBColor(46, 204, 113), # Зелёный
+    ),
+}
+DEFAULT_PPTX_THEME = "classic"
+
+
+@dataclass
+class PptxTemplate:
+    """Готовый шаблон презентации: содержимое .pptx и индекс макета «Заголовок и объект»."""
+    name: str
+    title: str
+    data: bytes
+    layout_index: int = 1
+
+
+# Шаблоны, загруженные при запуске: имя темы -> PptxTemplate
+PPTX_TEMPLATES = {}
+
+def _text_style_xml(alignment: str, size: Pt, color: RGBColor, font_name: str, bold: bool = False,
+                    space_after: Pt = None) -> str:
+    """XML стиля первого уровня текста (a:lvl1pPr) для списка стилей плейсхолдера макета."""
+    spacing = f'<a:spcAft><a:spcPts val="{int(space_after.pt * 100)}"/></a:spcAft>' if space_after else ""
+    return (
+        f'<a:lvl1pPr {nsdecls("a")} algn="{alignment}">{spacing}'
+        f'<a:defRPr sz="{int(size.pt * 100)}" b="{int(bold)}">'
+        f'<a:solidFill><a:srgbClr val="{color}"/></a:solidFill>'
+        f'<a:latin typeface="{font_name}"/>'
+        f'</a:defRPr></a:lvl1pPr>'
+    )
+
+def _set_placeholder_style(placeholder, style_xml: str) -> None:
+    """Задаёт стиль текста плейсхолдера макета; слайды наследуют его без изменений XML на каждом слайде."""
+    tx_body = placeholder._element.get_or_add_txBody()
+    lst_style = tx_body.find(qn("a:lstStyle"))
+    if lst_style is None:
+        # a:lstStyle идёт сразу после a:bodyPr
+        lst_style = parse_xml(f'<a:lstStyle {nsdecls("a")}/>')
+        tx_body.bodyPr.addnext(lst_style)
+    for child in list(lst_style):
+        lst_style.remove(child)
+    lst_style.append(parse_xml(style_xml))
+
+def build_theme_template(theme: PptxTheme) -> bytes:
+    """
+    Собирает шаблон презентации для темы: фон, полоса-акцент, шрифты и положение заголовка
+    задаются один раз в макете, а не на каждом слайде.
+    """
+    prs = Presentation()
+    layout = prs.slide_layouts[1] # Макет слайда с заголовком и списком
+
+    fill = layout.background.fill
+    fill.solid()
+    fill.fore_color.rgb = theme.background
+
+    # Полоса-акцент вверху слайда
+    sp_tree = layout.shapes._spTree
+    shape_id = max(int(element.get("id")) for element in sp_tree.iter(qn("p:cNvPr"))) + 1
+    sp_tree.append(parse_xml(
+        f'<p:sp {nsdecls("p", "a")}>'
+        f'<p:nvSpPr><p:cNvPr id="{shape_id}" name="Accent"/><p:cNvSpPr/><p:nvPr userDrawn="1"/></p:nvSpPr>'
+        f'<p:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{prs.slide_width}" cy="{theme.accent_height}"/></a:xfrm>'
+        f'<a:prstGeom prst="rect"><a:avLst/></a:prstGeom>'
+        f'<a:solidFill><a:srgbClr val="{theme.accent}"/></a:solidFill><a:ln><a:noFill/></a:ln></p:spPr>'
+        f'</p:sp>'
+    ))
+
+    for placeholder in layout.placeholders:
+        if placeholder.placeholder_format.idx == 0:
+            placeholder.left = theme.title_margin
+            placeholder.top = theme.title_top
+            placeholder.width = prs.slide_width - 2 * theme.title_margin
+            placeholder.height = theme.title_height
+            _set_placeholder_style(placeholder, _text_style_xml(
+                "ctr", theme.title_size, theme.primary, theme.font_name, bold=True))
+        elif placeholder.placeholder_format.idx == 1:
+            _set_placeholder_style(placeholder, _text_style_xml(
+                "l", theme.body_size, theme.secondary, theme.font_name, space_after=theme.body_space_after))
+
+    buffer = io.BytesIO()
+    prs.save(buffer)
+    return buffer.getvalue()
+
+def _find_content_layout(prs) -> int:
+    """Индекс макета с заголовком и текстом в пользовательском шаблоне."""
+    for index, layout in enumerate(prs.slide_layouts):
+        indexes = {placeholder.placeholder_format.idx for placeholder in layout.placeholders}
+        if 0 in indexes and 1 in indexes:
+            return index
+    raise ValueError("в шаблоне нет макета с заголовком и текстом")
+
+def load_pptx_templates() -> dict:
+    """
+    Загружает шаблоны презентаций: встроенные темы и файлы *.pptx из PPTX_THEMES_DIR
+    (имя файла — имя темы). Новые оформления добавляются просто файлом в этой папке.
+    """
+    templates = {
+        name: PptxTemplate(name, theme.title, build_theme_template(theme))
+        for name, theme in PPTX_THEMES.items()
+    }
+    if PPTX_THEMES_DIR and os.path.isdir(PPTX_THEMES_DIR):
+        for path in sorted(pathlib.Path(PPTX_THEMES_DIR).glob("*.pptx")):
+            try:
+                data = path.read_bytes()
+                layout_index = _find_content_layout(Presentation(io.BytesIO(data)))
+                templates[path.stem] = PptxTemplate(path.stem, path.stem, data, layout_index)
+            except Exception as e:
+                LOGGER.error("Не удалось загрузить шаблон презентации %s: %s", path, e)
+    LOGGER.info("Загружено шаблонов презентаций: %s.", len(templates))
+    return templates
+
+def _init_pptx_worker(templates: dict) -> None:
+    """Инициализация процесса пула: шаблоны передаются один раз при его запуске."""
+    PPTX_TEMPLATES.update(templates)
+
+def build_pptx_bytes(slides_data: list, theme_name: str = DEFAULT_PPTX_THEME) -> bytes:
+    """
+    Выполняется в процессе пула: копирует шаблон темы из памяти, заполняет слайды текстом
+    и возвращает содержимое .pptx-файла (без записи на диск).
+    """
+    template = PPTX_TEMPLATES.get(theme_name) or PPTX_TEMPLATES[DEFAULT_PPTX_THEME]
+    prs = Presentation(io.BytesIO(template.data))
+    slide_layout = prs.slide_layouts[template.layout_index]
+
+    for slide_info in slides_data:
+        slide = prs.slides.add_slide(slide_layout)
+        placeholders = {placeholder.placeholder_format.idx: placeholder for placeholder in slide.placeholders}
+        placeholders[0].text_frame.text = slide_info.get("title", "Без заголовка")
+
+        points = slide_info.get("points")
+        if isinstance(points, list) and 1 in placeholders:
+            content_tf = placeholders[1].text_frame
+            content_tf.word_wrap = True
+            # Каждая строка становится отдельным абзацем со стилем из макета
+            content_tf.text = "\n".join(str(point).replace("\n", " ") for point in points)
+
+    buffer = io.BytesIO()
+    prs.save(buffer)
+    return buffer.getvalue()
+
+
+# Пул процессов для сборки презентаций
+pptx_executor = None
+
+def open_pptx_executor() -> ProcessPoolExecutor:
+    """Создаёт пул процессов для сборки презентаций (если он ещё не создан)."""
+    global pptx_executor
+    if pptx_executor is None:
+        if not PPTX_TEMPLATES:
+            PPTX_TEMPLATES.update(load_pptx_templates())
+        pptx_executor = ProcessPoolExecutor(
+            max_workers=PPTX_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_pptx_worker,
+            initargs=(PPTX_TEMPLATES,),
+        )
+        LOGGER.info("Пул сборки презентаций запущен (%s процессов).", PPTX_WORKERS)
+    return pptx_executor
+
+def close_pptx_executor() -> None:
+    """Останавливает пул процессов для презентаций."""
+    global pptx_executor
+    if pptx_executor is not None:
+        pptx_executor.shutdown(wait=False, cancel_futures=True)
+        pptx_executor = None
+        LOGGER.info("Пул сборки презентаций остановлен.")
+
+async def create_and_send_pptx_file(update: Update, slides_data: list, theme_name: str = DEFAULT_PPTX_THEME):
+    """
+    Собирает PowerPoint-презентацию по шаблону темы в отдельном процессе и отправляет её из памяти.
+    """
+    LOGGER.info("Начало создания и отправки PPTX-файла (%s слайдов).", len(slides_data))
+    loop = asyncio.get_running_loop()
+    try:
+        with STAGE_SECONDS.time(stage="pptx_build"):
+            pptx_bytes = await asyncio.wait_for(
+                loop.run_in_executor(open_pptx_executor(), build_pptx_bytes, slides_data, theme_name),
+                timeout=PPTX_BUILD_TIMEOUT,
+            )
+    except BrokenProcessPool as e:
+        close_pptx_executor()
+        LOGGER.error("Пул сборки презентаций аварийно завершился: %s", e)
+        await update.message.reply_text("Извините, произошла ошибка при создании презентации.")
+        return
+    except Exception as e:
+        LOGGER.error("Error building PowerPoint file: %r", e)
+        await update.message.reply_text("Извините, произошла ошибка при создании презентации.")
+        return
+
+    # Отправка файла
+    try:
+        with STAGE_SECONDS.time(stage="send_document"):
+            await update.message.reply_document(
+                document=pptx_bytes,
+                filename="presentation.pptx"
+            )
+        LOGGER.info("Presentation file sent successfully to %s", update.effective_user.id)
+    except Exception as e:
+        LOGGER.error("Error sending PowerPoint file: %s", e)
+        await update.message.reply_text("Извините, произошла ошибка при отправке файла презентации.")
+
+# --- Хранилище данных пользователей ---
+
+STYLE_BLOCK_RE = re.compile(r"<style\b[^>]*>.*?</style>", re.IGNORECASE | re.DOTALL)
+WHITESPACE_RUN_RE = re.compile(r"\s{2,}")
+
+def compact_history_item(item: dict) -> dict:
+    """
+    Уменьшает сообщение перед сохранением в историю: убирает блоки <style>
+    (в каждом HTML-ответе повторяется NOTEBOOK_STYLES) и схлопывает пробелы.
+    """
+    if not HISTORY_COMPACT:
+        return item
+    parts = []
+    for part in item["parts"]:
+        if "text" in part:
+            text = STYLE_BLOCK_RE.sub("", part["text"])
+            part = {"text": WHITESPACE_RUN_RE.sub(" ", text).strip()}
+        parts.append(part)
+    return {"role": item["role"], "parts": parts}
+
+
+class HistoryCache:
+    """
+    Кэш истории диалогов в памяти.
+    История пользователя — deque, ограниченная MAX_HISTORY_MESSAGES и бюджетом HISTORY_TOKEN_BUDGET.
+    Пользователи, не писавшие дольше HISTORY_CACHE_TTL, и самые давние сверх HISTORY_CACHE_MAX_USERS
+    выгружаются из памяти (LRU); их история остаётся в базе и будет прочитана заново.
+    """
+
+    def __init__(self, max_users: int, ttl: float, token_budget: int):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.token_budget = token_budget
+        self._entries = OrderedDict()  # user_id -> [deque сообщений, их токены, время последнего доступа]
+
+    def get(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        entry[2] = time.monotonic()
+        self._entries.move_to_end(user_id)
+        return [item for item, _ in entry[0]]
+
+    def put(self, user_id: int, items: list) -> None:
+        """Кладёт в кэш историю, прочитанную из базы (если её ещё нет в кэше)."""
+        if user_id in self._entries:
+            return
+        self._entries[user_id] = [deque(), 0, time.monotonic()]
+        for item in items:
+            self.append(user_id, item)
+        self.evict()
+
+    def append(self, user_id: int, item: dict) -> None:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = self._entries[user_id] = [deque(), 0, time.monotonic()]
+        turns = entry[0]
+        turns.append((item, estimate_parts_tokens(item["parts"])))
+        entry[1] += turns[-1][1]
+        # Отбрасываем старые сообщения целыми парами «пользователь + модель»: история всегда начинается
+        # с сообщения пользователя, и роли чередуются. Если не помещается даже последняя пара,
+        # остаётся только последнее сообщение пользователя (или ничего).
+        while len(turns) > 1 and (len(turns) > MAX_HISTORY_MESSAGES or entry[1] > self.token_budget):
+            entry[1] -= turns.popleft()[1]
+            while turns and turns[0][0]["role"] != "user":
+                entry[1] -= turns.popleft()[1]
+        entry[2] = time.monotonic()
+        self._entries.move_to_end(user_id)
+
+    def items(self, user_id: int) -> list:
+        entry = self._entries.get(user_id)
+        return [item for item, _ in entry[0]] if entry else []
+
+    def discard(self, user_id: int) -> None:
+        self._entries.pop(user_id, None)
+
+    def evict(self) -> None:
+        """Выгружает простаивающих и лишних пользователей."""
+        deadline = time.monotonic() - self.ttl
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_users and entry[2] >= deadline:
+                break
+            del self._entries[user_id]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Настройки нового пользователя
+DEFAULT_USER_SETTINGS = {"response_format": "html", "html_credits": 0, "pptx_theme": DEFAULT_PPTX_THEME}
+
+class Storage:
+    """
+    Постоянное хранилище настроек, кредитов и истории диалогов в SQLite (режим WAL).
+    Все обращения к базе выполняются в одном выделенном потоке, поэтому цикл событий не блокируется.
+    Настройки и история кэшируются в памяти; новые сообщения истории записываются на диск пачками.
+    Списание и начисление кредитов выполняются атомарно на стороне SQLite.
+    """
+
+    SETTINGS_COLUMNS = ("response_format", "pptx_theme")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self._settings_cache = {}
+        self._history_cache = HistoryCache(HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_TTL, HISTORY_TOKEN_BUDGET)
+        self._pending_history = []
+        self._flush_task = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _open_sync(self) -> None:
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        # Ожидание блокировки задаётся первым: несколько рабочих процессов открывают базу одновременно
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                response_format TEXT NOT NULL DEFAULT 'html',
+                html_credits INTEGER NOT NULL DEFAULT 0,
+                pptx_theme TEXT NOT NULL DEFAULT '{DEFAULT_PPTX_THEME}'
+            );
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                parts TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS history_user ON history (user_id, id);
+            CREATE TABLE IF NOT EXISTS payments (
+                charge_id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                credits INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS key_health (
+                key_id TEXT PRIMARY KEY,
+                cooldown_until REAL NOT NULL DEFAULT 0,
+                invalid INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        # Колонки, добавленные после первой версии схемы (для старых баз). Проверка повторяется под
+        # блокировкой записи, чтобы несколько рабочих процессов не добавляли колонку одновременно.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+            if "pptx_theme" not in columns:
+                self._conn.execute(f"ALTER TABLE users ADD COLUMN pptx_theme TEXT NOT NULL DEFAULT '{DEFAULT_PPTX_THEME}'")
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    async def open(self) -> None:
+        """Открывает базу и запускает фоновую запись истории."""
+        await self._run(self._open_sync)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        LOGGER.info("Хранилище %s открыто.", self.path)
+
+    async def close(self) -> None:
+        """Записывает накопленную историю и закрывает базу."""
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._conn is not None:
+            await self.flush()
+            await self._run(self._conn.close)
+            self._conn = None
+        LOGGER.info("Хранилище закрыто.")
+
+    # Настройки и кредиты
+
+    def _load_settings_sync(self, user_id: int) -> dict:
+        row = self._conn.execute(
+            "SELECT response_format, html_credits, pptx_theme FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return dict(DEFAULT_USER_SETTINGS)
+        return {"response_format": row[0], "html_credits": row[1], "pptx_theme": row[2]}
+
+    async def get_settings(self, user_id: int) -> dict:
+        """Возвращает копию настроек пользователя (из кэша или из базы)."""
+        settings = self._settings_cache.get(user_id)
+        if settings is None:
+            settings = await self._run(self._load_settings_sync, user_id)
+            settings = self._settings_cache.setdefault(user_id, settings)
+        return dict(settings)
+
+    def _set_setting_sync(self, user_id: int, name: str, value) -> None:
+        self._conn.execute(
+            f"INSERT INTO users (user_id, {name}) VALUES (?, ?) "
+            f"ON CONFLICT(user_id) DO UPDATE SET {name} = excluded.{name}",
+            (user_id, value),
+        )
+
+    async def set_setting(self, user_id: int, name: str, value) -> None:
+        """Сохраняет одну настройку пользователя."""
+        if name not in self.SETTINGS_COLUMNS:
+            raise ValueError(f"Неизвестная настройка: {name}")
+        await self._run(self._set_setting_sync, user_id, name, value)
+        await self.get_settings(user_id)
+        self._settings_cache[user_id][name] = value
+
+    def _add_credits_sync(self, user_id: int, amount: int, charge_id) -> int:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if charge_id is not None:
+                inserted = self._conn.execute(
+                    "INSERT OR IGNORE INTO payments (charge_id, user_id, credits) VALUES (?, ?, ?)",
+                    (charge_id, user_id, amount),
+                ).rowcount
+                if not inserted:
+                    # Этот платёж уже был зачислен (повторная доставка обновления)
+                    amount = 0
+            self._conn.execute(
+                "INSERT INTO users (user_id, html_credits) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET html_credits = html_credits + excluded.html_credits",
+                (user_id, amount),
+            )
+            balance = self._conn.execute("SELECT html_credits FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return balance
+
+    async def add_credits(self, user_id: int, amount: int, charge_id: str = None) -> int:
+        """
+        Атомарно начисляет кредиты и возвращает новый баланс.
+        Если передан charge_id платежа, повторное начисление по нему не выполняется.
+        """
+        balance = await self._run(self._add_credits_sync, user_id, amount, charge_id)
+        self._update_cached_balance(user_id, balance)
+        return balance
+
+    def _debit_credits_sync(self, user_id: int, amount: int):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            updated = self._conn.execute(
+                "UPDATE users SET html_credits = html_credits - ? WHERE user_id = ? AND html_credits >= ?",
+                (amount, user_id, amount),
+            ).rowcount
+            balance = None
+            if updated:
+                balance = self._conn.execute("SELECT html_credits FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return balance
+
+    async def try_debit_credits(self, user_id: int, amount: int = 1):
+        """Атомарно списывает кредиты. Возвращает новый баланс или None, если кредитов не хватает."""
+        balance = await self._run(self._debit_credits_sync, user_id, amount)
+        if balance is not None:
+            self._update_cached_balance(user_id, balance)
+        return balance
+
+    def _update_cached_balance(self, user_id: int, balance: int) -> None:
+        if user_id in self._settings_cache:
+            self._settings_cache[user_id]["html_credits"] = balance
+
+    # Состояние API-ключей, общее для рабочих процессов
+
+    def _save_key_health_sync(self, key_id: str, cooldown_until: float, invalid: bool) -> None:
+        self._conn.execute(
+            "INSERT INTO key_health (key_id, cooldown_until, invalid) VALUES (?, ?, ?) "
+            "ON CONFLICT(key_id) DO UPDATE SET cooldown_until = MAX(cooldown_until, excluded.cooldown_until), "
+            "invalid = MAX(invalid, excluded.invalid)",
+            (key_id, cooldown_until, int(invalid)),
+        )
+
+    async def save_key_health(self, key_id: str, cooldown_until: float, invalid: bool) -> None:
+        """Сохраняет паузу (время по time.time()) и признак недействительности ключа."""
+        await self._run(self._save_key_health_sync, key_id, cooldown_until, invalid)
+
+    def _load_key_health_sync(self) -> dict:
+        rows = self._conn.execute("SELECT key_id, cooldown_until, invalid FROM key_health").fetchall()
+        return {key_id: (cooldown_until, bool(invalid)) for key_id, cooldown_until, invalid in rows}
+
+    async def load_key_health(self) -> dict:
+        """Возвращает {key_id: (пауза до, недействителен)} для всех ключей."""
+        return await self._run(self._load_key_health_sync)
+
+    # История диалогов
+
+    def _load_history_sync(self, user_id: int) -> list:
+        rows = self._conn.execute(
+            "SELECT role, parts FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, MAX_HISTORY_MESSAGES),
+        ).fetchall()
+        return [{"role": role, "parts": json.loads(parts)} for role, parts in reversed(rows)]
+
+    async def get_history(self, user_id: int) -> list:
+        """Возвращает последние сообщения диалога пользователя (в пределах бюджета токенов)."""
+        history = self._history_cache.get(user_id)
+        if history is None:
+            loaded = await self._run(self._load_history_sync, user_id)
+            # Пока история читалась, её мог загрузить другой обработчик — тогда put ничего не меняет
+            self._history_cache.put(user_id, loaded)
+            history = self._history_cache.items(user_id)
+        return history
+
+    async def append_history(self, user_id: int, item: dict) -> None:
+        """Добавляет сообщение в историю. На диск оно попадёт при ближайшей фоновой записи."""
+        item = compact_history_item(item)
+        await self.get_history(user_id)
+        self._history_cache.append(user_id, item)
+        self._pending_history.append((user_id, item["role"], json.dumps(item["parts"], ensure_ascii=False)))
+
+    def _clear_history_sync(self, user_id: int) -> None:
+        self._conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+
+    async def clear_history(self, user_id: int) -> None:
+        """Удаляет историю диалога пользователя."""
+        self._history_cache.discard(user_id)
+        self._pending_history = [row for row in self._pending_history if row[0] != user_id]
+        await self._run(self._clear_history_sync, user_id)
+
+    def _write_history_sync(self, rows: list) -> None:
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany("INSERT INTO history (user_id, role, parts) VALUES (?, ?, ?)", rows)
+            for user_id in {row[0] for row in rows}:
+                self._conn.execute(
+                    "DELETE FROM history WHERE user_id = ? AND id NOT IN "
+                    "(SELECT id FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+                    (user_id, user_id, MAX_HISTORY_MESSAGES),
+                )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    async def flush(self) -> None:
+        """Записывает накопленные сообщения истории одной транзакцией."""
+        if not self._pending_history:
+            return
+        rows, self._pending_history = self._pending_history, []
+        try:
+            await self._run(self._write_history_sync, rows)
+        except Exception as e:
+            LOGGER.error("Не удалось записать историю на диск: %s", e)
+            self._pending_history = rows + self._pending_history
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+            await self.flush()
+            self._history_cache.evict()
+
+
+STORAGE = Storage(STORAGE_PATH)
+
+# --- Очередь запросов ---
+
+class AdmissionRejected(Exception):
+    """Запрос слишком долго ждал в очереди и был отклонён."""
+
+
+@dataclass
+class AdmissionWaiter:
+    user_id: int
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class AdmissionScheduler:
+    """
+    Планировщик запросов к Gemini.
+    Общее число одновременных запросов ограничено ёмкостью пула ключей, у каждого пользователя
+    свой лимит. Ожидающие запросы обслуживаются по кругу между пользователями (а не в порядке
+    поступления), поэтому один пользователь с пачкой фото не задерживает остальных.
+    Платящие пользователи могут обслуживаться из отдельной приоритетной очереди.
+    """
+
+    def __init__(self, key_pool: ApiKeyPool, per_key: int, per_user: int, max_wait: float):
+        self.key_pool = key_pool
+        self.per_key = per_key
+        self.per_user = per_user
+        self.max_wait = max_wait
+        self.active = 0
+        self._active_by_user = {}
+        # Две очереди (приоритетная и обычная): user_id -> deque ожидающих, порядок пользователей — круговой
+        self._lanes = (OrderedDict(), OrderedDict())
+        self._service_time = 15.0  # Скользящее среднее времени обработки запроса, сек.
+
+    @property
+    def capacity(self) -> int:
+        return max(1, self.key_pool.healthy_count * self.per_key)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for lane in self._lanes for waiters in lane.values())
+
+    def _can_start(self, user_id: int) -> bool:
+        return self.active < self.capacity and self._active_by_user.get(user_id, 0) < self.per_user
+
+    def _start(self, user_id: int) -> None:
+        self.active += 1
+        self._active_by_user[user_id] = self._active_by_user.get(user_id, 0) + 1
+
+    def _finish(self, user_id: int, started_at: float) -> None:
+        self.active -= 1
+        left = self._active_by_user[user_id] - 1
+        if left:
+            self._active_by_user[user_id] = left
+        else:
+            del self._active_by_user[user_id]
+        self._service_time = 0.8 * self._service_time + 0.2 * (time.monotonic() - started_at)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Запускает ожидающие запросы, пока есть свободные места, обходя пользователей по кругу."""
+        for lane in self._lanes:
+            progress = True
+            while progress and self.active < self.capacity:
+                progress = False
+                for user_id in list(lane):
+                    if not self._can_start(user_id):
+                        continue
+                    waiters = lane[user_id]
+                    waiter = waiters.popleft()
+                    if waiters:
+                        lane.move_to_end(user_id)
+                    else:
+                        del lane[user_id]
+                    if waiter.future.done():
+                        progress = True
+                        break
+                    self._start(user_id)
+                    waiter.future.set_result(None)
+                    progress = True
+                    break
+
+    def _estimate(self, user_id: int, lane_index: int) -> tuple:
+        """Приблизительная позиция в очереди и время ожидания в секундах."""
+        lane = self._lanes[lane_index]
+        own = len(lane.get(user_id, ()))
+        position = own + sum(min(len(waiters), own) for other, waiters in lane.items() if other != user_id)
+        if lane_index == 1:
+            position += sum(len(waiters) for waiters in self._lanes[0].values())
+        eta = position * self._service_time / self.capacity
+        return position, eta
+
+    def _remove(self, waiter: AdmissionWaiter, lane_index: int) -> None:
+        lane = self._lanes[lane_index]
+        waiters = lane.get(waiter.user_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del lane[waiter.user_id]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: int, priority: bool = False, on_queued=None):
+        """
+        Ждёт своей очереди и удерживает место на время запроса.
+        on_queued(position, eta) вызывается, если запросу пришлось встать в очередь.
+        """
+        lane_index = 0 if priority else 1
+        if self._can_start(user_id) and not self.queued:
+            self._start(user_id)
+        else:
+            waiter = AdmissionWaiter(user_id, asyncio.get_running_loop().create_future(), time.monotonic())
+            self._lanes[lane_index].setdefault(user_id, deque()).append(waiter)
+            position, eta = self._estimate(user_id, lane_index)
+            self._dispatch()
+            try:
+                # Уведомление — внутри try: если его отменят, место в очереди освобождается как и при ожидании
+                if not waiter.future.done():
+                    LOGGER.info("Запрос пользователя %s в очереди: позиция %s, ожидание ~%.0f с.", user_id, position, eta)
+                    if on_queued is not None:
+                        try:
+                            await on_queued(position, eta)
+                        except Exception as e:
+                            LOGGER.warning("Не удалось сообщить пользователю %s о месте в очереди: %s", user_id, e)
+                await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.max_wait)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # Место уже выделено — освобождаем его
+                    self._finish(user_id, time.monotonic())
+                else:
+                    waiter.future.cancel()
+                    self._remove(waiter, lane_index)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise AdmissionRejected(f"запрос ждал в очереди дольше {self.max_wait:.0f} с") from e
+                raise
+
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self._finish(user_id, started_at)
+
+
+ADMISSION = AdmissionScheduler(GEMINI_KEY_POOL, ADMISSION_PER_KEY, ADMISSION_PER_USER, ADMISSION_MAX_WAIT)
+
+# --- Кэш ответов ---
+
+# Ответы-ошибки не кэшируются
+GEMINI_ERROR_MESSAGES = {
+    GEMINI_BAD_REQUEST_MESSAGE, GEMINI_UNKNOWN_ERROR_MESSAGE, GEMINI_FAILED_MESSAGE, "Не удалось получить ответ.",
+}
+
+def response_cache_key(response_format: str, content: dict, images: list, history: list) -> str:
+    """
+    Ключ кэша ответов: нормализованный текст запроса, хэши изображений, формат ответа и модель.
+    Для запросов без вложений в ключ входит и история диалога: короткие уточнения вроде
+    «объясни подробнее» без контекста означают разное.
+    """
+    texts = [" ".join(part["text"].lower().split()) for part in content["parts"] if "text" in part]
+    image_keys = [image.phash if RESPONSE_CACHE_PERCEPTUAL and image.phash else image.digest for image in images]
+    key_data = [GEMINI_MODEL, response_format, texts, image_keys]
+    if not images:
+        key_data.append(history)
+    return hashlib.sha256(json.dumps(key_data, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов Gemini: LRU в памяти с ограничением по объёму
+    и необязательный дисковый уровень в SQLite. У каждой записи есть срок жизни.
+    Счётчики попаданий и промахов хранятся в stats.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int, path: str = "", disk_max_bytes: int = 0):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.path = path
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()  # ключ -> (ответ, время истечения, размер)
+        self._memory_bytes = 0
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache") if path else None
+        self._puts_since_trim = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _open_sync(self) -> None:
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        # Как и в Storage: файл кэша общий для рабочих процессов, поэтому ожидание блокировки задаётся первым
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_expiry ON responses (expires_at)")
+
+    async def open(self) -> None:
+        if self.path and self._conn is None:
+            await self._run(self._open_sync)
+            LOGGER.info("Дисковый кэш ответов %s открыт.", self.path)
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old:
+            self._memory_bytes -= old[2]
+        self._memory[key] = (value, expires_at, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+            self.stats["evictions"] += 1
+
+    def _disk_get_sync(self, key: str, now: float):
+        row = self._conn.execute(
+            "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        return row
+
+    def _disk_put_sync(self, key: str, value: str, size: int, expires_at: float, trim: bool) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, expires_at) VALUES (?, ?, ?, ?)",
+            (key, value, size, expires_at),
+        )
+        if trim:
+            self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.disk_max_bytes:
+                # Удаляем записи, которые истекают раньше всех, пока не уложимся в лимит
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY expires_at, key) - size AS freed_before "
+                    "FROM responses) WHERE freed_before < ?)",
+                    (total - self.disk_max_bytes,),
+                )
+
+    async def get(self, key: str):
+        """Возвращает ответ из кэша или None."""
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                CACHE_LOOKUPS.inc(result="memory_hit")
+                return entry[0]
+            self._memory.pop(key)
+            self._memory_bytes -= entry[2]
+        if self._conn is not None:
+            row = await self._run(self._disk_get_sync, key, now)
+            if row is not None:
+                self._remember(key, row[0], row[1])
+                self.stats["disk_hits"] += 1
+                CACHE_LOOKUPS.inc(result="disk_hit")
+                return row[0]
+        self.stats["misses"] += 1
+        CACHE_LOOKUPS.inc(result="miss")
+        return None
+
+    async def put(self, key: str, value: str) -> None:
+        """Сохраняет ответ, если это не сообщение об ошибке."""
+        if not value or value in GEMINI_ERROR_MESSAGES:
+            return
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        if self._conn is not None:
+            self._puts_since_trim += 1
+            trim = self._puts_since_trim >= 100
+            if trim:
+                self._puts_since_trim = 0
+            try:
+                await self._run(self._disk_put_sync, key, value, len(value.encode("utf-8")), expires_at, trim)
+            except sqlite3.Error as e:
+                LOGGER.error("Не удалось записать ответ в дисковый кэш: %s", e)
+
+
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_PATH, RESPONSE_CACHE_DISK_MAX_BYTES)
+
+class SingleFlight:
+    """
+    Объединение одновременных одинаковых запросов: пока запрос с данным ключом выполняется,
+    остальные вызовы с тем же ключом не создают новый, а ждут его результата.
+    Отмена одного из ожидающих не прерывает общий запрос; он отменяется, только когда ждать его некому.
+    """
+
+    def __init__(self):
+        self._calls = {}  # ключ -> [задача, число ожидающих]
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, factory) -> tuple:
+        """
+        Выполняет factory() один раз на все одновременные вызовы с ключом key.
+        Возвращает (результат, shared), где shared=True, если результат получен от чужого запроса.
+        """
+        call = self._calls.get(key)
+        shared = call is not None
+        if call is None:
+            call = [asyncio.create_task(factory()), 0]
+            self._calls[key] = call
+            call[0].add_done_callback(lambda _: self._calls.pop(key, None) if self._calls.get(key) is call else None)
+        else:
+            LOGGER.info("Такой же запрос уже выполняется, ожидаю его результат.")
+
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0]), shared
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                call[0].cancel()
+
+
+GEMINI_SINGLEFLIGHT = SingleFlight()
+
+async def generate_cached(cache_key: str, payload: dict, slot=None) -> str:
+    """
+    Возвращает ответ из кэша или запрашивает его у Gemini и кэширует.
+    Одновременные одинаковые запросы выполняются одним обращением к Gemini.
+    slot — место в очереди ADMISSION; занимается только при реальном обращении к Gemini.
+    """
+    cached = await RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        LOGGER.info("Ответ найден в кэше.")
+        return cached
+
+    async def produce() -> str:
+        async with slot or contextlib.nullcontext():
+            response = await call_gemini_api(payload)
+        await RESPONSE_CACHE.put(cache_key, response)
+        return response
+
+    response, _ = await GEMINI_SINGLEFLIGHT.do(cache_key, produce)
+    return response
+
+async def iterate_text(text: str):
+    """Отдаёт готовый текст как поток из одной части (для ответов из кэша)."""
+    yield text
+
+# --- Текстовые ответы ---
+
+# Виды токенов конвертера: текст, открывающий тег Telegram, закрывающий тег Telegram
+TOKEN_TEXT, TOKEN_OPEN, TOKEN_CLOSE = range(3)
+
+# Теги, которые Telegram понимает в режиме HTML (с заменой синонимов)
+TELEGRAM_INLINE_TAGS = {
+    "b": "b", "strong": "b", "i": "i", "em": "i", "u": "u", "ins": "u",
+    "s": "s", "strike": "s", "del": "s", "code": "code", "pre": "pre",
+    "blockquote": "blockquote", "tg-spoiler": "tg-spoiler",
+}
+HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+BLOCK_TAGS = {"p", "div", "section", "article", "header", "footer", "main", "table", "tr", "li", "hr", "pre", "blockquote"}
+SKIPPED_TAGS = {"style", "script", "title", "template", "noscript"} # Содержимое этих тегов не показывается
+WHITESPACE_RE = re.compile(r"\s+")
 
-**IMPORTANT:** You must generate **ONLY** JSON. No other characters or text.
 
-**Instructions:**
-- The JSON should be an array of objects.
-- Each object in the array represents a single slide.
-- Each object must have two keys:
-    - `"title"`: A string for the slide's title.
-    - `"points"`: An array of strings with the main points or bullet points for that slide.
+class TelegramHTMLConverter(HTMLParser):
+    """
+    Однопроходный перевод HTML-ответа модели в разметку Telegram: заголовки и <strong> становятся <b>,
+    списки — строками с маркерами, блоки — переводами строк; содержимое <style> и <script> отбрасывается.
+    Результат — список токенов (вид, значение, закрывающий тег) для split_telegram_html.
+    """
 
-**Example of the expected JSON structure:**
-[
-  {
-    "title": "Slide 1 Title",
-    "points": [
-      "Point 1",
-      "Point 2",
-      "Point 3"
-    ]
-  },
-  {
-    "title": "Slide 2 Title",
-    "points": [
-      "Another point",
-      "Yet another point"
-    ]
-  }
-]
-"""
-# --- Функции API и вспомогательные функции ---
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tokens = []
+        self._open = []  # (тег HTML, закрывающий тег Telegram или None)
+        self._lists = []  # номер последнего пункта для <ol>, None для <ul>
+        self._skip = 0
+        self._pre = 0
+        self._newlines = 2  # сколько переводов строки в конце вывода; в начале текста отступ не нужен
 
-async def get_next_api_key():
-    """Возвращает следующий API-ключ из списка по кругу."""
-    global key_index
-    api_key = GEMINI_API_KEYS[key_index]
-    key_index = (key_index + 1) % len(GEMINI_API_KEYS)
-    LOGGER.info(f"Переключение на API ключ с индексом {key_index - 1}.")
-    return api_key
+    def _emit(self, text: str) -> None:
+        self.tokens.append((TOKEN_TEXT, text, None))
+        self._newlines = len(text) - len(text.rstrip("\n")) if text.endswith("\n") else 0
 
-async def call_gemini_api(payload: dict) -> str:
-    """Отправляет запрос к Gemini API и возвращает ответ."""
-    async with aiohttp.ClientSession() as session:
-        retries = 0
-        while retries < MAX_RETRIES:
-            api_key = await get_next_api_key()
-            api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={api_key}"
-            LOGGER.info(f"Попытка {retries + 1}/{MAX_RETRIES} с API ключом {key_index}.")
-            LOGGER.debug(f"Payload для Gemini API: {json.dumps(payload, indent=2)}")
-            try:
-                async with session.post(api_url, json=payload, timeout=300.0) as response:
-                    LOGGER.info(f"Ответ от Gemini API: HTTP {response.status}")
-                    if response.status == 400:
-                        error_text = await response.text()
-                        if "API key not valid" in error_text:
-                            LOGGER.error(f"Неверный API ключ: {api_key}. Переключаюсь на следующий.")
-                            retries += 1
-                            continue
-                        else:
-                            LOGGER.error(f"HTTP 400 Bad Request. Details: {error_text}")
-                            return "Извините, этот тип файла не поддерживается или запрос неверно сформирован."
-                    
-                    response.raise_for_status()
-                    result = await response.json()
-                    text_content = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', 'Не удалось получить ответ.')
-                    LOGGER.info("Успешный ответ от Gemini API.")
-                    return text_content
-            except aiohttp.ClientResponseError as e:
-                LOGGER.error(f"HTTP error during Gemini API request: {e.status} - {e.message}")
-                if e.status == 429:
-                    LOGGER.warning("Rate limit exceeded for Gemini API. Switching to next key...")
-                    retries += 1
-                else:
-                    retries += 1
-                    await asyncio.sleep(RETRY_DELAY * (2 ** retries))
-            except aiohttp.ClientError as e:
-                LOGGER.error(f"Network error during Gemini API request: {e}")
-                retries += 1
-                await asyncio.sleep(RETRY_DELAY * (2 ** retries))
-            except Exception as e:
-                LOGGER.error(f"Unknown error: {e}")
-                return "Извините, произошла ошибка."
-        LOGGER.error("Не удалось получить ответ от нейросети после нескольких попыток.")
-        return "Извините, не удалось получить ответ от нейросети после нескольких попыток."
+    def _newline(self, count: int = 1) -> None:
+        if self._skip or self._newlines >= count:
+            return
+        last = self.tokens[-1] if self.tokens else None
+        if last is not None and last[0] == TOKEN_TEXT and last[1].endswith(" "):
+            self.tokens[-1] = (TOKEN_TEXT, last[1].rstrip(" "), None)
+        self._emit("\n" * (count - self._newlines))
 
-async def send_html_file(update: Update, html_code: str):
-    """Creates and sends an HTML file from the generated code."""
-    LOGGER.info("Начало отправки HTML-файла.")
-    try:
-        file_size_bytes = len(html_code.encode('utf-8'))
-        LOGGER.info(f"Размер генерируемого HTML-файла: {file_size_bytes} байт.")
-        if file_size_bytes > 50 * 1024 * 1024:
-            await update.message.reply_text("Извините, сгенерированный файл слишком большой для отправки в Telegram.")
-            LOGGER.warning(f"Файл слишком большой для отправки: {file_size_bytes} байт.")
+    def _open_tag(self, tag: str, name: str = None, opening: str = None) -> None:
+        closing = f"</{name}>" if name else None
+        self._open.append((tag, closing))
+        if name:
+            self.tokens.append((TOKEN_OPEN, opening or f"<{name}>", closing))
+            if name == "pre":
+                self._pre += 1
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip += 1
+            return
+        if self._skip:
             return
+        if tag in HEADING_TAGS:
+            self._newline(2)
+            self._open_tag(tag, None if self._pre else "b")
+        elif tag in TELEGRAM_INLINE_TAGS:
+            if tag in BLOCK_TAGS:
+                self._newline(1)
+            # Внутри <pre> Telegram не допускает другой разметки
+            self._open_tag(tag, None if self._pre else TELEGRAM_INLINE_TAGS[tag])
+        elif tag == "a":
+            href = dict(attrs).get("href") or ""
+            if href.startswith(("http://", "https://", "tg://")) and not self._pre:
+                self._open_tag(tag, "a", f'<a href="{html.escape(href)}">')
+            else:
+                self._open_tag(tag)
+        elif tag in ("ul", "ol"):
+            self._newline(1)
+            self._lists.append(0 if tag == "ol" else None)
+        elif tag == "li":
+            self._newline(1)
+            indent = "  " * max(len(self._lists) - 1, 0)
+            if self._lists and self._lists[-1] is not None:
+                self._lists[-1] += 1
+                self._emit(f"{indent}{self._lists[-1]}. ")
+            else:
+                self._emit(f"{indent}• ")
+        elif tag == "br":
+            self._emit("\n")
+            self._newlines = min(self._newlines + 1, 2) if self._newlines else 1
+        elif tag in ("td", "th"):
+            if not self._newlines:
+                self._emit(" | ")
+        elif tag == "sup":
+            self._emit("^")
+        elif tag in BLOCK_TAGS:
+            self._newline(2 if tag == "p" else 1)
 
-        await update.message.reply_document(
-            document=html_code.encode('utf-8'),
-            filename="solution.html"
-        )
-        LOGGER.info(f"HTML-файл успешно отправлен пользователю {update.effective_user.id}")
-    except BadRequest as e:
-        if "too long" in str(e).lower():
-            await update.message.reply_text("Извините, сгенерированный файл слишком большой для отправки в Telegram. Пожалуйста, попробуйте сформулировать запрос более кратко.")
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self._skip = max(self._skip - 1, 0)
+            return
+        if self._skip:
+            return
+        # Закрываем тег вместе со всеми незакрытыми внутри него (модель не всегда пишет корректный HTML)
+        if any(open_tag == tag for open_tag, _ in self._open):
+            while True:
+                open_tag, closing = self._open.pop()
+                if closing:
+                    self.tokens.append((TOKEN_CLOSE, closing, None))
+                    if closing == "</pre>":
+                        self._pre -= 1
+                if open_tag == tag:
+                    break
+        if tag in HEADING_TAGS:
+            self._newline(2)
+        elif tag in ("ul", "ol"):
+            if self._lists:
+                self._lists.pop()
+            self._newline(1)
+        elif tag in BLOCK_TAGS:
+            self._newline(2 if tag == "p" else 1)
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if not self._pre:
+            data = WHITESPACE_RE.sub(" ", data)
+            if self._newlines:
+                data = data.lstrip(" ")
+        if data:
+            self._emit(data)
+
+    def finish(self) -> list:
+        """Закрывает оставшиеся открытыми теги и возвращает токены."""
+        while self._open:
+            _, closing = self._open.pop()
+            if closing:
+                self.tokens.append((TOKEN_CLOSE, closing, None))
+        return self.tokens
+
+
+def split_telegram_html(tokens: list, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """
+    Собирает из токенов сообщения не длиннее limit видимых символов (так считает Telegram),
+    по возможности разрывая текст по переводу строки или пробелу. На границе сообщения открытые теги
+    закрываются и открываются заново в следующем, поэтому разметка каждой части корректна.
+    """
+    pieces = []
+    parts = []
+    stack = []  # (открывающий, закрывающий) теги, открытые в текущем месте
+    size = 0
+    visible = False
+    fresh = 0  # Сколько открывающих тегов в конце parts ещё без текста
+    at_break = False  # Текст части кончается пробелом или переводом строки
+
+    def flush() -> None:
+        nonlocal size, visible, fresh
+        if visible:
+            # Теги, открытые перед самым разрывом, в эту часть не попадают — они откроются в следующей
+            emitted = len(stack) - fresh
+            del parts[len(parts) - fresh:]
+            parts.extend(closing for _, closing in reversed(stack[:emitted]))
+            pieces.append("".join(parts))
+        parts.clear()
+        parts.extend(opening for opening, _ in stack)
+        size = 0
+        visible = False
+        fresh = len(stack)
+
+    for kind, value, closing in tokens:
+        if kind == TOKEN_OPEN:
+            stack.append((value, closing))
+            parts.append(value)
+            fresh += 1
+        elif kind == TOKEN_CLOSE:
+            stack.pop()
+            if fresh:
+                # Пустой элемент не выводим
+                parts.pop()
+                fresh -= 1
+            else:
+                parts.append(value)
         else:
-            LOGGER.error(f"Ошибка при отправке HTML-файла: {e}")
-            await update.message.reply_text("Извините, произошла ошибка при отправке файла.")
-    except Exception as e:
-        LOGGER.error(f"Ошибка при отправке HTML-файла: {e}")
-        await update.message.reply_text("Извините, произошла ошибка при отправке файла.")
+            while len(value) > limit - size:
+                room = limit - size
+                cut = value.rfind("\n", 0, room + 1)
+                if cut <= 0:
+                    cut = value.rfind(" ", 0, room + 1)
+                if cut <= 0 and size and (at_break or value[0] in "\n "):
+                    cut = 0  # Разрыв перед этим текстом не разрезает слово
+                elif cut <= 0:
+                    cut = room
+                if cut > 0:
+                    parts.append(html.escape(value[:cut], quote=False))
+                    visible = visible or not value[:cut].isspace()
+                    fresh = 0
+                flush()
+                value = value[cut:].lstrip("\n ")
+            if value:
+                parts.append(html.escape(value, quote=False))
+                size += len(value)
+                visible = visible or not value.isspace()
+                fresh = 0
+                at_break = value[-1] in "\n "
+    flush()
+    return pieces
 
-async def create_and_send_pptx_file(update: Update, slides_data: list):
+def html_to_telegram(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT, final: bool = True) -> list:
     """
-    Создает PowerPoint-презентацию из JSON-данных с улучшенным дизайном.
-    Использует новые настройки для цветов, шрифтов и макета.
+    Переводит HTML-ответ в сообщения Telegram (parse_mode=HTML) за один проход.
+    final=False — для незаконченного потока: оборванный в конце тег не выводится как текст.
     """
-    LOGGER.info("Начало создания и отправки PPTX-файла.")
-    prs = Presentation()
+    converter = TelegramHTMLConverter()
+    converter.feed(text)
+    if final:
+        converter.close()
+    return split_telegram_html(converter.finish(), limit)
 
-    # Настройка цветов и стилей
-    BACKGROUND_COLOR = RGBColor(245, 245, 245)
-    PRIMARY_COLOR = RGBColor(41, 128, 185) # Синий
-    SECONDARY_COLOR = RGBColor(52, 73, 94) # Темно-серый
-    ACCENT_COLOR = RGBColor(52, 152, 219) # Голубой
+async def send_streamed_text(update: Update, placeholder, text_stream) -> str:
+    """
+    Отправляет ответ в текстовом режиме по мере генерации: редактирует сообщение-заглушку
+    не чаще STREAM_EDIT_INTERVAL и начинает новое сообщение, когда текст превышает 4096 символов.
+    Возвращает полный текст ответа.
+    """
+    messages = [placeholder]
+    shown = [placeholder.text]
+    chunks = []
 
-    for slide_info in slides_data:
-        LOGGER.debug(f"Обработка слайда: {slide_info.get('title', 'Без заголовка')}")
-        # Выбор макета для слайда с заголовком и списком
-        slide_layout = prs.slide_layouts[1]
-        slide = prs.slides.add_slide(slide_layout)
-        
-        # Настройка фона слайда
-        fill = slide.background.fill
-        fill.solid()
-        fill.fore_color.rgb = BACKGROUND_COLOR
-
-        # Добавление фигуры-акцента вверху слайда
-        left = top = Inches(0)
-        width = prs.slide_width
-        height = Inches(0.2)
-        accent_shape = slide.shapes.add_shape(MSO_SHAPE.RECTANGLE, left, top, width, height)
-        accent_shape.fill.solid()
-        accent_shape.fill.fore_color.rgb = ACCENT_COLOR
-        accent_shape.line.fill.background()
-        
-        # Добавление тени для акцентной фигуры
-        accent_shape.shadow.visible = True
-        accent_shape.shadow.offset_x = Inches(0)
-        accent_shape.shadow.offset_y = Inches(0.1)
-
-        # Работа с заголовком
-        title_shape = slide.shapes.title
-        title_shape.text = slide_info.get("title", "Без заголовка")
-        title_tf = title_shape.text_frame
-        
-        # Настройка шрифта и выравнивания заголовка
-        title_para = title_tf.paragraphs[0]
-        title_para.font.name = 'Arial'
-        title_para.font.size = Pt(36)
-        title_para.font.bold = True
-        title_para.font.color.rgb = PRIMARY_COLOR
-        title_para.alignment = PP_ALIGN.CENTER
-        
-        # Улучшенное позиционирование и размер заголовка
-        title_shape.top = Inches(0.5)
-        title_shape.height = Inches(1.5)
-        title_shape.width = prs.slide_width - Inches(2)
-        title_shape.left = Inches(1)
-
-        # Работа с основным текстом
-        if "points" in slide_info and isinstance(slide_info["points"], list):
-            content_shape = slide.placeholders[1]
-            content_tf = content_shape.text_frame
-            content_tf.clear()
-            content_tf.word_wrap = True
-            
-            for point in slide_info["points"]:
-                p = content_tf.add_paragraph()
-                p.text = point
-                p.level = 0
-                p.font.name = 'Arial'
-                p.font.size = Pt(20)
-                p.font.color.rgb = SECONDARY_COLOR
-                p.alignment = PP_ALIGN.LEFT
-                p.space_after = Pt(10)
-        
-    # Сохранение во временный файл
-    with tempfile.NamedTemporaryFile(suffix=".pptx", delete=False) as temp_file:
-        prs.save(temp_file.name)
-        filepath = temp_file.name
-    
-    # Отправка файла
+    async def render(final: bool = False) -> None:
+        pieces = html_to_telegram("".join(chunks), final=final)
+        for i, piece in enumerate(pieces):
+            if i < len(messages):
+                if shown[i] != piece:
+                    await messages[i].edit_text(piece, parse_mode=ParseMode.HTML)
+                    shown[i] = piece
+            else:
+                messages.append(await update.message.reply_text(piece, parse_mode=ParseMode.HTML))
+                shown.append(piece)
+
+    next_edit = 0.0
+    async for chunk in text_stream:
+        chunks.append(chunk)
+        if time.monotonic() < next_edit:
+            continue
+        try:
+            await render()
+            next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        except RetryAfter as e:
+            next_edit = time.monotonic() + e.retry_after
+        except BadRequest as e:
+            # Например, «Message is not modified» — следующая попытка будет при новом фрагменте
+            LOGGER.debug("Не удалось обновить сообщение при потоковой выдаче: %s", e)
+
+    if not "".join(chunks).strip():
+        chunks.append("Не удалось получить ответ.")
     try:
-        await update.message.reply_document(
-            document=open(filepath, 'rb'),
-            filename="presentation.pptx"
-        )
-        LOGGER.info(f"Presentation file sent successfully to {update.effective_user.id}")
-    except Exception as e:
-        LOGGER.error(f"Error sending PowerPoint file: {e}")
-        await update.message.reply_text("Извините, произошла ошибка при отправке файла презентации.")
-    finally:
-        # Удаление временного файла
-        os.remove(filepath)
-        LOGGER.info(f"Временный файл {filepath} удален.")
+        await render(final=True)
+    except RetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        await render(final=True)
+    return "".join(chunks)
 
 # --- Обработчики команд и сообщений ---
 
@@ -388,9 +3100,8 @@ async def create_and_send_pptx_file(update: Update, slides_data: list):
 async def start_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет приветственное сообщение с меню в виде кнопок."""
     user_id = update.effective_user.id
-    LOGGER.info(f"Пользователь {user_id} отправил команду /start.")
-    if user_id in user_history:
-        del user_history[user_id]
+    LOGGER.info("Пользователь %s отправил команду /start.", user_id)
+    await STORAGE.clear_history(user_id)
     
     welcome_message = """
 Привет! Я - твой личный помощник для учебы.
@@ -413,13 +3124,13 @@ async def start_command_handler(update: Update, context: ContextTypes.DEFAULT_TY
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await update.message.reply_text(welcome_message, reply_markup=reply_markup)
-    LOGGER.info(f"Пользователь {user_id} начал чат.")
+    LOGGER.info("Пользователь %s начал чат.", user_id)
 
 # НОВОЕ: Обработчик команды /donate
 async def donate_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет меню для доната."""
     user_id = update.effective_user.id
-    LOGGER.info(f"Пользователь {user_id} отправил команду /donate.")
+    LOGGER.info("Пользователь %s отправил команду /donate.", user_id)
     
     message = "Спасибо за вашу поддержку! Выберите, сколько звёзд вы хотите купить. За каждую звезду вы получите 10 ответов."
     keyboard = [
@@ -434,30 +3145,29 @@ async def donate_command_handler(update: Update, context: ContextTypes.DEFAULT_T
         await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
     else:
         await update.message.reply_text(message, reply_markup=reply_markup)
-    LOGGER.info(f"Меню доната отправлено пользователю {user_id}.")
+    LOGGER.info("Меню доната отправлено пользователю %s.", user_id)
 
 
 # Обработчик команды /reset
 async def reset_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Очищает историю диалога для текущего пользователя."""
     user_id = update.effective_user.id
-    LOGGER.info(f"Пользователь {user_id} отправил команду /reset.")
-    if user_id in user_history:
-        del user_history[user_id]
-        LOGGER.info(f"История диалога для пользователя {user_id} очищена.")
+    LOGGER.info("Пользователь %s отправил команду /reset.", user_id)
+    await STORAGE.clear_history(user_id)
+    LOGGER.info("История диалога для пользователя %s очищена.", user_id)
     await update.message.reply_text("Диалог сброшен. Можете начинать новую беседу.")
 
 # НОВАЯ функция для тестирования: выдает кредиты
 async def get_stars_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Добавляет 5 кредитов для тестирования."""
     user_id = update.effective_user.id
-    LOGGER.info(f"Пользователь {user_id} отправил команду /get_stars.")
+    LOGGER.info("Пользователь %s отправил команду /get_stars.", user_id)
     if IS_TEST_MODE:
-        user_settings[user_id]["html_credits"] += 5
-        LOGGER.info(f"Добавлено 5 кредитов пользователю {user_id}. Текущий баланс: {user_settings[user_id]['html_credits']}")
+        balance = await STORAGE.add_credits(user_id, 5)
+        LOGGER.info("Добавлено 5 кредитов пользователю %s. Текущий баланс: %s", user_id, balance)
         await update.message.reply_text(
             f"✅ **Режим тестирования:** Вам добавлено 5 кредитов. Теперь вы можете генерировать HTML-ответы."
-            f"\n\n**Текущий баланс:** {user_settings[user_id]['html_credits']} кредитов."
+            f"\n\n**Текущий баланс:** {balance} кредитов."
         )
     else:
         LOGGER.info("Команда /get_stars была вызвана в не-тестовом режиме.")
@@ -469,13 +3179,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    LOGGER.info(f"Пользователь {user_id} нажал кнопку: {query.data}")
+    LOGGER.info("Пользователь %s нажал кнопку: %s", user_id, query.data)
 
     if query.data == 'start_chat':
         await query.edit_message_text("Отлично, можете присылать ваши задания. Чтобы начать заново, используйте команду /start.")
     elif query.data == 'settings':
         keyboard = [
             [InlineKeyboardButton("Способ отправки", callback_data='settings_send_method')],
+            [InlineKeyboardButton("Оформление презентаций", callback_data='settings_theme')],
             [InlineKeyboardButton("Купить ответы (10 за 1⭐️)", callback_data='donate')], # Изменено, ведёт в новое меню доната
             [InlineKeyboardButton("Назад", callback_data='start_chat')]
         ]
@@ -485,85 +3196,187 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await donate_command_handler(update, context) # Новый вызов
     elif query.data.startswith('buy_stars_'):
         stars_cost = int(query.data.split('_')[2])
-        LOGGER.info(f"Пользователь {user_id} инициировал покупку {stars_cost} звёзд.")
+        LOGGER.info("Пользователь %s инициировал покупку %s звёзд.", user_id, stars_cost)
         await send_invoice(update, context, stars_cost)
     elif query.data == 'settings_send_method':
         keyboard = [
             [InlineKeyboardButton("HTML (файл)", callback_data='format_html')],
+            *([[InlineKeyboardButton("Картинка (фото)", callback_data='format_image')]] if HTML_RENDERER.available else []),
             [InlineKeyboardButton("Презентация (файл)", callback_data='format_presentation')],
             [InlineKeyboardButton("Текст (сообщение)", callback_data='format_text')],
             [InlineKeyboardButton("Назад", callback_data='settings')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text("Выберите формат ответа:", reply_markup=reply_markup)
+    elif query.data == 'settings_theme':
+        settings = await STORAGE.get_settings(user_id)
+        keyboard = [
+            [InlineKeyboardButton(("✅ " if name == settings["pptx_theme"] else "") + template.title, callback_data=f'theme_{name}')]
+            for name, template in PPTX_TEMPLATES.items()
+        ]
+        keyboard.append([InlineKeyboardButton("Назад", callback_data='settings')])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text("Выберите оформление презентаций:", reply_markup=reply_markup)
+    elif query.data.startswith('theme_'):
+        theme_name = query.data[len('theme_'):]
+        if theme_name not in PPTX_TEMPLATES:
+            await query.edit_message_text("Это оформление больше недоступно. Выберите другое в /settings.")
+            return
+        await STORAGE.set_setting(user_id, "pptx_theme", theme_name)
+        LOGGER.info("Оформление презентаций для пользователя %s изменено на: %s", user_id, theme_name)
+        await query.edit_message_text(f"Отлично! Презентации будут в оформлении «{PPTX_TEMPLATES[theme_name].title}».")
     elif query.data.startswith('format_'):
         response_format = query.data.split('_')[1]
-        user_settings[user_id]["response_format"] = response_format
-        LOGGER.info(f"Формат ответа для пользователя {user_id} изменен на: {response_format}")
+        await STORAGE.set_setting(user_id, "response_format", response_format)
+        LOGGER.info("Формат ответа для пользователя %s изменен на: %s", user_id, response_format)
         await query.edit_message_text(f"Отлично! Теперь я буду отвечать в формате **{response_format.upper()}**. Чтобы изменить, зайдите в /settings.")
 
-async def process_media_group(media_group_id, user_id, context):
+async def prepare_album_photo(message, limiter: asyncio.Semaphore) -> PreparedImage:
     """
-    Ждет небольшое время, чтобы убедиться, что все сообщения из медиагруппы получены,
-    затем обрабатывает их.
+    Скачивает и подготавливает фото из альбома (запускается сразу при получении сообщения).
+    limiter ограничивает число одновременных скачиваний в одном альбоме.
     """
-    LOGGER.info(f"Получена медиагруппа с ID: {media_group_id} от пользователя {user_id}. Ожидание...")
-    await asyncio.sleep(2) # Ждем 2 секунды, чтобы собрать все фото
-    
-    if media_group_id not in media_groups:
-        LOGGER.warning(f"Медиагруппа {media_group_id} уже была обработана или не найдена.")
-        return # Если медиагруппа уже обработана, выходим
+    async with limiter:
+        photo_content = await download_photo(message.photo)
+    return await prepare_image(photo_content)
 
-    messages = media_groups.pop(media_group_id)["messages"]
-    LOGGER.info(f"Собрано {len(messages)} сообщений из медиагруппы {media_group_id}. Начало обработки.")
-    
+
+@dataclass
+class MediaGroup:
+    """
+    Альбом, собираемый из отдельных сообщений. Фото начинают скачиваться и обрабатываться
+    сразу по приходу, пока ожидаются остальные сообщения альбома.
+    """
+    user_id: int
+    updates: list = field(default_factory=list)
+    photos: list = field(default_factory=list) # Задачи prepare_album_photo (None для сообщений без фото)
+    started: float = field(default_factory=time.monotonic)
+    last_arrival: float = field(default_factory=time.monotonic)
+    max_gap: float = 0.0
+    arrived: asyncio.Event = field(default_factory=asyncio.Event)
+    task: asyncio.Task = None
+    closed: bool = False
+    limiter: asyncio.Semaphore = field(default_factory=lambda: asyncio.Semaphore(ALBUM_DOWNLOAD_CONCURRENCY))
+
+    def add(self, update: Update) -> None:
+        now = time.monotonic()
+        if self.updates:
+            self.max_gap = max(self.max_gap, now - self.last_arrival)
+        self.last_arrival = now
+        self.updates.append(update)
+        message = update.message
+        self.photos.append(asyncio.create_task(prepare_album_photo(message, self.limiter)) if message.photo else None)
+        self.arrived.set()
+
+    def quiet_period(self) -> float:
+        """Сколько ждать следующее фото: зависит от того, с какими интервалами приходили предыдущие."""
+        if len(self.updates) < 2:
+            return MEDIA_GROUP_FIRST_WAIT
+        return max(MEDIA_GROUP_MIN_WAIT, MEDIA_GROUP_GAP_FACTOR * self.max_gap)
+
+
+def sweep_media_groups() -> None:
+    """Забывает давно обработанные альбомы и удаляет альбомы, сбор которых прервался."""
+    now = time.monotonic()
+    for media_group_id, finished_at in list(processed_media_groups.items()):
+        if now - finished_at > MEDIA_GROUP_RETAIN:
+            del processed_media_groups[media_group_id]
+    for media_group_id, group in list(media_groups.items()):
+        if now - group.started > MEDIA_GROUP_MAX_WAIT + MEDIA_GROUP_RETAIN and (group.task is None or group.task.done()):
+            for photo in group.photos:
+                if photo is not None:
+                    photo.cancel()
+            del media_groups[media_group_id]
+
+async def collect_media_group(media_group_id, group: MediaGroup, context) -> None:
+    """
+    Ждёт, пока альбом перестанет пополняться (или наберёт MEDIA_GROUP_MAX_ITEMS фото,
+    или истечёт MEDIA_GROUP_MAX_WAIT), затем обрабатывает его.
+    """
+    LOGGER.info("Получена медиагруппа с ID: %s от пользователя %s. Ожидание...", media_group_id, group.user_id)
+    while len(group.updates) < MEDIA_GROUP_MAX_ITEMS:
+        now = time.monotonic()
+        deadline = min(group.last_arrival + group.quiet_period(), group.started + MEDIA_GROUP_MAX_WAIT)
+        if deadline <= now:
+            break
+        group.arrived.clear()
+        try:
+            await asyncio.wait_for(group.arrived.wait(), deadline - now)
+        except asyncio.TimeoutError:
+            break
+    group.closed = True
+    LOGGER.info(
+        "Собрано %s сообщений из медиагруппы %s за %.2f с. Начало обработки.",
+        len(group.updates), media_group_id, time.monotonic() - group.started,
+    )
+    try:
+        await process_media_group(group, context)
+    finally:
+        # Обработанный альбом с фото больше не нужен; для опоздавших фото запоминаем только его ID
+        media_groups.pop(media_group_id, None)
+        processed_media_groups[media_group_id] = time.monotonic()
+        for photo in group.photos:
+            if photo is not None:
+                photo.cancel()
+
+@REQUESTS_IN_FLIGHT.track()
+async def process_media_group(group: MediaGroup, context):
+    """Дожидается подготовки фото альбома и отправляет их в Gemini одним запросом."""
+    user_id = group.user_id
     await context.bot.send_message(user_id, "⌛ Обрабатываю ваш альбом...")
     
     content_parts = []
+    images = []
     caption = ""
-    
-    for msg in messages:
-        if msg.photo:
-            photo_file = await msg.photo[-1].get_file()
-            photo_content = io.BytesIO(await photo_file.download_as_bytearray())
-            try:
-                img = Image.open(photo_content)
-                img_rgb = img.convert("RGB")
-                buffer = io.BytesIO()
-                img_rgb.save(buffer, format="JPEG")
-                base64_encoded_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
-                content_parts.append({
-                    "inlineData": {
-                        "mimeType": "image/jpeg",
-                        "data": base64_encoded_image
-                    }
-                })
-            except Exception as e:
-                LOGGER.error(f"Ошибка при обработке изображения из медиагруппы: {e}")
-                continue
-            
-            if msg.caption:
-                caption = msg.caption
+    failed = []
+
+    # Фото уже скачиваются параллельно; собираем результаты в порядке сообщений альбома
+    items = sorted(
+        ((update, photo) for update, photo in zip(group.updates, group.photos) if photo is not None),
+        key=lambda item: item[0].message.message_id,
+    )
+    results = await asyncio.gather(*(photo for _, photo in items), return_exceptions=True)
+    for number, ((update, _), result) in enumerate(zip(items, results), start=1):
+        if isinstance(result, BaseException):
+            LOGGER.error("Не удалось обработать фото %s из медиагруппы: %r", number, result)
+            failed.append(number)
+            continue
+        images.append(result)
+        content_parts.append(result.as_part())
+        if update.message.caption:
+            caption = update.message.caption
+
+    if failed:
+        numbers = ", ".join(str(number) for number in failed)
+        if not images:
+            await context.bot.send_message(user_id, "Извините, не удалось обработать ни одного фото из альбома.")
+            return
+        await context.bot.send_message(user_id, f"⚠️ Не удалось обработать фото № {numbers} — они не учтены в ответе.")
     
     text_prompt = caption or "Реши эти задания."
     
     payload = {
+        "systemInstruction": system_instruction(DEVELOPER_PROMPT),
         "contents": [
             {
-                "parts": [
-                    {"text": DEVELOPER_PROMPT + "\n\n" + text_prompt},
-                ] + content_parts
+                "role": "user",
+                "parts": [{"text": text_prompt}] + content_parts
             }
         ],
         "generationConfig": {"temperature": 0.4}
     }
     
+    with STAGE_SECONDS.time(stage="payload_build"):
+        cache_key = response_cache_key("html", payload["contents"][-1], images, [])
+    REQUESTS_TOTAL.inc(format="album")
     try:
-        html_response = await call_gemini_api(payload)
-        await send_html_file(messages[0], html_response)
+        html_response = await generate_cached(cache_key, payload, ADMISSION.slot(user_id))
+        await send_html_file(group.updates[0], html_response)
+    except AdmissionRejected as e:
+        LOGGER.warning("Альбом пользователя %s отклонён: %s", user_id, e)
+        await context.bot.send_message(user_id, "Извините, сейчас слишком много запросов. Пожалуйста, попробуйте позже.")
     except Exception as e:
-        LOGGER.error(f"Ошибка при обработке медиагруппы: {e}")
+        LOGGER.error("Ошибка при обработке медиагруппы: %s", e)
         await context.bot.send_message(user_id, "Извините, произошла ошибка при обработке альбома.")
 
 # Изменено: теперь принимает stars_cost
@@ -588,80 +3401,88 @@ async def send_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE, stars
             need_name=False,
             need_shipping_address=False
         )
-        LOGGER.info(f"Счёт для оплаты {stars_cost} звёзд отправлен пользователю {user_id}")
+        LOGGER.info("Счёт для оплаты %s звёзд отправлен пользователю %s", stars_cost, user_id)
     except Exception as e:
-        LOGGER.error(f"Ошибка при отправке счёта: {e}")
+        LOGGER.error("Ошибка при отправке счёта: %s", e)
         await context.bot.send_message(user_id, "Извините, не удалось создать счёт для оплаты.")
 
 # НОВЫЙ обработчик для pre_checkout_query
 async def pre_checkout_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает pre-checkout запросы от Telegram."""
     query = update.pre_checkout_query
-    LOGGER.info(f"Получен pre_checkout_query от {query.from_user.id}. Payload: {query.invoice_payload}")
+    LOGGER.info("Получен pre_checkout_query от %s. Payload: %s", query.from_user.id, query.invoice_payload)
 
     # Проверяем, что payload начинается с нужного префикса
     if query.invoice_payload.startswith("html_purchase_"):
         await query.answer(ok=True)
-        LOGGER.info(f"Pre_checkout_query успешно подтвержден для пользователя {query.from_user.id}")
+        LOGGER.info("Pre_checkout_query успешно подтвержден для пользователя %s", query.from_user.id)
     else:
         await query.answer(ok=False, error_message="Извините, мы не можем обработать этот платёж.")
-        LOGGER.warning(f"Неизвестный payload в pre_checkout_query от {query.from_user.id}")
+        LOGGER.warning("Неизвестный payload в pre_checkout_query от %s", query.from_user.id)
 
 async def successful_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает успешную оплату и выдаёт "кредиты"."""
     user_id = update.effective_user.id
-    payload = update.effective_message.successful_payment.invoice_payload
+    payment = update.effective_message.successful_payment
+    payload = payment.invoice_payload
     
-    LOGGER.info(f"Получен успешный платёж от пользователя {user_id}. Payload: {payload}")
+    LOGGER.info("Получен успешный платёж от пользователя %s. Payload: %s", user_id, payload)
     
     if payload.startswith("html_purchase_"):
         try:
             stars_bought = int(payload.split('_')[2])
             credits_to_add = stars_bought * 10 # 10 ответов за каждую звезду
             
-            # Увеличиваем "баланс" пользователя
-            user_settings[user_id]["html_credits"] += credits_to_add
-            LOGGER.info(f"Баланс пользователя {user_id} увеличен на {credits_to_add}. Текущий баланс: {user_settings[user_id]['html_credits']}")
+            # Увеличиваем "баланс" пользователя (повторная доставка того же платежа не зачисляется)
+            balance = await STORAGE.add_credits(user_id, credits_to_add, charge_id=payment.telegram_payment_charge_id)
+            LOGGER.info("Баланс пользователя %s увеличен на %s. Текущий баланс: %s", user_id, credits_to_add, balance)
             
             await update.effective_message.reply_text(f"✅ Оплата прошла успешно! Вам зачислено {credits_to_add} кредитов. Теперь вы можете получить ответы в формате HTML. Пожалуйста, отправьте мне ваше задание.")
         except (IndexError, ValueError) as e:
-            LOGGER.error(f"Не удалось распарсить payload {payload}: {e}")
+            LOGGER.error("Не удалось распарсить payload %s: %s", payload, e)
             await update.effective_message.reply_text("Извините, произошла ошибка при зачислении кредитов. Пожалуйста, свяжитесь с администратором.")
 
+def history_user_turn(content: dict) -> dict:
+    """Сообщение пользователя для истории: текст сохраняется, изображения заменяются пометкой."""
+    parts = [part if "text" in part else {"text": "[изображение]"} for part in content["parts"]]
+    return {"role": "user", "parts": parts}
+
+@REQUESTS_IN_FLIGHT.track()
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Универсальный обработчик для текста, фото и файлов."""
     
     user_id = update.effective_user.id
-    LOGGER.info(f"Получено сообщение от пользователя {user_id}.")
+    LOGGER.info("Получено сообщение от пользователя %s.", user_id, extra=SAMPLED)
     
-    response_format = user_settings[user_id].get("response_format", "html")
+    settings = await STORAGE.get_settings(user_id)
+    response_format = settings["response_format"]
     
     if update.message.media_group_id:
         media_group_id = update.message.media_group_id
-        
-        if media_group_id not in media_groups:
-            media_groups[media_group_id] = {"messages": [], "task": None}
-        
-        media_groups[media_group_id]["messages"].append(update.message)
-        
-        if media_groups[media_group_id]["task"]:
-            media_groups[media_group_id]["task"].cancel()
-            
-        media_groups[media_group_id]["task"] = asyncio.create_task(
-            process_media_group(media_group_id, user_id, context)
-        )
+        sweep_media_groups()
+
+        group = media_groups.get(media_group_id)
+        if media_group_id in processed_media_groups:
+            LOGGER.warning("Сообщение пришло после обработки медиагруппы %s и пропущено.", media_group_id)
+        elif group is None:
+            group = media_groups[media_group_id] = MediaGroup(user_id)
+            group.add(update)
+            group.task = asyncio.create_task(collect_media_group(media_group_id, group, context))
+        elif group.closed or len(group.updates) >= MEDIA_GROUP_MAX_ITEMS:
+            LOGGER.warning("Сообщение пришло после обработки медиагруппы %s и пропущено.", media_group_id)
+        else:
+            group.add(update)
         return
 
-    # Проверяем, нужно ли обрабатывать как HTML-файл и есть ли "кредиты"
-    if response_format == "html":
-        credits = user_settings[user_id].get("html_credits", 0)
-        LOGGER.info(f"Пользователь {user_id} запросил HTML-формат. Текущий баланс: {credits}")
+    # Проверяем, нужно ли обрабатывать как HTML-файл (или картинку из него) и есть ли "кредиты"
+    if response_format in HTML_FORMATS:
+        LOGGER.info("Пользователь %s запросил HTML-формат. Текущий баланс: %s", user_id, settings['html_credits'])
         
-        # Этот блок кода проверяет, достаточно ли кредитов у пользователя для получения ответа.
-        # Если у пользователя 1 или более кредит, условие "credits <= 0" будет ложным,
-        # и бот продолжит работу. Если кредитов 0, бот попросит оплату.
-        if credits <= 0:
-            LOGGER.info(f"У пользователя {user_id} недостаточно кредитов. Отправка предложения о покупке.")
+        # Списываем 1 кредит атомарно перед началом генерации.
+        # Если кредитов нет, списание не выполняется и бот попросит оплату.
+        balance = await STORAGE.try_debit_credits(user_id, 1)
+        if balance is None:
+            LOGGER.info("У пользователя %s недостаточно кредитов. Отправка предложения о покупке.", user_id)
             await update.message.reply_text(
                 "Чтобы получить ответ в формате HTML, у вас должен быть как минимум 1 кредит. Вы можете купить их в меню: /donate.",
                 reply_markup=InlineKeyboardMarkup([
@@ -670,118 +3491,99 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        # Если "кредит" есть, уменьшаем его на 1 перед началом генерации
-        user_settings[user_id]["html_credits"] -= 1
-        LOGGER.info(f"1 кредит использован. Новый баланс для {user_id}: {user_settings[user_id]['html_credits']}")
-        await update.message.reply_text(f"⏳ Использую 1 «кредит». Осталось: {user_settings[user_id]['html_credits']}. Обрабатываю ваш запрос...")
+        CREDITS_SPENT.inc()
+        LOGGER.info("1 кредит использован. Новый баланс для %s: %s", user_id, balance)
+        await update.message.reply_text(f"⏳ Использую 1 «кредит». Осталось: {balance}. Обрабатываю ваш запрос...")
     else:
-        LOGGER.info(f"Пользователь {user_id} запросил формат: {response_format}. Обрабатываю запрос.")
-        await update.message.reply_text("⏳ Обрабатываю ваш запрос...")
+        LOGGER.info("Пользователь %s запросил формат: %s. Обрабатываю запрос.", user_id, response_format)
+        status_message = await update.message.reply_text("⏳ Обрабатываю ваш запрос...")
         
-    if user_id not in user_history:
-        user_history[user_id] = []
-        LOGGER.debug(f"Инициализирована новая история для пользователя {user_id}.")
+    # Системный промпт передаётся отдельно (systemInstruction), в contents — только диалог
+    contents = await STORAGE.get_history(user_id)
+    history = list(contents)
+    images = [] # Подготовленные изображения запроса (их хэши входят в ключ кэша ответов)
+    document_text = None # Большой документ: в запрос попадёт его конспект по частям (см. summarize_document)
 
-    while len(user_history[user_id]) >= MAX_HISTORY_MESSAGES:
-        user_history[user_id].pop(0)
-        LOGGER.debug("Удалено самое старое сообщение из истории диалога.")
-
-    contents = [{ "role": "user", "parts": [{ "text": DEVELOPER_PROMPT }]}]
-    for item in user_history[user_id]:
-        contents.append(item)
+    async def refund_credit() -> None:
+        if response_format in HTML_FORMATS:
+            await STORAGE.add_credits(user_id, 1)
+            CREDITS_REFUNDED.inc()
 
     if update.message.document:
         document = update.message.document
-        LOGGER.info(f"Получен документ от {user_id}: {document.file_name}, MIME-тип: {document.mime_type}")
+        LOGGER.info("Получен документ от %s: %s, MIME-тип: %s", user_id, document.file_name, document.mime_type)
         file_info = {
             'file_id': document.file_id,
-            'file_name': document.file_name,
-            'mime_type': document.mime_type
+            'file_name': document.file_name or "",
+            'mime_type': document.mime_type or ""
         }
-        file = await context.bot.get_file(file_info['file_id'])
-        file_content = await file.download_as_bytearray()
-        
+        is_pdf = file_info['mime_type'] == 'application/pdf' or file_info['file_name'].lower().endswith('.pdf')
+
         if file_info['mime_type'].startswith('image/'):
-            LOGGER.info(f"Документ идентифицирован как изображение. Размер: {len(file_content)} байт.")
+            with STAGE_SECONDS.time(stage="download"):
+                file = await context.bot.get_file(file_info['file_id'])
+                file_content = await file.download_as_bytearray()
+            LOGGER.info("Документ идентифицирован как изображение. Размер: %s байт.", len(file_content))
             try:
-                img = Image.open(io.BytesIO(file_content))
-                img_rgb = img.convert("RGB")
-                buffer = io.BytesIO()
-                img_rgb.save(buffer, format="JPEG")
-                base64_encoded_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
+                image = await prepare_image(file_content)
+                images.append(image)
                 text_prompt = update.message.caption if update.message.caption else "Проанализируй это изображение."
                 contents.append({
                     "role": "user",
-                    "parts": [
-                        {"text": text_prompt},
-                        {
-                            "inlineData": {
-                                "mimeType": "image/jpeg",
-                                "data": base64_encoded_image
-                            }
-                        }
-                    ]
+                    "parts": [{"text": text_prompt}, image.as_part()]
                 })
-            except Exception as e:
-                LOGGER.error(f"Ошибка при обработке изображения из документа: {e}")
+            except ImageProcessingError as e:
+                LOGGER.error("Ошибка при обработке изображения из документа: %s", e)
                 await update.message.reply_text("Извините, произошла ошибка при обработке изображения.")
                 return
         
-        elif file_info['mime_type'].startswith('text/') or file_info['file_name'].lower().endswith(('.py', '.txt', '.html', '.md')):
-            LOGGER.info(f"Документ идентифицирован как текстовый файл.")
+        elif is_pdf or file_info['mime_type'].startswith('text/') or file_info['file_name'].lower().endswith(DOCUMENT_TEXT_EXTENSIONS):
+            LOGGER.info("Документ идентифицирован как %s.", "PDF" if is_pdf else "текстовый файл")
             try:
-                decoded_content = file_content.decode('utf-8')
-                text_prompt = update.message.caption if update.message.caption else ""
+                document_text = await read_document(document, is_pdf)
+            except DocumentError as e:
+                LOGGER.warning("Не удалось прочитать документ %s: %s", file_info['file_name'], e)
+                await refund_credit()
+                await update.message.reply_text(str(e))
+                return
+            text_prompt = update.message.caption if update.message.caption else ""
+            if document_text.tokens <= DOCUMENT_INLINE_TOKENS:
                 contents.append({
                     "role": "user",
-                    "parts": [{ "text": f"{text_prompt}\n\nСодержимое файла:\n\n{decoded_content}"}]
+                    "parts": [{ "text": f"{text_prompt}\n\nСодержимое файла:\n\n{''.join(document_text.chunks)}"}]
                 })
-                LOGGER.debug("Содержимое текстового файла успешно декодировано.")
-            except UnicodeDecodeError:
-                LOGGER.error("Не удалось декодировать файл. Возможно, это бинарный файл.")
-                await update.message.reply_text("Извините, не удалось прочитать этот файл как текст.")
-                return
+                document_text = None
+            else:
+                await update.message.reply_text(
+                    f"📄 Файл большой, читаю его по частям ({len(document_text.chunks)}). Это займёт немного больше времени."
+                    + (" Файл слишком длинный, поэтому прочитано только его начало." if document_text.truncated else "")
+                )
         else:
-            LOGGER.warning(f"Получен неподдерживаемый тип файла: {file_info['mime_type']}.")
+            LOGGER.warning("Получен неподдерживаемый тип файла: %s.", file_info['mime_type'])
             await update.message.reply_text("Извините, этот тип файла не поддерживается.")
             return
             
     elif update.message.photo:
-        photo = update.message.photo[-1]
-        LOGGER.info(f"Получена фотография от {user_id}. File ID: {photo.file_id}")
-        file = await context.bot.get_file(photo.file_id)
-        file_content = await file.download_as_bytearray()
+        LOGGER.info("Получена фотография от %s. File ID: %s", user_id, update.message.photo[-1].file_id)
+        file_content = await download_photo(update.message.photo)
         
         try:
-            img = Image.open(io.BytesIO(file_content))
-            img_rgb = img.convert("RGB")
-            buffer = io.BytesIO()
-            img_rgb.save(buffer, format="JPEG")
-            base64_encoded_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
-            
+            image = await prepare_image(file_content)
+            images.append(image)
             text_prompt = update.message.caption if update.message.caption else "Проанализируй это изображение."
             contents.append({
                 "role": "user",
-                "parts": [
-                    {"text": text_prompt},
-                    {
-                        "inlineData": {
-                            "mimeType": "image/jpeg",
-                            "data": base64_encoded_image
-                        }
-                    }
-                ]
+                "parts": [{"text": text_prompt}, image.as_part()]
             })
             LOGGER.info("Фотография успешно обработана и добавлена в запрос.")
-        except Exception as e:
-            LOGGER.error(f"Ошибка при обработке фотографии: {e}")
+        except ImageProcessingError as e:
+            LOGGER.error("Ошибка при обработке фотографии: %s", e)
             await update.message.reply_text("Извините, произошла ошибка при обработке фотографии.")
             return
 
     elif update.message.text:
         text_prompt = update.message.text
-        LOGGER.info(f"Получен текстовый запрос от {user_id}: '{text_prompt}'")
+        LOGGER.info("Получен текстовый запрос от %s: '%s'", user_id, text_prompt)
         contents.append({
             "role": "user",
             "parts": [{"text": text_prompt}]
@@ -790,28 +3592,64 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пожалуйста, предоставьте текст, фотографию или файл, чтобы я мог помочь.")
         return
 
+    # Место в общей очереди к Gemini; платящие пользователи могут идти в приоритетной очереди
+    async def notify_queued(position: int, eta: float) -> None:
+        await update.message.reply_text(f"🕒 Сейчас много запросов. Вы в очереди: {position}-й, примерно {max(1, round(eta))} с.")
+
+    priority = ADMISSION_PRIORITY_PAID and settings["html_credits"] > 0
+
     try:
-        if response_format == "html":
+        if document_text is not None:
+            # Каждый запрос части занимает своё место в очереди, поэтому map-этап не обходит ADMISSION_PER_USER
+            # и общую ёмкость; о месте в очереди сообщаем один раз, а не по каждой части
+            queued_notified = False
+
+            async def notify_queued_once(position: int, eta: float) -> None:
+                nonlocal queued_notified
+                if not queued_notified:
+                    queued_notified = True
+                    await notify_queued(position, eta)
+
+            summary = await summarize_document(
+                document_text, text_prompt, lambda: ADMISSION.slot(user_id, priority, notify_queued_once))
+            contents.append({
+                "role": "user",
+                "parts": [{"text": f"{text_prompt}\n\nФайл «{document_text.file_name}» слишком большой, поэтому ниже его конспект по частям"
+                                   f"{' (прочитано только начало файла)' if document_text.truncated else ''}:\n\n{summary}"}]
+            })
+
+        # Одинаковые запросы обслуживаются из кэша; кредит при этом всё равно списан выше
+        # Картинка отрисовывается из того же HTML, поэтому у форматов «html» и «image» общий кэш
+        with STAGE_SECONDS.time(stage="payload_build"):
+            cache_key = response_cache_key("html" if response_format in HTML_FORMATS else response_format, contents[-1], images, history)
+        REQUESTS_TOTAL.inc(format=response_format)
+        admission_slot = ADMISSION.slot(user_id, priority, notify_queued)
+
+        if response_format in HTML_FORMATS:
             payload = {
+                "systemInstruction": system_instruction(DEVELOPER_PROMPT),
                 "contents": contents,
                 "generationConfig": {"temperature": 0.4}
             }
             LOGGER.info("Отправка запроса в Gemini API для генерации HTML.")
-            gemini_response = await call_gemini_api(payload)
+            gemini_response = await generate_cached(cache_key, payload, admission_slot)
             
-            user_history[user_id].append({
+            await STORAGE.append_history(user_id, history_user_turn(contents[-1]))
+            await STORAGE.append_history(user_id, {
                 "role": "model",
                 "parts": [{"text": gemini_response}]
             })
             
-            await send_html_file(update, gemini_response)
+            if response_format == "image":
+                await send_html_image(update, gemini_response)
+            else:
+                await send_html_file(update, gemini_response)
 
         elif response_format == "presentation":
             LOGGER.info("Отправка запроса в Gemini API для генерации презентации (JSON).")
-            # Change the prompt and force JSON output for presentation mode
-            contents[0]["parts"][0]["text"] = PRESENTATION_PROMPT
-            
+            # Для презентаций — свой системный промпт и принудительный JSON-ответ
             payload = {
+                "systemInstruction": system_instruction(PRESENTATION_PROMPT),
                 "contents": contents,
                 "generationConfig": {
                     "temperature": 0.4,
@@ -833,56 +3671,446 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 }
             }
             
-            gemini_json_response = await call_gemini_api(payload)
+            gemini_json_response = await generate_cached(cache_key, payload, admission_slot)
 
             try:
                 slides_data = json.loads(gemini_json_response)
                 LOGGER.info("JSON для презентации успешно разобран.")
-                await create_and_send_pptx_file(update, slides_data)
+                await create_and_send_pptx_file(update, slides_data, settings["pptx_theme"])
             except json.JSONDecodeError as e:
-                LOGGER.error(f"Failed to parse JSON from Gemini API: {e}")
+                LOGGER.error("Failed to parse JSON from Gemini API: %s", e)
                 await update.message.reply_text("Извините, произошла ошибка при обработке данных для презентации. Пожалуйста, попробуйте снова.")
 
         elif response_format == "text":
             LOGGER.info("Отправка запроса в Gemini API для генерации обычного текста.")
             payload = {
+                "systemInstruction": system_instruction(DEVELOPER_PROMPT),
                 "contents": contents,
                 "generationConfig": {"temperature": 0.4}
             }
-            gemini_response = await call_gemini_api(payload)
-            clean_text = gemini_response.replace('<!DOCTYPE html>', '').replace('<html>', '').replace('<head>', '').replace('<body>', '').replace('</body>', '').replace('</html>', '').replace('<title>', '').replace('</title>', '').replace('</head>', '').replace('<div class="math-background">', '').replace('</div>', '').replace('<div class="default-background">', '').replace('<p>', '').replace('</p>', '').replace('<h1>', '').replace('</h1>', '')
-            await update.message.reply_text(clean_text)
+            # Ответ выводится по мере генерации в сообщение «Обрабатываю ваш запрос...»
+            cached = await RESPONSE_CACHE.get(cache_key)
+            if cached is not None:
+                await send_streamed_text(update, status_message, iterate_text(cached))
+            else:
+                async def produce() -> str:
+                    async with admission_slot:
+                        text_response = await send_streamed_text(update, status_message, stream_gemini_api(payload))
+                    await RESPONSE_CACHE.put(cache_key, text_response)
+                    return text_response
+
+                # Если такой же запрос уже выводится другому пользователю, дожидаемся готового текста
+                text_response, shared = await GEMINI_SINGLEFLIGHT.do(cache_key, produce)
+                if shared:
+                    await send_streamed_text(update, status_message, iterate_text(text_response))
 
+    except AdmissionRejected as e:
+        LOGGER.warning("Запрос пользователя %s отклонён: %s", user_id, e)
+        await refund_credit()
+        if response_format in HTML_FORMATS:
+            await update.message.reply_text("Извините, сейчас слишком много запросов. Кредит возвращён, попробуйте позже.")
+        else:
+            await update.message.reply_text("Извините, сейчас слишком много запросов. Пожалуйста, попробуйте позже.")
+    except DocumentError as e:
+        LOGGER.warning("Не удалось обработать документ пользователя %s: %s", user_id, e)
+        await refund_credit()
+        await update.message.reply_text(str(e))
     except RetryAfter as e:
-        LOGGER.warning(f"Flood control: Waiting for {e.retry_after} seconds.")
+        LOGGER.warning("Flood control: Waiting for %s seconds.", e.retry_after)
         await asyncio.sleep(e.retry_after)
         await update.message.reply_text("Извините, слишком много запросов. Пожалуйста, попробуйте снова через несколько секунд.")
     except NetworkError as e:
-        LOGGER.error(f"Сетевая ошибка: {e}")
+        LOGGER.error("Сетевая ошибка: %s", e)
         await update.message.reply_text("Извините, произошла сетевая ошибка при обработке.")
     except Exception as e:
-        LOGGER.error(f"Ошибка при обработке: {e}")
+        LOGGER.error("Ошибка при обработке: %s", e)
         await update.message.reply_text("Извините, произошла неизвестная ошибка.")
 
+# Фоновая синхронизация состояния ключей между рабочими процессами
+key_health_task = None
+
+async def sync_key_health_loop() -> None:
+    """Периодически обменивается состоянием API-ключей с другими рабочими процессами."""
+    while True:
+        await asyncio.sleep(KEY_HEALTH_SYNC_INTERVAL)
+        try:
+            await GEMINI_KEY_POOL.sync_health(STORAGE)
+        except Exception as e:
+            LOGGER.error("Не удалось синхронизировать состояние API-ключей: %s", e)
+
+async def post_init(application: Application) -> None:
+    """Выполняется после инициализации бота: открывает общие ресурсы."""
+    await open_gemini_client()
+    open_image_executor()
+    open_pptx_executor()
+    await STORAGE.open()
+    await RESPONSE_CACHE.open()
+    if HTML_RENDER_ENABLED:
+        await HTML_RENDERER.open()
+    await open_metrics_server()
+    if LOOP_WATCHDOG_ENABLED:
+        LOOP_WATCHDOG.start()
+    if BOT_WORKERS > 1:
+        global key_health_task
+        key_health_task = asyncio.create_task(sync_key_health_loop())
+
+async def post_shutdown(application: Application) -> None:
+    """Выполняется при остановке бота: закрывает общие ресурсы."""
+    if key_health_task is not None:
+        key_health_task.cancel()
+    await close_gemini_client()
+    await close_document_client()
+    close_image_executor()
+    close_pptx_executor()
+    await STORAGE.close()
+    await RESPONSE_CACHE.close()
+    await HTML_RENDERER.close()
+    await close_metrics_server()
+    LOOP_WATCHDOG.stop()
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает ошибки в приложении и логирует их."""
     LOGGER.error("Произошла ошибка, но бот продолжит работу.")
-    LOGGER.error(f"Update {update} caused error {context.error}")
+    LOGGER.error("Update %s caused error %s", update, context.error)
 
-def main() -> None:
-    """Запускает бота."""
-    if not BOT_TOKEN:
-        LOGGER.error("Токен бота не найден в secrets.env. Пожалуйста, добавьте BOT_TOKEN.")
-        exit(1)
-        
-    if not GEMINI_API_KEYS or GEMINI_API_KEYS == ['']:
-        LOGGER.error("В файле secrets.env нет API-ключей. Пожалуйста, добавьте их.")
+# --- Приём обновлений ---
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает до max_concurrent_updates обновлений одновременно, но обновления одного чата —
+    строго по очереди и в порядке поступления. Обновления без чата (например, pre_checkout_query)
+    обрабатываются сразу.
+    Место из max_concurrent_updates занимается только после очереди своего чата: обновления, ждущие
+    предыдущих из того же чата, мест не занимают, поэтому один активный чат не задерживает остальные.
+    Поэтому ограничение PTB (семафор вокруг do_process_update) отключено, а действует собственное.
+
+    Кроме того, ограничено число принятых, но ещё не обработанных обновлений (max_pending):
+    PTB забирает обновления из update_queue сразу, поэтому ограничение размера самой очереди
+    ничего не сдерживает. Источник обновлений вызывает try_admit (webhook: False — ответить 503)
+    или admit (ждать освобождения места); место освобождается, когда обработка закончена.
+    """
+
+    UNLIMITED = 2 ** 31 - 1
+
+    def __init__(self, max_concurrent_updates: int, max_pending: int = UNLIMITED):
+        super().__init__(self.UNLIMITED)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chats = {}  # chat_id -> [Lock, число обновлений чата в работе]
+        self.max_pending = max_pending
+        self._admitted = {}  # update_id -> число принятых копий (Telegram может доставить обновление повторно)
+        self._released = asyncio.Event()
+
+    @property
+    def pending(self) -> int:
+        return sum(self._admitted.values())
+
+    def try_admit(self, update_id: int) -> bool:
+        """Резервирует место для нового обновления; False, если принятых обновлений уже max_pending."""
+        if self.pending >= self.max_pending:
+            return False
+        self._admitted[update_id] = self._admitted.get(update_id, 0) + 1
+        return True
+
+    async def admit(self, update_id: int) -> None:
+        """Ждёт, пока освободится место для нового обновления, и резервирует его."""
+        while not self.try_admit(update_id):
+            self._released.clear()
+            await self._released.wait()
+
+    def release(self, update) -> None:
+        """Освобождает место, занятое обновлением (если оно было принято через try_admit/admit)."""
+        update_id = getattr(update, "update_id", None)
+        count = self._admitted.get(update_id)
+        if count is None:
+            return
+        if count > 1:
+            self._admitted[update_id] = count - 1
+        else:
+            del self._admitted[update_id]
+        self._released.set()
+
+    async def do_process_update(self, update, coroutine) -> None:
+        try:
+            chat = update.effective_chat if isinstance(update, Update) else None
+            if chat is None:
+                async with self._slots:
+                    await coroutine
+                return
+
+            entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0], self._slots:
+                    await coroutine
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._chats[chat.id]
+        finally:
+            self.release(update)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+async def _send_response(send, status: int, body: bytes = b"") -> None:
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+def make_webhook_app(submit):
+    """
+    ASGI-приложение для webhook: проверяет секретный токен, разбирает обновление и передаёт его
+    в submit(data). submit возвращает False, если очередь обновлений заполнена, — тогда отвечаем 503
+    и Telegram повторит доставку позже.
+    """
+    secret = WEBHOOK_SECRET.encode()
+
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        if scope["path"] != WEBHOOK_PATH or scope["method"] != "POST":
+            await _send_response(send, 404)
+            return
+
+        headers = dict(scope["headers"])
+        if secret and not hmac.compare_digest(headers.get(b"x-telegram-bot-api-secret-token", b""), secret):
+            LOGGER.warning("Webhook: запрос с неверным секретным токеном отклонён.")
+            await _send_response(send, 403)
+            return
+
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if len(body) > WEBHOOK_MAX_BODY:
+                await _send_response(send, 413)
+                return
+
+        try:
+            accepted = submit(json.loads(body))
+        except Exception as e:
+            LOGGER.warning("Webhook: не удалось разобрать обновление: %s", e)
+            await _send_response(send, 400)
+            return
+
+        if not accepted:
+            LOGGER.warning("Webhook: очередь обновлений заполнена, Telegram повторит доставку.")
+            await _send_response(send, 503)
+            return
+        await _send_response(send, 200)
+
+    return app
+
+async def register_webhook(bot: Bot) -> None:
+    """Сообщает Telegram адрес webhook и секретный токен."""
+    if not WEBHOOK_SECRET:
+        LOGGER.warning("WEBHOOK_SECRET не задан: запросы к webhook не проверяются.")
+    await bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+
+async def serve_webhook(submit) -> None:
+    """Запускает встроенный ASGI-сервер (uvicorn) и работает до остановки (Ctrl+C)."""
+    try:
+        import uvicorn
+    except ImportError:
+        LOGGER.error("Для режима webhook нужен пакет uvicorn: pip install uvicorn")
         exit(1)
 
-    LOGGER.info(f"Найдено {len(GEMINI_API_KEYS)} API-ключей. Запуск бота...")
-    
-    application = Application.builder().token(BOT_TOKEN).build()
-    
+    server = uvicorn.Server(uvicorn.Config(
+        make_webhook_app(submit),
+        host=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        lifespan="off",
+        access_log=False,
+        log_level="warning",
+    ))
+    LOGGER.info("Webhook запущен на %s:%s%s.", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+    await server.serve()
+
+def make_update_submit(application: Application):
+    """
+    submit(data) для make_webhook_app в режиме одного процесса: передаёт обновление приложению.
+    Возвращает False, если принятых и ещё не обработанных обновлений уже UPDATE_QUEUE_SIZE.
+    """
+    def submit(data: dict) -> bool:
+        update = Update.de_json(data, application.bot)
+        if not application.update_processor.try_admit(update.update_id):
+            return False
+        try:
+            application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            application.update_processor.release(update)
+            return False
+        return True
+
+    return submit
+
+async def run_webhook(application: Application) -> None:
+    """Запускает бота в режиме webhook в одном процессе."""
+    submit = make_update_submit(application)
+    async with application:
+        await post_init(application)
+        await register_webhook(application.bot)
+        await application.start()
+        try:
+            await serve_webhook(submit)
+        finally:
+            await application.stop()
+            await post_shutdown(application)
+
+# --- Несколько рабочих процессов ---
+
+def update_shard_key(data: dict) -> int:
+    """
+    По какому ключу обновление направляется в рабочий процесс: по отправителю, а если его нет — по чату.
+    Все данные бота привязаны к пользователю, поэтому его обновления (и альбомы) обрабатывает один процесс;
+    в личном чате это и есть chat_id.
+    """
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        if "from" in value:
+            return value["from"]["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return 0
+
+def run_worker(index: int, updates) -> None:
+    """Точка входа рабочего процесса: получает обновления из очереди updates и обрабатывает их."""
+    # Остановкой управляет главный процесс (через None в очереди), Ctrl+C здесь игнорируется
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    LOGGER.info("Рабочий процесс %s запущен.", index)
+    asyncio.run(serve_worker(build_application(with_updater=False), updates))
+    LOGGER.info("Рабочий процесс %s остановлен.", index)
+
+async def serve_worker(application: Application, updates) -> None:
+    loop = asyncio.get_running_loop()
+    async with application:
+        await post_init(application)
+        await application.start()
+        try:
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    break
+                # Пока принятых обновлений max_pending, следующие копятся в очереди процесса,
+                # а когда заполнится и она — главный процесс отвечает Telegram 503
+                update = Update.de_json(data, application.bot)
+                await application.update_processor.admit(update.update_id)
+                await application.update_queue.put(update)
+        finally:
+            await application.stop()
+            await post_shutdown(application)
+
+async def dispatch_updates(queues: list) -> None:
+    """Принимает обновления (webhook или long polling) и раздаёт их рабочим процессам."""
+    def submit(data: dict) -> bool:
+        try:
+            queues[update_shard_key(data) % len(queues)].put_nowait(data)
+        except queue.Full:
+            return False
+        return True
+
+    async with Bot(BOT_TOKEN, **telegram_api_options()) as bot:
+        if WEBHOOK_URL:
+            await register_webhook(bot)
+            await serve_webhook(submit)
+            return
+
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                received = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except NetworkError as e:
+                LOGGER.warning("Ошибка при получении обновлений: %s", e)
+                await asyncio.sleep(1)
+                continue
+            for update in received:
+                offset = update.update_id + 1
+                data = update.to_dict()
+                # Если очередь процесса заполнена, ждём, пока он её разберёт
+                while not submit(data):
+                    await asyncio.sleep(0.1)
+
+def start_workers() -> tuple:
+    """Запускает BOT_WORKERS рабочих процессов. Возвращает (очереди обновлений, процессы)."""
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(BOT_WORKERS)]
+    workers = [
+        context.Process(target=run_worker, args=(index, updates), name=f"bot-worker-{index}")
+        for index, updates in enumerate(queues)
+    ]
+    for worker in workers:
+        worker.start()
+    LOGGER.info("Запущено рабочих процессов: %s.", BOT_WORKERS)
+    return queues, workers
+
+def stop_workers(queues: list, workers: list) -> None:
+    """Просит рабочие процессы завершиться (None в очереди) и дожидается их."""
+    LOGGER.info("Остановка рабочих процессов...")
+    for updates in queues:
+        try:
+            updates.put(None, timeout=5)
+        except queue.Full:
+            pass
+    for worker in workers:
+        worker.join(timeout=30)
+        if worker.is_alive():
+            worker.terminate()
+
+def run_dispatcher() -> None:
+    """Запускает BOT_WORKERS рабочих процессов и раздаёт им обновления до остановки (Ctrl+C)."""
+    queues, workers = start_workers()
+    try:
+        asyncio.run(dispatch_updates(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(queues, workers)
+
+def telegram_api_options() -> dict:
+    """Адреса Bot API из настроек (свой сервер или поддельный из bench.py) для Bot и Application.builder()."""
+    options = {}
+    if TELEGRAM_API_BASE:
+        options["base_url"] = TELEGRAM_API_BASE
+    if TELEGRAM_FILE_API_BASE:
+        options["base_file_url"] = TELEGRAM_FILE_API_BASE
+    return options
+
+def build_application(with_updater: bool = True) -> Application:
+    """Создаёт приложение бота со всеми обработчиками."""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES, UPDATE_QUEUE_SIZE))
+    )
+    for option, value in telegram_api_options().items():
+        builder = getattr(builder, option)(value)
+    if not with_updater:
+        # Обновления приходят от главного процесса
+        builder = builder.updater(None)
+    application = builder.build()
+
     # Команды и кнопки
     application.add_handler(CommandHandler("start", start_command_handler))
     application.add_handler(CommandHandler("reset", reset_command_handler))
@@ -899,9 +4127,29 @@ def main() -> None:
     
     # Обработчик ошибок
     application.add_error_handler(error_handler)
+    return application
+
+def main() -> None:
+    """Запускает бота."""
+    if not BOT_TOKEN:
+        LOGGER.error("Токен бота не найден в secrets.env. Пожалуйста, добавьте BOT_TOKEN.")
+        exit(1)
+        
+    if not GEMINI_API_KEYS or GEMINI_API_KEYS == ['']:
+        LOGGER.error("В файле secrets.env нет API-ключей. Пожалуйста, добавьте их.")
+        exit(1)
+
+    LOGGER.info("Найдено %s API-ключей. Запуск бота...", len(GEMINI_API_KEYS))
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_WORKERS > 1:
+        run_dispatcher()
+        return
+
+    application = build_application()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
-
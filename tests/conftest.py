@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# bot.py при импорте проверяет наличие ключей и читает настройки из окружения
+os.environ.setdefault("GEMINI_API_KEYS", "test-key")
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ.setdefault("LOOP_WATCHDOG_ENABLED", "false")
+
+
+@pytest.fixture(scope="session")
+def bot():
+    """Модуль бота; тесты пропускаются, если не установлены его зависимости."""
+    for module in ("telegram", "httpx", "dotenv", "PIL", "pptx"):
+        pytest.importorskip(module)
+    return importlib.import_module("bot")
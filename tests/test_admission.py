@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+
+def make_scheduler(bot, capacity=1, max_wait=5):
+    key_pool = SimpleNamespace(healthy_count=capacity)
+    return bot.AdmissionScheduler(key_pool, per_key=1, per_user=1, max_wait=max_wait)
+
+
+async def hold_slot(scheduler, user_id, release: asyncio.Event):
+    async with scheduler.slot(user_id):
+        await release.wait()
+
+
+async def enter_slot(scheduler, user_id, on_queued):
+    async with scheduler.slot(user_id, on_queued=on_queued):
+        pass
+
+
+def test_failed_notification_keeps_waiting(bot):
+    async def scenario():
+        scheduler = make_scheduler(bot)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold_slot(scheduler, 1, release))
+        await asyncio.sleep(0)
+
+        async def on_queued(position, eta):
+            raise RuntimeError("bot was blocked by the user")
+
+        async def queued():
+            async with scheduler.slot(2, on_queued=on_queued):
+                return scheduler.active
+
+        waiting = asyncio.create_task(queued())
+        await asyncio.sleep(0)
+        release.set()
+        assert await waiting == 1
+        await holder
+        assert scheduler.active == 0 and scheduler.queued == 0
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("grant_before_cancel", [False, True])
+def test_cancelled_notification_releases_capacity(bot, grant_before_cancel):
+    async def scenario():
+        scheduler = make_scheduler(bot)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold_slot(scheduler, 1, release))
+        await asyncio.sleep(0)
+
+        notifying = asyncio.Event()
+
+        async def on_queued(position, eta):
+            notifying.set()
+            await asyncio.sleep(3600)
+
+        waiting = asyncio.create_task(enter_slot(scheduler, 2, on_queued))
+        await notifying.wait()
+        if grant_before_cancel:
+            # Место освобождается, пока пользователю ещё отправляется уведомление
+            release.set()
+            await holder
+            assert scheduler.active == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        release.set()
+        await holder
+        assert scheduler.active == 0 and scheduler.queued == 0
+        # Пользователь снова может получить место
+        async with scheduler.slot(2):
+            assert scheduler.active == 1
+
+    asyncio.run(scenario())
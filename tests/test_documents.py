@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+# Ровно одна часть при DOCUMENT_CHUNK_TOKENS = 100 (около 4 символов на токен); в буфере чанкера остаётся только «\n»
+FULL_CHUNK = "a" * 399 + "\n\n"
+
+
+def read(bot, monkeypatch, pieces):
+    """Читает документ, текст которого отдаётся частями pieces, с лимитом в одну часть."""
+    monkeypatch.setattr(bot, "DOCUMENT_CHUNK_TOKENS", 100)
+    monkeypatch.setattr(bot, "DOCUMENT_MAX_TOKENS", 100)
+
+    async def download_document(document, spool):
+        return ""
+
+    async def iter_document_text(spool, is_pdf):
+        for text in pieces:
+            yield text
+
+    monkeypatch.setattr(bot, "download_document", download_document)
+    monkeypatch.setattr(bot, "iter_document_text", iter_document_text)
+    return asyncio.run(bot.read_document(SimpleNamespace(file_name="doc.txt"), False))
+
+
+@pytest.mark.parametrize("pieces, truncated", [
+    # Лимит набран, но дальше ничего нет
+    ([FULL_CHUNK], False),
+    ([FULL_CHUNK, "  \n\n "], False),
+    # После лимита есть текст — файл обрезан
+    ([FULL_CHUNK, "c"], True),
+    (["b" * 300 + " " + "b" * 200], True),
+    # Лимит не набран
+    (["a" * 300], False),
+])
+def test_read_document_truncated(bot, monkeypatch, pieces, truncated):
+    document_text = read(bot, monkeypatch, pieces)
+    assert document_text.truncated is truncated
+    assert len(document_text.chunks) == 1
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+
+def turn(role, text):
+    return {"role": role, "parts": [{"text": text}]}
+
+
+def test_get_after_append_returns_history_items(bot):
+    cache = bot.HistoryCache(max_users=10, ttl=3600, token_budget=10000)
+    cache.append(1, turn("user", "привет"))
+    cache.append(1, turn("model", "здравствуйте"))
+
+    assert cache.get(1) == [turn("user", "привет"), turn("model", "здравствуйте")]
+    assert cache.get(1) == cache.items(1)
+
+
+def test_get_after_put_returns_history_items(bot):
+    cache = bot.HistoryCache(max_users=10, ttl=3600, token_budget=10000)
+    cache.put(2, [turn("user", "вопрос")])
+
+    assert cache.get(2) == [turn("user", "вопрос")]
+    assert cache.get(3) is None
+
+
+def test_oversized_user_turn_is_kept_until_answered(bot):
+    cache = bot.HistoryCache(max_users=10, ttl=3600, token_budget=5)
+    cache.append(1, turn("user", "a" * 100))
+    assert cache.get(1) == [turn("user", "a" * 100)]
+
+    # Пара не помещается в бюджет, а история не может начинаться с ответа модели
+    cache.append(1, turn("model", "b" * 100))
+    assert cache.get(1) == []
+
+
+def test_token_budget_trims_whole_pairs(bot):
+    # Каждое сообщение — 26 токенов; бюджет вмещает три сообщения, но не четыре
+    cache = bot.HistoryCache(max_users=10, ttl=3600, token_budget=80)
+    for index in range(3):
+        cache.append(1, turn("user", f"u{index}" + "x" * 98))
+        cache.append(1, turn("model", f"m{index}" + "y" * 98))
+
+        history = cache.get(1)
+        assert history[0]["role"] == "user"
+        assert [item["role"] for item in history] == ["user", "model"] * (len(history) // 2)
+
+    assert [item["parts"][0]["text"][:2] for item in cache.get(1)] == ["u2", "m2"]
+
+
+def test_message_limit_trims_whole_pairs(bot, monkeypatch):
+    monkeypatch.setattr(bot, "MAX_HISTORY_MESSAGES", 5)
+    cache = bot.HistoryCache(max_users=10, ttl=3600, token_budget=10000)
+    for index in range(4):
+        cache.append(1, turn("user", f"u{index}"))
+        cache.append(1, turn("model", f"m{index}"))
+
+    assert [item["parts"][0]["text"] for item in cache.get(1)] == ["u2", "m2", "u3", "m3"]
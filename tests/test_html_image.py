@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from types import SimpleNamespace
+
+
+class Message:
+    """Сообщение, у которого Telegram отклоняет и фото, и документ."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.calls = []
+
+    async def reply_photo(self, photo):
+        self.calls.append("photo")
+        raise self.bot.BadRequest("Photo_invalid_dimensions")
+
+    async def reply_document(self, document, filename):
+        self.calls.append(filename)
+        raise self.bot.BadRequest("Request entity too large")
+
+
+def test_image_falls_back_to_html_file(bot, monkeypatch):
+    message = Message(bot)
+    update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=1))
+    sent = []
+
+    async def render(html_code):
+        return b"jpeg"
+
+    async def send_html_file(update, html_code):
+        sent.append(html_code)
+
+    monkeypatch.setattr(bot.HTML_RENDERER, "render", render)
+    monkeypatch.setattr(bot, "send_html_file", send_html_file)
+    asyncio.run(bot.send_html_image(update, "<p>ответ</p>"))
+    assert message.calls == ["photo", "solution.jpg"]
+    assert sent == ["<p>ответ</p>"]
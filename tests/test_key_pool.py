@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+
+def test_least_loaded_key_is_chosen(bot):
+    async def scenario():
+        pool = bot.ApiKeyPool(["a", "b"], rpm=10, tpm=1000)
+        first = await pool.acquire(10)
+        second = await pool.acquire(10)
+        await pool.release(first)
+        third = await pool.acquire(10)
+        return first.key, second.key, third.key
+
+    # Третий запрос уходит на освободившийся ключ «a», а не на занятый «b»
+    assert asyncio.run(scenario()) == ("a", "b", "a")
+
+
+def test_rate_limited_key_is_paused(bot):
+    async def scenario():
+        pool = bot.ApiKeyPool(["a", "b"], rpm=10, tpm=1000)
+        state = await pool.acquire(10)
+        await pool.release(state, "rate_limited", retry_after=30)
+        keys = []
+        for _ in range(3):
+            state = await pool.acquire(10)
+            keys.append(state.key)
+            await pool.release(state)
+        return keys
+
+    assert asyncio.run(scenario()) == ["b", "b", "b"]
+
+
+def test_invalid_keys_are_excluded(bot):
+    async def scenario():
+        pool = bot.ApiKeyPool(["a", "b"], rpm=10, tpm=1000)
+        for _ in range(2):
+            await pool.release(await pool.acquire(10), "invalid")
+        assert pool.healthy_count == 0
+        await pool.acquire(10, timeout=1)
+
+    with pytest.raises(bot.NoHealthyKeysError):
+        asyncio.run(scenario())
+
+
+def test_exhausted_budget_waits_then_times_out(bot):
+    async def scenario():
+        pool = bot.ApiKeyPool(["a"], rpm=1, tpm=1000)
+        await pool.release(await pool.acquire(10))
+        # Бюджет на минуту исчерпан, новый запрос будет возможен только через ~60 с
+        await pool.acquire(10, timeout=0.05)
+
+    with pytest.raises(bot.NoHealthyKeysError):
+        asyncio.run(scenario())
+
+
+def test_waiter_gets_key_after_cooldown(bot):
+    async def scenario():
+        pool = bot.ApiKeyPool(["a"], rpm=10, tpm=1000)
+        await pool.release(await pool.acquire(10), "rate_limited", retry_after=0.05)
+        state = await pool.acquire(10, timeout=1)
+        return state.key
+
+    assert asyncio.run(scenario()) == "a"
+
+
+def test_actual_tokens_correct_the_estimate(bot):
+    async def scenario():
+        pool = bot.ApiKeyPool(["a"], rpm=10, tpm=1000)
+        state = await pool.acquire(100)
+        await pool.release(state, actual_tokens=900, estimated_tokens=100)
+        return state.tpm.tokens
+
+    # Из 1000 токенов минуты списаны 900 фактических, а не 100 оценочных
+    assert asyncio.run(scenario()) == pytest.approx(100, abs=1)
+
+
+def test_health_is_shared_between_workers(bot, tmp_path):
+    async def scenario():
+        storage = bot.Storage(str(tmp_path / "bot.sqlite3"))
+        await storage.open()
+        try:
+            first, second = bot.ApiKeyPool(["a", "b"], 10, 1000), bot.ApiKeyPool(["a", "b"], 10, 1000)
+            await first.release(await first.acquire(10), "rate_limited", retry_after=30)
+            await first.release(await first.acquire(10), "invalid")
+            await first.sync_health(storage)
+            await second.sync_health(storage)
+            return second._states
+        finally:
+            await storage.close()
+
+    states = asyncio.run(scenario())
+    assert states[0].cooldown_until - bot.time.monotonic() == pytest.approx(30, abs=2)
+    assert [state.invalid for state in states] == [False, True]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import threading
+import time
+
+
+def stalls(bot):
+    return sum(bot.LOOP_STALLS._values.values())
+
+
+def test_stall_is_counted_once_on_loop_thread(bot, caplog, monkeypatch):
+    increments = []
+    original_inc = bot.LOOP_STALLS.inc
+
+    def inc(*args, **labels):
+        increments.append(threading.get_ident())
+        original_inc(*args, **labels)
+
+    monkeypatch.setattr(bot.LOOP_STALLS, "inc", inc)
+
+    async def scenario():
+        watchdog = bot.LoopWatchdog(interval=0.02, threshold=0.1)
+        watchdog.start()
+        await asyncio.sleep(0.05)
+        before = stalls(bot)
+        time.sleep(0.4) # Синхронный код блокирует цикл
+        await asyncio.sleep(0.1)
+        watchdog.stop()
+        return before
+
+    with caplog.at_level(logging.WARNING, logger="bot"):
+        before = asyncio.run(scenario())
+
+    assert stalls(bot) - before == 1
+    assert increments == [threading.get_ident()]
+    warnings = [record for record in caplog.records if "заблокирован" in record.getMessage()]
+    assert len(warnings) == 1
+    assert "Стек" in warnings[0].getMessage()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from types import SimpleNamespace
+
+
+def message_update(message_id):
+    return SimpleNamespace(message=SimpleNamespace(message_id=message_id, photo=None, caption=None))
+
+
+def test_processed_group_leaves_registry(bot, monkeypatch):
+    processed = []
+
+    async def process_media_group(group, context):
+        processed.append(len(group.updates))
+
+    monkeypatch.setattr(bot, "process_media_group", process_media_group)
+    monkeypatch.setattr(bot, "MEDIA_GROUP_FIRST_WAIT", 0.01)
+    monkeypatch.setattr(bot, "media_groups", {})
+    monkeypatch.setattr(bot, "processed_media_groups", {})
+
+    async def scenario():
+        group = bot.media_groups["album"] = bot.MediaGroup(1)
+        group.add(message_update(1))
+        await bot.collect_media_group("album", group, context=None)
+
+    asyncio.run(scenario())
+    assert processed == [1]
+    assert bot.media_groups == {}
+    assert "album" in bot.processed_media_groups
+
+    # Спустя MEDIA_GROUP_RETAIN альбом забывается
+    bot.processed_media_groups["album"] -= bot.MEDIA_GROUP_RETAIN + 1
+    bot.sweep_media_groups()
+    assert bot.processed_media_groups == {}
+
+
+def test_failed_group_leaves_registry(bot, monkeypatch):
+    async def process_media_group(group, context):
+        raise RuntimeError("Telegram недоступен")
+
+    monkeypatch.setattr(bot, "process_media_group", process_media_group)
+    monkeypatch.setattr(bot, "MEDIA_GROUP_FIRST_WAIT", 0.01)
+    monkeypatch.setattr(bot, "media_groups", {})
+    monkeypatch.setattr(bot, "processed_media_groups", {})
+
+    async def scenario():
+        group = bot.media_groups["album"] = bot.MediaGroup(1)
+        group.add(message_update(1))
+        try:
+            await bot.collect_media_group("album", group, context=None)
+        except RuntimeError:
+            pass
+
+    asyncio.run(scenario())
+    assert bot.media_groups == {}
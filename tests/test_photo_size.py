@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+MB = 1024 * 1024
+
+# (ширина, высота, размер в МБ) вариантов фото
+SMALL = (320, 240, 0.02)
+MEDIUM = (800, 600, 0.1)
+LARGE = (1280, 960, 0.3)
+HUGE = (2560, 1920, 25)
+HUGE_NO_SIZE = (2560, 1920, None)
+
+
+@pytest.mark.parametrize("sizes, fallback, expected", [
+    # Наименьший вариант не меньше PHOTO_TARGET_EDGE
+    ([SMALL, MEDIUM, LARGE, HUGE], True, LARGE),
+    ([SMALL, MEDIUM, LARGE, HUGE], False, LARGE),
+    # Размер неизвестен — вариант считается укладывающимся в лимит
+    ([SMALL, HUGE_NO_SIZE], False, HUGE_NO_SIZE),
+    # Подходящего нет: самый большой, если это разрешено...
+    ([SMALL, MEDIUM, HUGE], True, HUGE),
+    ([SMALL, MEDIUM], True, MEDIUM),
+    # ...иначе самый большой из укладывающихся в лимит
+    ([SMALL, MEDIUM, HUGE], False, MEDIUM),
+    ([SMALL, MEDIUM], False, MEDIUM),
+    # В лимит не укладывается ни один вариант
+    ([HUGE], False, HUGE),
+])
+def test_select_photo_size(bot, monkeypatch, sizes, fallback, expected):
+    monkeypatch.setattr(bot, "PHOTO_TARGET_EDGE", 1280)
+    monkeypatch.setattr(bot, "IMAGE_MAX_INPUT_BYTES", 20 * MB)
+    monkeypatch.setattr(bot, "PHOTO_FALLBACK_TO_LARGEST", fallback)
+
+    from telegram import PhotoSize
+
+    photo_sizes = [
+        PhotoSize(f"id{index}", f"unique{index}", width, height,
+                      int(megabytes * MB) if megabytes is not None else None)
+        for index, (width, height, megabytes) in enumerate(sizes)
+    ]
+    selected = bot.select_photo_size(photo_sizes)
+
+    assert (selected.width, selected.height) == expected[:2]
+    assert selected.file_size == (int(expected[2] * MB) if expected[2] is not None else None)
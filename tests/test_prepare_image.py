@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+def test_slot_is_held_until_timed_out_job_finishes(bot, monkeypatch):
+    finish = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def slow_prepare(*args):
+        finish.wait(5)
+        return "image/jpeg", "", "digest", None
+
+    monkeypatch.setattr(bot, "open_image_executor", lambda: executor)
+    monkeypatch.setattr(bot, "_prepare_image_sync", slow_prepare)
+    monkeypatch.setattr(bot, "IMAGE_PROCESS_TIMEOUT", 0.05)
+
+    async def scenario():
+        monkeypatch.setattr(bot, "image_slots", asyncio.Semaphore(1))
+        with pytest.raises(bot.ImageProcessingError):
+            await bot.prepare_image(b"raw")
+        # Процесс пула ещё работает — место занято
+        held = bot.image_slots.locked()
+        finish.set()
+        await asyncio.wait_for(bot.image_slots.acquire(), 1)
+        return held
+
+    try:
+        assert asyncio.run(scenario()) is True
+    finally:
+        finish.set()
+        executor.shutdown()
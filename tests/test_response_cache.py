@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+
+def test_memory_hit_and_miss(bot):
+    async def scenario():
+        cache = bot.ResponseCache(ttl=60, max_bytes=1024)
+        assert await cache.get("key") is None
+        await cache.put("key", "ответ")
+        assert await cache.get("key") == "ответ"
+        return cache.stats
+
+    stats = asyncio.run(scenario())
+    assert stats["misses"] == 1 and stats["memory_hits"] == 1
+
+
+def test_error_messages_are_not_cached(bot):
+    async def scenario():
+        cache = bot.ResponseCache(ttl=60, max_bytes=1024)
+        await cache.put("error", bot.GEMINI_FAILED_MESSAGE)
+        await cache.put("empty", "")
+        return await cache.get("error"), await cache.get("empty")
+
+    assert asyncio.run(scenario()) == (None, None)
+
+
+def test_expired_entries_are_dropped(bot, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "time", lambda: now[0])
+
+    async def scenario():
+        cache = bot.ResponseCache(ttl=10, max_bytes=1024)
+        await cache.put("key", "ответ")
+        now[0] += 11
+        return await cache.get("key"), cache._memory_bytes
+
+    assert asyncio.run(scenario()) == (None, 0)
+
+
+def test_memory_tier_evicts_least_recently_used(bot):
+    async def scenario():
+        cache = bot.ResponseCache(ttl=60, max_bytes=10)
+        await cache.put("a", "aaaa")
+        await cache.put("b", "bbbb")
+        await cache.get("a")  # «a» теперь использовалась последней
+        await cache.put("c", "cccc")
+        return [await cache.get(key) for key in "abc"], cache.stats["evictions"]
+
+    values, evictions = asyncio.run(scenario())
+    assert values == ["aaaa", None, "cccc"]
+    assert evictions == 1
+
+
+def test_disk_tier_is_shared_between_processes(bot, tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+
+    async def scenario():
+        writer, reader = bot.ResponseCache(60, 1024, path, 1 << 20), bot.ResponseCache(60, 1024, path, 1 << 20)
+        await writer.open()
+        await reader.open()
+        try:
+            await writer.put("key", "ответ")
+            value = await reader.get("key")
+            busy_timeout = reader._conn.execute("PRAGMA busy_timeout").fetchone()[0]
+            return value, reader.stats["disk_hits"], busy_timeout
+        finally:
+            await writer.close()
+            await reader.close()
+
+    assert asyncio.run(scenario()) == ("ответ", 1, 5000)
+
+
+def test_disk_tier_is_trimmed_to_limit(bot, tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+
+    async def scenario():
+        cache = bot.ResponseCache(60, 1024, path, disk_max_bytes=500)
+        await cache.open()
+        try:
+            for number in range(100):
+                await cache.put(f"key{number}", f"{number:010d}")
+            total = cache._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            newest = cache._conn.execute("SELECT 1 FROM responses WHERE key = 'key99'").fetchone()
+            return total, newest
+        finally:
+            await cache.close()
+
+    total, newest = asyncio.run(scenario())
+    assert total <= 500
+    assert newest is not None
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+
+def counting_factory(calls, release):
+    async def factory():
+        calls.append(1)
+        await release.wait()
+        return f"ответ {len(calls)}"
+    return factory
+
+
+def test_concurrent_calls_share_one_request(bot):
+    async def scenario():
+        flight, calls, release = bot.SingleFlight(), [], asyncio.Event()
+        factory = counting_factory(calls, release)
+        waiters = [asyncio.create_task(flight.do("key", factory)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters)
+        return results, len(calls), len(flight)
+
+    results, calls, left = asyncio.run(scenario())
+    assert calls == 1 and left == 0
+    assert [result for result, _ in results] == ["ответ 1"] * 5
+    assert [shared for _, shared in results] == [False, True, True, True, True]
+
+
+def test_different_keys_and_later_calls_are_separate(bot):
+    async def scenario():
+        flight, calls, release = bot.SingleFlight(), [], asyncio.Event()
+        release.set()
+        factory = counting_factory(calls, release)
+        await asyncio.gather(flight.do("a", factory), flight.do("b", factory))
+        await flight.do("a", factory)
+        return len(calls)
+
+    assert asyncio.run(scenario()) == 3
+
+
+def test_cancelled_waiter_does_not_cancel_shared_request(bot):
+    async def scenario():
+        flight, calls, release = bot.SingleFlight(), [], asyncio.Event()
+        factory = counting_factory(calls, release)
+        first = asyncio.create_task(flight.do("key", factory))
+        second = asyncio.create_task(flight.do("key", factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await second, first.cancelled()
+
+    assert asyncio.run(scenario()) == (("ответ 1", True), True)
+
+
+def test_request_is_cancelled_when_nobody_waits(bot):
+    async def scenario():
+        flight, cancelled = bot.SingleFlight(), asyncio.Event()
+
+        async def factory():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.create_task(flight.do("key", factory))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        return len(flight)
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_errors_reach_every_waiter(bot):
+    async def scenario():
+        flight, release = bot.SingleFlight(), asyncio.Event()
+
+        async def factory():
+            await release.wait()
+            raise RuntimeError("Gemini недоступен")
+
+        waiters = [asyncio.create_task(flight.do("key", factory)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        return results, len(flight)
+
+    results, left = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert left == 0
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import sqlite3
+import threading
+
+
+def open_storages(bot, path, count):
+    """Открывает count хранилищ на одной базе одновременно, как рабочие процессы при BOT_WORKERS > 1."""
+    storages = [bot.Storage(str(path)) for _ in range(count)]
+    barrier = threading.Barrier(count)
+    errors = []
+
+    def open_one(storage):
+        barrier.wait()
+        try:
+            storage._open_sync()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=open_one, args=(storage,)) for storage in storages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return storages, errors
+
+
+def test_new_database_has_pptx_theme(bot, tmp_path):
+    storages, errors = open_storages(bot, tmp_path / "bot.sqlite3", 4)
+    assert errors == []
+    columns = {row[1] for row in storages[0]._conn.execute("PRAGMA table_info(users)")}
+    assert "pptx_theme" in columns
+
+
+def test_legacy_database_is_migrated_concurrently(bot, tmp_path):
+    path = tmp_path / "legacy.sqlite3"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, response_format TEXT NOT NULL DEFAULT 'html', "
+                 "html_credits INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("INSERT INTO users (user_id, html_credits) VALUES (1, 3)")
+    conn.commit()
+    conn.close()
+
+    storages, errors = open_storages(bot, path, 4)
+    assert errors == []
+    row = storages[0]._conn.execute("SELECT html_credits, pptx_theme FROM users WHERE user_id = 1").fetchone()
+    assert row == (3, bot.DEFAULT_PPTX_THEME)
+
+
+def run_with_storages(bot, path, count, scenario):
+    """Выполняет scenario(storages) с count открытыми хранилищами на одной базе."""
+    async def run():
+        storages = [bot.Storage(str(path)) for _ in range(count)]
+        for storage in storages:
+            await storage.open()
+        try:
+            return await scenario(storages)
+        finally:
+            for storage in storages:
+                await storage.close()
+
+    return asyncio.run(run())
+
+
+def test_credits_are_added_and_debited(bot, tmp_path):
+    async def scenario(storages):
+        storage = storages[0]
+        await storage.get_settings(1)  # Баланс в кэше настроек обновляется вместе с базой
+        balances = [await storage.add_credits(1, 2), await storage.try_debit_credits(1),
+                    await storage.try_debit_credits(1), await storage.try_debit_credits(1)]
+        return balances, (await storage.get_settings(1))["html_credits"]
+
+    balances, cached = run_with_storages(bot, tmp_path / "bot.sqlite3", 1, scenario)
+    # Третье списание не проходит, баланс не уходит в минус
+    assert balances == [2, 1, 0, None]
+    assert cached == 0
+
+
+def test_payment_is_credited_once(bot, tmp_path):
+    async def scenario(storages):
+        storage = storages[0]
+        first = await storage.add_credits(1, 5, charge_id="charge-1")
+        repeated = await storage.add_credits(1, 5, charge_id="charge-1")
+        other = await storage.add_credits(1, 5, charge_id="charge-2")
+        return first, repeated, other
+
+    assert run_with_storages(bot, tmp_path / "bot.sqlite3", 1, scenario) == (5, 5, 10)
+
+
+def test_concurrent_debits_do_not_overspend(bot, tmp_path):
+    async def scenario(storages):
+        await storages[0].add_credits(1, 5)
+        # Как рабочие процессы при BOT_WORKERS > 1: у каждого хранилища своё соединение и свой поток
+        results = await asyncio.gather(*(storages[i % len(storages)].try_debit_credits(1) for i in range(20)))
+        balance = (await storages[0].get_settings(1))["html_credits"]
+        return results, balance
+
+    results, balance = run_with_storages(bot, tmp_path / "bot.sqlite3", 4, scenario)
+    assert sorted(result for result in results if result is not None) == [0, 1, 2, 3, 4]
+    assert results.count(None) == 15
+    assert balance == 0
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import html
+import re
+
+import pytest
+
+TAG_RE = re.compile(r"<(/?)([a-z-]+)[^>]*>")
+
+
+def check_piece(piece, limit):
+    """Проверяет, что теги части сбалансированы, а видимый текст не длиннее limit; возвращает видимый текст."""
+    stack = []
+    for closing, name in TAG_RE.findall(piece):
+        if closing:
+            assert stack and stack[-1] == name, piece
+            stack.pop()
+        else:
+            stack.append(name)
+    assert stack == [], piece
+    text = html.unescape(TAG_RE.sub("", piece))
+    assert len(text) <= limit
+    assert "<" not in TAG_RE.sub("", piece)
+    return text
+
+
+def convert(bot, source, limit=4096):
+    """Сообщения без завершающих переводов строки (Telegram их всё равно обрезает)."""
+    return [piece.rstrip("\n") for piece in bot.html_to_telegram(source, limit)]
+
+
+def test_inline_tags_and_headings(bot):
+    pieces = convert(bot, "<h2>Ответ</h2><p><strong>x</strong> = <em>2</em></p>")
+    assert pieces == ["<b>Ответ</b>\n\n<b>x</b> = <i>2</i>"]
+
+
+def test_unsupported_tags_are_dropped_and_text_escaped(bot):
+    pieces = convert(bot, 
+        '<div class="card"><span style="color:red">a &lt; b &amp;&amp; c &gt; d</span></div>'
+        "<style>p { color: red }</style><script>alert(1)</script><p>&lt;b&gt;не тег&lt;/b&gt;</p>"
+    )
+    assert pieces == ["a &lt; b &amp;&amp; c &gt; d\n\n&lt;b&gt;не тег&lt;/b&gt;"]
+
+
+def test_unsafe_links_are_dropped(bot):
+    pieces = convert(bot, '<a href="javascript:alert(1)">x</a> <a href="https://e.com/?a=1&b=2">y</a>')
+    assert pieces == ['x <a href="https://e.com/?a=1&amp;b=2">y</a>']
+
+
+def test_lists(bot):
+    pieces = convert(bot, "<ol><li>один</li><li>два<ul><li>вложенный</li></ul></li></ol>")
+    assert pieces == ["1. один\n2. два\n  • вложенный"]
+
+
+def test_unclosed_and_misnested_tags_are_closed(bot):
+    assert convert(bot, "<b>жирный <i>курсив</b> текст") == ["<b>жирный <i>курсив</i></b> текст"]
+    assert convert(bot, "<pre><code>x = 1") == ["<pre>x = 1</pre>"]
+
+
+def test_markup_inside_pre_is_dropped(bot):
+    assert convert(bot, "<pre><b>x</b> &lt; 1</pre>") == ["<pre>x &lt; 1</pre>"]
+
+
+@pytest.mark.parametrize("source", [
+    "<b>" + "слово " * 50 + "</b>",
+    "<b>начало <i>" + "длинный курсив " * 30 + "</i> конец</b>",
+    "<blockquote>" + "a&b " * 60 + "</blockquote>",
+    "<pre>" + "x = 1\n" * 40 + "</pre>",
+    "<b>" + "а" * 250 + "</b>",
+])
+def test_split_keeps_tags_balanced(bot, source):
+    limit = 50
+    pieces = bot.html_to_telegram(source, limit)
+    assert len(pieces) > 1
+    texts = [check_piece(piece, limit) for piece in pieces]
+    # Разрывы съедают только пробелы и переводы строк на границе
+    expected = html.unescape(TAG_RE.sub("", bot.html_to_telegram(source)[0]))
+    assert "".join(texts).replace(" ", "").replace("\n", "") == expected.replace(" ", "").replace("\n", "")
+
+
+def test_split_reopens_tags_in_next_piece(bot):
+    pieces = convert(bot, "<b>first second <i>third fourth</i></b>", limit=14)
+    # Перед разрывом не остаётся пустого <i></i>, слово «third» не разрезано
+    assert pieces == ["<b>first second </b>", "<b><i>third fourth</i></b>"]
+
+
+def test_split_prefers_line_breaks(bot):
+    pieces = convert(bot, "<p>первая строка</p><p>вторая строка</p>", limit=20)
+    assert pieces == ["первая строка", "вторая строка"]
+
+
+def test_long_word_is_cut_at_limit(bot):
+    assert convert(bot, "<b>" + "а" * 25 + "</b>", limit=10) == ["<b>" + "а" * 10 + "</b>"] * 2 + ["<b>" + "а" * 5 + "</b>"]
+
+
+def test_unfinished_stream_hides_partial_tag(bot):
+    assert bot.html_to_telegram("<b>ответ</b> <i", final=False) == ["<b>ответ</b> "]
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+
+
+def make_update(update_id, chat_id, text="привет"):
+    chat = {"id": chat_id, "type": "private"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "chat": chat, "text": text,
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Тест"},
+        },
+    }
+
+
+async def post(app, data, path="/", secret=None):
+    """Отправляет обновление в ASGI-приложение так, как это делает Telegram, и возвращает HTTP-статус."""
+    headers = [(b"content-type", b"application/json")]
+    if secret is not None:
+        headers.append((b"x-telegram-bot-api-secret-token", secret.encode()))
+    scope = {"type": "http", "method": "POST", "path": path, "headers": headers}
+    body = json.dumps(data).encode()
+    messages = [{"type": "http.request", "body": body[:10], "more_body": True},
+                {"type": "http.request", "body": body[10:], "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]["status"]
+
+
+def queue_submit(updates: asyncio.Queue):
+    def submit(data: dict) -> bool:
+        try:
+            updates.put_nowait(data)
+        except asyncio.QueueFull:
+            return False
+        return True
+    return submit
+
+
+def test_secret_token_is_checked(bot, monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "s3cret")
+
+    async def scenario():
+        updates = asyncio.Queue()
+        app = bot.make_webhook_app(queue_submit(updates))
+        assert await post(app, make_update(1, 10)) == 403
+        assert await post(app, make_update(1, 10), secret="wrong") == 403
+        assert await post(app, make_update(1, 10), secret="s3cret") == 200
+        assert await post(app, make_update(2, 10), path="/other", secret="s3cret") == 404
+        assert updates.qsize() == 1
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_returns_503(bot, monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "")
+
+    async def scenario():
+        updates = asyncio.Queue(maxsize=1)
+        app = bot.make_webhook_app(queue_submit(updates))
+        assert await post(app, make_update(1, 10)) == 200
+        assert await post(app, make_update(2, 10)) == 503
+        updates.get_nowait()
+        assert await post(app, make_update(2, 10)) == 200
+
+    asyncio.run(scenario())
+
+
+def test_updates_of_one_chat_are_ordered_without_blocking_others(bot, monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "")
+
+    async def scenario():
+        updates = asyncio.Queue()
+        app = bot.make_webhook_app(queue_submit(updates))
+        for update_id, chat_id in [(1, 10), (2, 10), (3, 10), (4, 20)]:
+            assert await post(app, make_update(update_id, chat_id)) == 200
+
+        processor = bot.ChatOrderedUpdateProcessor(2)
+        release = asyncio.Event()
+        handled = []
+
+        async def handle(update):
+            if update.effective_chat.id == 10:
+                await release.wait()
+            handled.append(update.update_id)
+
+        # Так же, как Application раздаёт обновления из update_queue
+        tasks = []
+        while not updates.empty():
+            update = bot.Update.de_json(updates.get_nowait(), None)
+            tasks.append(asyncio.create_task(processor.process_update(update, handle(update))))
+
+        # Чат 20 обрабатывается, пока первое обновление чата 10 ещё выполняется
+        await asyncio.wait_for(tasks[3], timeout=1)
+        assert handled == [4]
+
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=1)
+        assert handled == [4, 1, 2, 3]
+
+    asyncio.run(scenario())
+
+
+def test_backpressure_returns_503_while_updates_are_in_flight(bot, monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "")
+
+    async def scenario():
+        processor = bot.ChatOrderedUpdateProcessor(1, max_pending=2)
+        application = (
+            bot.Application.builder().token("123456:test").updater(None)
+            .update_queue(asyncio.Queue(maxsize=100)).concurrent_updates(processor).build()
+        )
+        app = bot.make_webhook_app(bot.make_update_submit(application))
+        release = asyncio.Event()
+
+        async def handle(update):
+            await release.wait()
+
+        # Как Application: обновления сразу забираются из очереди и ждут своей очереди чата в задачах
+        tasks = []
+
+        async def fetch():
+            while not application.update_queue.empty():
+                update = application.update_queue.get_nowait()
+                tasks.append(asyncio.create_task(processor.process_update(update, handle(update))))
+            await asyncio.sleep(0)
+
+        statuses = []
+        for update_id in range(1, 6):
+            statuses.append(await post(app, make_update(update_id, 10)))
+            await fetch()
+        assert statuses == [200, 200, 503, 503, 503]
+        assert application.update_queue.qsize() == 0 and processor.pending == 2
+
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=1)
+        assert processor.pending == 0
+        assert await post(app, make_update(6, 10)) == 200
+
+    asyncio.run(scenario())